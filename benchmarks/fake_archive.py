@@ -0,0 +1,445 @@
+"""
+Local stand-in for the NED and Vizier services, serving canned responses with
+configurable faults: latency, errors, slow and truncated bodies. It is used to
+drive the pipeline hard without sending a single request to the real archives.
+"""
+import re
+import gzip
+import math
+import time
+import random
+import hashlib
+import threading
+from collections import Counter, defaultdict
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+from astroquery.ned import Ned
+from astroquery.vizier import Vizier
+
+from .fixtures import VOTABLE_HEADER
+
+
+@dataclass
+class Faults:
+    """
+    Faults injected into the responses of the fake archive
+    latency: time in seconds before every response starts
+    jitter: mean of an exponentially distributed extra delay, in seconds
+    error_rate: fraction of requests answered with 503 Service Unavailable
+    slow_rate: fraction of responses whose body is sent in chunks over
+               slow_time seconds
+    truncate_rate: fraction of responses whose body is cut in half and the
+                   connection closed
+    """
+
+    latency: float = 0.0
+    jitter: float = 0.0
+    error_rate: float = 0.0
+    slow_rate: float = 0.0
+    slow_time: float = 2.0
+    truncate_rate: float = 0.0
+
+
+def redshift_table(object_name):
+    """
+    Per-object NED redshift table. Most objects get a spectroscopic redshift
+    with a small uncertainty, the others only a photometric one; the choice is
+    fixed by the object name, such that runs are reproducible.
+    Input:
+        object_name: NED object name
+    Return:
+        VOTable document in bytes
+    """
+    seed = int(hashlib.sha256(object_name.encode()).hexdigest()[:8], 16)
+    rng = np.random.default_rng(seed)
+    n_rows = rng.integers(1, 4)
+    z = rng.uniform(0.01, 1.5)
+    spectroscopic = rng.uniform() < 0.7
+    uncertainty = rng.uniform(1e-5, 5e-4, n_rows) if spectroscopic else [0.05] * n_rows
+
+    out = [VOTABLE_HEADER, '<RESOURCE type="results">\n<TABLE ID="NED_Redshifts">\n']
+    out.append('<FIELD name="No." datatype="int"/>\n')
+    out.append('<FIELD name="Published Redshift" datatype="double"/>\n')
+    out.append('<FIELD name="Published Redshift Uncertainty" datatype="double"/>\n')
+    out.append("<DATA><TABLEDATA>\n")
+    for i in range(n_rows):
+        out.append(f"<TR><TD>{i + 1}</TD><TD>{z:.6f}</TD>")
+        out.append(f"<TD>{uncertainty[i]:.6f}</TD></TR>\n")
+    out.append("</TABLEDATA></DATA>\n</TABLE>\n</RESOURCE>\n</VOTABLE>\n")
+    return "".join(out).encode()
+
+
+# Parts of the canned Vizier responses, which have one RESOURCE per catalog and
+# one row per line, see fixtures.vizier_votable
+CATALOG = re.compile(
+    rb"(<RESOURCE[^>]*>\n<TABLE[^>]*>\n)(.*?)<DATA><TABLEDATA>\n(.*?)"
+    rb"</TABLEDATA></DATA>\n</TABLE>\n</RESOURCE>\n",
+    re.DOTALL,
+)
+FIELD_ELEMENT = re.compile(rb"<FIELD.*?</FIELD>\n", re.DOTALL)
+ATTRIBUTE_NAME = re.compile(rb'name="([^"]*)"')
+
+
+def constraint(value):
+    """
+    Turn a Vizier column constraint into a test of a cell; only the numeric
+    comparisons and equality are understood. Missing values never match.
+    """
+    if value[0] in "<>":
+        limit = float(value[1:])
+        compare = (lambda x: x < limit) if value[0] == "<" else (lambda x: x > limit)
+        return lambda cell: cell != b"" and compare(float(cell))
+    return lambda cell: cell == value.encode()
+
+
+def in_cone(ra, dec, cone):
+    """
+    Input:
+        ra, dec: position in degrees
+        cone: tuple of the center RA, DEC and the radius, in degrees
+    Return:
+        True if the position lies within the cone
+    """
+    ra0, dec0, radius = map(math.radians, cone)
+    ra, dec = math.radians(ra), math.radians(dec)
+    cos_separation = math.sin(dec) * math.sin(dec0) + math.cos(dec) * math.cos(
+        dec0
+    ) * math.cos(ra - ra0)
+    return cos_separation >= math.cos(radius)
+
+
+def vizier_cone(options):
+    """
+    Cone of a Vizier query script, e.g. -c=150.00000000+2.00000000 with
+    -c.rm=20 for a radius of 20 arcmin
+    Input:
+        options: dictionary of the options of the script
+    Return:
+        tuple of the center RA, DEC and the radius in degrees, or None if the
+        script has no cone around coordinates
+    """
+    center = re.fullmatch(r"([0-9.]+)([+-][0-9.]+)", options.get("-c", ""))
+    scales = {"-c.rd": 1, "-c.rm": 1 / 60, "-c.rs": 1 / 3600}
+    radii = [float(options[k]) * v for k, v in scales.items() if k in options]
+    if center is None or not radii:
+        return None
+    return float(center.group(1)), float(center.group(2)), radii[0]
+
+
+def ned_cone(params):
+    """
+    Cone of a NED region query: lon in hours (as astroquery sends it for
+    equatorial coordinates), lat in degrees and radius in arcmin
+    Input:
+        params: query string parameters of the request
+    Return:
+        tuple of the center RA, DEC and the radius in degrees, or None if the
+        query has no cone around coordinates
+    """
+    try:
+        ra, dec, radius = (float(params[k][0]) for k in ("lon", "lat", "radius"))
+    except (KeyError, ValueError):
+        return None
+    return ra * 15, dec, radius / 60
+
+
+class CannedCatalogs:
+    """
+    Canned response split into its catalogs (tables), such that the fake
+    archive can answer only part of it, like the archives do: the rows within
+    the searched cone, and for Vizier the options of the query script: the
+    catalog (-source), the columns (-out, -out.add, -out.all), the maximum
+    number of rows per catalog (-out.max) and the column constraints.
+    Catalogs without any matching row are left out, as Vizier does, unless
+    keep_empty is set: NED answers an empty table.
+    Input:
+        response: VOTable document with one row per line, see
+                  fixtures.vizier_votable and fixtures.ned_votable
+        ra, dec: names of the position columns of the catalogs
+        keep_empty: whether to answer catalogs without matching rows
+    """
+
+    def __init__(self, response, ra="_RAJ2000", dec="_DEJ2000", keep_empty=False):
+        self.response = response
+        self.keep_empty = keep_empty
+        self.header = response[: response.find(b"<RESOURCE")]
+        self.catalogs = []
+        for match in CATALOG.finditer(response):
+            start, fields, rows = match.groups()
+            fields = FIELD_ELEMENT.findall(fields)
+            names = [ATTRIBUTE_NAME.search(f).group(1).decode() for f in fields]
+            table = ATTRIBUTE_NAME.search(start[start.find(b"<TABLE") :])
+            name = table.group(1).decode() if table is not None else None
+            position = (names.index(ra), names.index(dec))
+            self.catalogs.append((name, start, fields, names, position, rows))
+
+    def vizier(self, script):
+        """
+        Input:
+            script: Vizier query script sent by astroquery, in bytes
+        Return:
+            VOTable document in bytes
+        """
+        options = {}
+        for line in script.decode().splitlines():
+            key, _, value = line.partition("=")
+            options[key] = value
+        columns = options.get("-out", "").split(",")
+        columns += options.get("-out.add", "").split(",")
+        limit = options.get("-out.max", "unlimited")
+        return self.select(
+            cone=vizier_cone(options),
+            source=options.get("-source"),
+            columns=None if "-out.all" in options else columns,
+            limit=None if limit == "unlimited" else int(limit),
+            filters={k: constraint(v) for k, v in options.items() if k[:1] != "-"},
+        )
+
+    def select(self, cone=None, source=None, columns=None, limit=None, filters=None):
+        """
+        Input:
+            cone: optional tuple of the center RA, DEC and the radius of the
+                  search, in degrees
+            source: optional name of the only catalog to answer
+            columns: optional names of the columns to answer
+            limit: optional maximum number of rows per catalog
+            filters: dictionary of column name and test of its cells
+        Return:
+            VOTable document in bytes
+        """
+        filters = filters if filters is not None else {}
+        if (cone, source, columns, limit, filters) == (None, None, None, None, {}):
+            return self.response
+
+        out = [self.header]
+        for name, start, fields, names, position, rows in self.catalogs:
+            if source not in (None, name):
+                continue
+            keep = [i for i, n in enumerate(names) if columns is None or n in columns]
+            tests = [
+                (names.index(k), test) for k, test in filters.items() if k in names
+            ]
+            ra, dec = position
+            selected = []
+            for row in rows.splitlines():
+                cells = row[len(b"<TR><TD>") : -len(b"</TD></TR>")].split(b"</TD><TD>")
+                if cone is not None:
+                    if not in_cone(float(cells[ra]), float(cells[dec]), cone):
+                        continue
+                if all(test(cells[i]) for i, test in tests):
+                    selected.append(b"</TD><TD>".join(cells[i] for i in keep))
+                    if len(selected) == limit:
+                        break
+            if not selected and not self.keep_empty:
+                continue
+            out += [start, *(fields[i] for i in keep), b"<DATA><TABLEDATA>\n"]
+            out += [b"<TR><TD>" + row + b"</TD></TR>\n" for row in selected]
+            out.append(b"</TABLEDATA></DATA>\n</TABLE>\n</RESOURCE>\n")
+        out.append(b"</VOTABLE>\n")
+        return b"".join(out)
+
+
+class ArchiveStats:
+    """
+    Thread-safe record of the requests answered by the fake archive: number of
+    requests per endpoint and outcome, service time of each request, bytes
+    sent and number of connections opened by the clients
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = Counter()
+        self.latencies = defaultdict(list)
+        self.bytes_sent = 0
+        self.connections = 0
+
+    def connected(self):
+        with self.lock:
+            self.connections += 1
+
+    def record(self, endpoint, outcome, latency, size):
+        with self.lock:
+            self.counts[(endpoint, outcome)] += 1
+            self.latencies[endpoint].append(latency)
+            self.bytes_sent += size
+
+    def summary(self):
+        """
+        Request counts and latency percentiles per endpoint
+        Return:
+            dictionary per endpoint with the number of requests per outcome and
+            the 50th, 90th, 99th percentile and maximum latency in seconds
+        """
+        with self.lock:
+            summary = {}
+            for endpoint, latencies in self.latencies.items():
+                p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+                summary[endpoint] = {
+                    "requests": {
+                        outcome: n
+                        for (e, outcome), n in self.counts.items()
+                        if e == endpoint
+                    },
+                    "p50": p50,
+                    "p90": p90,
+                    "p99": p99,
+                    "max": max(latencies),
+                }
+            return summary
+
+
+class FakeArchive:
+    """
+    HTTP server answering the Vizier region query, the NED region query and
+    the NED per-object redshift tables, in a background thread. The region
+    queries are answered with the rows of the canned responses that lie in
+    the searched cone.
+    Input:
+        vizier_response: VOTable of the catalogs of every Vizier region query
+        ned_response: VOTable of the sources of every NED region query
+        faults: faults to inject, see Faults
+        seed: seed of the random generator deciding which requests fail
+    """
+
+    def __init__(self, vizier_response, ned_response, faults=None, seed=0):
+        self.vizier = CannedCatalogs(vizier_response)
+        self.ned = CannedCatalogs(ned_response, "RA", "DEC", keep_empty=True)
+        self.faults = faults if faults is not None else Faults()
+        self.stats = ArchiveStats()
+        self.random = random.Random(seed)
+        self.random_lock = threading.Lock()
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), self.handler())
+        self.server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def draw(self):
+        with self.random_lock:
+            return self.random.random(), self.random.random(), self.random.random()
+
+    def delay(self):
+        if not self.faults.jitter:
+            return self.faults.latency
+        with self.random_lock:
+            return self.faults.latency + self.random.expovariate(1 / self.faults.jitter)
+
+    def response(self, endpoint, params):
+        if endpoint == "vizier":
+            return self.vizier.vizier(params["script"])
+        if endpoint == "ned_region":
+            return self.ned.select(cone=ned_cone(params))
+        return redshift_table(params.get("objname", [""])[0])
+
+    def handler(self):
+        archive = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                archive.stats.connected()
+
+            def do_GET(self):
+                url = urlparse(self.path)
+                endpoint = {
+                    "/cgi-bin/objsearch": "ned_region",
+                    "/cgi-bin/datasearch": "ned_redshifts",
+                }.get(url.path)
+                self.answer(endpoint, parse_qs(url.query))
+
+            def do_POST(self):
+                # Vizier sends the query as a script in the request body
+                script = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                url = urlparse(self.path)
+                endpoint = "vizier" if url.path.startswith("/viz-bin/") else None
+                self.answer(endpoint, {"script": script})
+
+            def answer(self, endpoint, params):
+                start = time.monotonic()
+                self.gzip = False
+                if endpoint is None:
+                    self.send_error(404)
+                    return
+                time.sleep(archive.delay())
+                error, slow, truncate = archive.draw()
+                faults = archive.faults
+
+                if error < faults.error_rate:
+                    body = b"<html><body>Service Unavailable</body></html>"
+                    self.send(503, body)
+                    outcome = "503"
+                elif truncate < faults.truncate_rate:
+                    body = self.encode(archive.response(endpoint, params))
+                    self.send(200, body[: len(body) // 2], length=len(body))
+                    self.close_connection = True
+                    outcome = "truncated"
+                elif slow < faults.slow_rate:
+                    body = self.encode(archive.response(endpoint, params))
+                    self.send(200, body, chunks=10, pause=faults.slow_time / 10)
+                    outcome = "slow"
+                else:
+                    body = self.encode(archive.response(endpoint, params))
+                    self.send(200, body)
+                    outcome = "200"
+                archive.stats.record(
+                    endpoint, outcome, time.monotonic() - start, len(body)
+                )
+
+            def encode(self, body):
+                # Compress the response if the client accepts it, like the
+                # archives do
+                self.gzip = "gzip" in self.headers.get("Accept-Encoding", "")
+                return gzip.compress(body, compresslevel=1) if self.gzip else body
+
+            def send(self, status, body, length=None, chunks=1, pause=0.0):
+                self.send_response(status)
+                self.send_header("Content-Type", "text/xml")
+                if status == 200 and self.gzip:
+                    self.send_header("Content-Encoding", "gzip")
+                self.send_header("Content-Length", str(length or len(body)))
+                self.end_headers()
+                step = -(-len(body) // chunks)
+                try:
+                    for i in range(0, len(body), step):
+                        self.wfile.write(body[i : i + step])
+                        self.wfile.flush()
+                        if pause:
+                            time.sleep(pause)
+                except (BrokenPipeError, ConnectionResetError):
+                    self.close_connection = True
+
+        return Handler
+
+
+def use_fake_archive(url):
+    """
+    Send all NED and Vizier queries of this process to the fake archive
+    Input:
+        url: base URL of the fake archive
+    """
+    NedClass = type(Ned)
+    NedClass.OBJ_SEARCH_URL = f"{url}/cgi-bin/objsearch"
+    NedClass.DATA_SEARCH_URL = f"{url}/cgi-bin/datasearch"
+    type(Vizier)._server_to_url = lambda self, return_type="votable": (
+        f"{url}/viz-bin/{return_type}"
+    )
@@ -0,0 +1,198 @@
+import os
+
+import numpy as np
+
+# Location of the generated fixtures; they are generated once and reused by all
+# later benchmark runs
+FIXTURE_DIR = os.path.expanduser(
+    os.environ.get("REDSHIFTS_BENCHMARK_DIR", "~/.cache/redshifts/benchmarks")
+)
+# Part of the name of the fixture files, to be increased whenever the fixtures
+# change such that old files are not reused
+FIXTURE_VERSION = 2
+
+# Fields of increasing size: number of distinct sources, number of Vizier
+# catalogs, and average number of catalogs that measure each source. The dense
+# field has 10^6 Vizier rows, most of them duplicates of the same sources.
+FIELDS = {
+    "sparse": (500, 4, 1.2),
+    "medium": (20_000, 10, 2.5),
+    "dense": (250_000, 20, 4.0),
+}
+
+VOTABLE_HEADER = (
+    '<?xml version="1.0" encoding="UTF-8"?>\n'
+    '<VOTABLE version="1.2" xmlns="http://www.ivoa.net/xml/VOTable/v1.2">\n'
+)
+
+# Columns of the Vizier catalogs: name, UCD (Vizier answers with UCD1 words),
+# datatype, precision, unit and description. Every catalog has a spectroscopic
+# redshift, a photometric redshift that has to be rejected, and a velocity.
+VIZIER_FIELDS = [
+    ("_RAJ2000", "POS_EQ_RA_MAIN", "double", 6, "deg", "Right ascension"),
+    ("_DEJ2000", "POS_EQ_DEC_MAIN", "double", 6, "deg", "Declination"),
+    ("Name", "ID_MAIN", "char", None, None, "Source name"),
+    ("z", "REDSHIFT_HC", "double", 5, None, "Spectroscopic redshift"),
+    ("zph", "REDSHIFT_PHOT", "float", 2, None, "Photometric redshift"),
+    ("HRV", "VELOC_HC", "int", None, "km/s", "Heliocentric velocity"),
+    ("Mag", "PHOT_MAG", "float", 2, "mag", "Magnitude"),
+]
+
+NED_OBJECT_TYPES = ["G", "G", "G", "G", "QSO", "GClstr", "GGroup", "*"]
+NED_REDSHIFT_FLAGS = ["", "", "", "SPEC", "PHOT", "?"]
+
+
+def field_rows(field, seed=0):
+    """
+    Draw the sources of a synthetic field and the catalogs that measured them
+    Input:
+        field: name of the field, see FIELDS
+        seed: seed of the random generator, such that fixtures are reproducible
+    Return:
+        list with, for each catalog, the RA, DEC, redshift and velocity of its
+        rows and the masks of the missing values
+    """
+    n_sources, n_catalogs, duplication = FIELDS[field]
+    rng = np.random.default_rng(seed)
+    ra = 150 + rng.uniform(-0.5, 0.5, n_sources)
+    dec = 2 + rng.uniform(-0.5, 0.5, n_sources)
+    z = rng.uniform(0.01, 1.5, n_sources)
+
+    catalogs = []
+    for _ in range(n_catalogs):
+        # Each catalog measures a random subset of the sources, with positions
+        # scattered by a fraction of an arcsec
+        rows = np.flatnonzero(rng.uniform(size=n_sources) < duplication / n_catalogs)
+        scatter = rng.normal(0, 0.2 / 3600, (2, len(rows)))
+        catalogs.append(
+            {
+                "ra": ra[rows] + scatter[0],
+                "dec": dec[rows] + scatter[1],
+                "z": z[rows] + rng.normal(0, 1e-4, len(rows)),
+                "z_mask": rng.uniform(size=len(rows)) < 0.1,
+                "v_mask": rng.uniform(size=len(rows)) < 0.5,
+                "mag": rng.uniform(15, 23, len(rows)),
+            }
+        )
+    return catalogs
+
+
+def field_element(name, ucd, datatype, precision, unit, description):
+    attributes = f'name="{name}" ucd="{ucd}" datatype="{datatype}"'
+    if datatype == "char":
+        attributes += ' arraysize="*"'
+    if precision is not None:
+        attributes += f' precision="{precision}"'
+    if unit is not None:
+        attributes += f' unit="{unit}"'
+    # Like Vizier, declare the value that stands for a missing integer, such
+    # that empty cells are read as masked rather than as 0
+    values = '<VALUES null="-2147483648"/>' if datatype == "int" else ""
+    return (
+        f"<FIELD {attributes}><DESCRIPTION>{description}</DESCRIPTION>"
+        f"{values}</FIELD>\n"
+    )
+
+
+def cells(values, fmt, mask=None):
+    """
+    Format a column as TABLEDATA cells, with empty cells for missing values
+    """
+    text = np.char.mod(fmt, values)
+    if mask is not None:
+        text[mask] = ""
+    return text
+
+
+def vizier_votable(field, seed=0):
+    """
+    Build a Vizier response of a synthetic field, with one RESOURCE per catalog
+    Input:
+        field: name of the field, see FIELDS
+        seed: seed of the random generator
+    Return:
+        VOTable document in bytes
+    """
+    out = [VOTABLE_HEADER]
+    for k, cat in enumerate(field_rows(field, seed)):
+        out.append(f'<RESOURCE ID="yCat_{k}" name="J/BENCH/{k}">\n')
+        out.append(f'<TABLE ID="J_BENCH_{k}_table" name="J/BENCH/{k}/table">\n')
+        out.extend(field_element(*f) for f in VIZIER_FIELDS)
+        out.append("<DATA><TABLEDATA>\n")
+        n = len(cat["ra"])
+        columns = [
+            cells(cat["ra"], "%.6f"),
+            cells(cat["dec"], "%+.6f"),
+            cells(np.arange(n), "S%07d"),
+            cells(cat["z"], "%.5f", cat["z_mask"]),
+            cells(np.round(cat["z"], 1), "%.2f"),
+            cells(cat["z"] * 299792.458, "%d", cat["v_mask"]),
+            cells(cat["mag"], "%.2f"),
+        ]
+        for row in zip(*columns):
+            out.append("<TR><TD>" + "</TD><TD>".join(row) + "</TD></TR>\n")
+        out.append("</TABLEDATA></DATA>\n</TABLE>\n</RESOURCE>\n")
+    out.append("</VOTABLE>\n")
+    return "".join(out).encode()
+
+
+def ned_votable(field, seed=0):
+    """
+    Build a NED region query response of a synthetic field
+    Input:
+        field: name of the field, see FIELDS
+        seed: seed of the random generator
+    Return:
+        VOTable document in bytes
+    """
+    n_sources = FIELDS[field][0]
+    rng = np.random.default_rng(seed + 1)
+    ra = 150 + rng.uniform(-0.5, 0.5, n_sources)
+    dec = 2 + rng.uniform(-0.5, 0.5, n_sources)
+    z = rng.uniform(0.01, 1.5, n_sources)
+    columns = [
+        cells(np.arange(1, n_sources + 1), "%d"),
+        cells(np.arange(n_sources), "BENCH J%07d"),
+        cells(ra, "%.5f"),
+        cells(dec, "%+.5f"),
+        rng.choice(NED_OBJECT_TYPES, n_sources),
+        cells(z, "%.6f", rng.uniform(size=n_sources) < 0.3),
+        rng.choice(NED_REDSHIFT_FLAGS, n_sources),
+    ]
+    fields = [
+        ("No.", "meta.number", "int", None, None, "Row number"),
+        ("Object Name", "meta.id", "char", None, None, "Object name"),
+        ("RA", "pos.eq.ra", "double", None, "degrees", "Right ascension"),
+        ("DEC", "pos.eq.dec", "double", None, "degrees", "Declination"),
+        ("Type", "src.class", "char", None, None, "Object type"),
+        ("Redshift", "src.redshift", "double", None, None, "Redshift"),
+        ("Redshift Flag", "meta.code", "char", None, None, "Redshift flag"),
+    ]
+    out = [VOTABLE_HEADER, '<RESOURCE type="results">\n<TABLE ID="NED_MainTable">\n']
+    out.extend(field_element(*f) for f in fields)
+    out.append("<DATA><TABLEDATA>\n")
+    for row in zip(*columns):
+        out.append("<TR><TD>" + "</TD><TD>".join(row) + "</TD></TR>\n")
+    out.append("</TABLEDATA></DATA>\n</TABLE>\n</RESOURCE>\n</VOTABLE>\n")
+    return "".join(out).encode()
+
+
+def fixture(service, field, seed=0):
+    """
+    Read a fixture from disk, generating and storing it the first time
+    Input:
+        service: Vizier or NED
+        field: name of the field, see FIELDS
+        seed: seed of the random generator
+    Return:
+        VOTable document in bytes
+    """
+    path = os.path.join(FIXTURE_DIR, f"{service}_{field}_{seed}_v{FIXTURE_VERSION}.vot")
+    if not os.path.exists(path):
+        build = vizier_votable if service == "Vizier" else ned_votable
+        os.makedirs(FIXTURE_DIR, exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            f.write(build(field, seed))
+        os.replace(path + ".tmp", path)
+    with open(path, "rb") as f:
+        return f.read()
@@ -0,0 +1,178 @@
+"""
+End-to-end load test: run the full pipeline over many fields against the local
+fake archive, and report the throughput, the requests sent and their tail
+latencies. Example, 50 fields over 4 processes with 0.2 s latency and 2% errors:
+
+    python -m benchmarks.load --fields 50 --jobs 4 --latency 0.2 --error-rate 0.02
+"""
+import os
+import json
+import time
+import tempfile
+import warnings
+from collections import Counter
+from dataclasses import replace
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import numpy as np
+from astropy.utils.exceptions import AstropyWarning
+
+import redshifts.batch as b
+import redshifts.constants as c
+from redshifts.main import load_config
+
+from .fake_archive import FakeArchive, Faults, use_fake_archive
+from .fixtures import FIELDS, fixture
+
+
+def init_load_worker(url, config):
+    """
+    Point a worker process at the fake archive and store the configuration
+    Input:
+        url: base URL of the fake archive
+        config: configuration
+    """
+    warnings.simplefilter("ignore", AstropyWarning)
+    use_fake_archive(url)
+    b.init_worker(config)
+
+
+def load_targets(n_fields):
+    """
+    Fields of the load test; all fields get the same canned responses, but have
+    their own coordinates such that no request is answered from a cache
+    Input:
+        n_fields: number of fields
+    Return:
+        list of targets, as read by batch.read_targets
+    """
+    return [
+        {
+            "name": f"load_{i:04d}",
+            "RA": f"{150 + 0.01 * i} deg",
+            "DEC": "2 deg",
+            "radius": None,
+        }
+        for i in range(n_fields)
+    ]
+
+
+def run_load(data_path, config, faults, field="sparse", n_fields=10, jobs=1):
+    """
+    Run the pipeline over many fields against the fake archive
+    Input:
+        data_path: location to place the results of the fields
+        config: configuration; the response cache, the NED verdicts and the
+                stage manifest are switched off, such that every field queries
+                the archive, and the catalog index is kept in data_path
+        faults: faults injected by the fake archive
+        field: size of the canned responses, see fixtures.FIELDS
+        n_fields: number of fields
+        jobs: number of fields run in parallel
+    Return:
+        dictionary with the throughput, the outcome of the fields and the
+        requests per endpoint with their latency percentiles
+    """
+    config = replace(
+        config,
+        use_cache=False,
+        ned_verdicts=False,
+        reuse_stages=False,
+        cache_dir=os.path.join(data_path, "cache"),
+    )
+    archive = FakeArchive(fixture("Vizier", field), fixture("NED", field), faults)
+    archive.start()
+    targets = load_targets(n_fields)
+
+    start = time.monotonic()
+    try:
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            initializer=init_load_worker,
+            initargs=(archive.url, config),
+        ) as executor:
+            rows = list(executor.map(b.run_field, [data_path] * n_fields, targets))
+    finally:
+        wall = time.monotonic() - start
+        archive.stop()
+
+    field_times = [row["time"] for row in rows]
+    return {
+        "fields": n_fields,
+        "jobs": jobs,
+        "wall_time": wall,
+        "fields_per_hour": 3600 * n_fields / wall,
+        "field_time_p50": float(np.percentile(field_times, 50)),
+        "field_time_max": max(field_times),
+        "status": dict(Counter(row["status"] for row in rows)),
+        "errors": sorted({row["error"] for row in rows if row["error"]}),
+        "bytes_sent": archive.stats.bytes_sent,
+        "connections": archive.stats.connections,
+        "endpoints": archive.stats.summary(),
+    }
+
+
+def print_report(result):
+    """
+    Print the outcome of a load test
+    Input:
+        result: dictionary returned by run_load
+    """
+    print(
+        f"{result['fields']} fields over {result['jobs']} jobs in "
+        f"{result['wall_time']:.1f} s: {result['fields_per_hour']:.0f} fields/hour"
+    )
+    print(
+        f"Field time: median {result['field_time_p50']:.2f} s, "
+        f"max {result['field_time_max']:.2f} s"
+    )
+    print("Fields: " + ", ".join(f"{n} {s}" for s, n in result["status"].items()))
+    for error in result["errors"]:
+        print(f"  {error}")
+    print(
+        f"{result['bytes_sent'] / 1e6:.1f} MB sent over "
+        f"{result['connections']} connections"
+    )
+    print(f"{'endpoint':<15}{'requests':<40}{'p50':>8}{'p90':>8}{'p99':>8}{'max':>8}")
+    for endpoint, stats in sorted(result["endpoints"].items()):
+        requests = ", ".join(f"{n} {o}" for o, n in sorted(stats["requests"].items()))
+        latencies = "".join(f"{stats[p]:>8.3f}" for p in ["p50", "p90", "p99", "max"])
+        print(f"{endpoint:<15}{requests:<40}{latencies}")
+
+
+@click.command()
+@click.option("--config", "config_path", type=click.Path(exists=True), default=None)
+@click.option("--field", type=click.Choice(list(FIELDS)), default="sparse")
+@click.option("--fields", "n_fields", type=int, default=10)
+@click.option("--jobs", type=int, default=1)
+@click.option("--latency", type=float, default=0.0, help="Seconds per response")
+@click.option("--jitter", type=float, default=0.0, help="Mean extra delay, s")
+@click.option("--error-rate", type=float, default=0.0)
+@click.option("--slow-rate", type=float, default=0.0)
+@click.option("--slow-time", type=float, default=2.0)
+@click.option("--truncate-rate", type=float, default=0.0)
+@click.option("--output", type=click.Path(), default=None, help="JSON report")
+def cli(config_path, field, n_fields, jobs, output, **faults):
+    """
+    Run the load test against a fake NED and Vizier
+    """
+    if config_path is not None:
+        config = load_config(config_path)
+    else:
+        config = c.Setup(
+            radius=c.Angle("30 arcmin"),
+            uncertainty=0.01,
+            banned_catalogs_redshift=[],
+            banned_catalogs_velocity=[],
+        )
+    with tempfile.TemporaryDirectory() as data_path:
+        result = run_load(data_path, config, Faults(**faults), field, n_fields, jobs)
+    print_report(result)
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,149 @@
+"""
+Time and peak memory of each stage of the pipeline, on synthetic NED and Vizier
+responses of increasing size (see fixtures.FIELDS). Nothing is downloaded, so
+the benchmarks run without network access.
+"""
+import tempfile
+import warnings
+from dataclasses import replace
+from io import BytesIO
+
+from astropy.io.votable import parse
+from astropy.utils.exceptions import AstropyWarning
+
+import redshifts.query as q
+import redshifts.duplicates as duplicates
+import redshifts.constants as c
+from redshifts.assembly import assemble
+
+from .fixtures import FIELDS, fixture
+
+RA, DEC = "_RAJ2000", "_DEJ2000"
+TYPES = {"redshift": q.REDSHIFT_KEYS, "velocity": q.VELOCITY_KEYS}
+
+CONFIG = c.Setup(
+    radius=c.Angle("1 deg"),
+    uncertainty=0.01,
+    banned_catalogs_redshift=[],
+    banned_catalogs_velocity=[],
+    use_cache=False,
+)
+
+
+def quiet():
+    # The synthetic responses, like the real ones, raise many VOTable warnings
+    warnings.simplefilter("ignore", AstropyWarning)
+
+
+class Stage:
+    """
+    Common parameters of the benchmarks: one run per field size
+    """
+
+    params = list(FIELDS)
+    param_names = ["field"]
+    timeout = 1800
+
+    def setup_cache(self):
+        # Generate the fixtures once, before any benchmark is timed
+        for field in FIELDS:
+            fixture("Vizier", field)
+            fixture("NED", field)
+
+
+class PrelimSelection(Stage):
+    def setup(self, field):
+        quiet()
+        self.response = fixture("Vizier", field)
+        # Catalog index that has seen every catalog of the response already
+        self.indexed = replace(CONFIG, cache_dir=tempfile.mkdtemp())
+        q.prelim_selections(self.response, TYPES, RA, DEC, self.indexed)
+
+    def time_prelim_selection(self, field):
+        q.prelim_selection(self.response, "redshift", RA, DEC, q.REDSHIFT_KEYS)
+
+    def peakmem_prelim_selection(self, field):
+        q.prelim_selection(self.response, "redshift", RA, DEC, q.REDSHIFT_KEYS)
+
+    def time_prelim_selection_combined(self, field):
+        q.prelim_selections(self.response, TYPES, RA, DEC)
+
+    def time_prelim_selection_indexed(self, field):
+        q.prelim_selections(self.response, TYPES, RA, DEC, self.indexed)
+
+
+class ProcessCatalog(Stage):
+    def setup(self, field):
+        quiet()
+        self.cat_list = q.prelim_selection(
+            fixture("Vizier", field), "redshift", RA, DEC, q.REDSHIFT_KEYS
+        )
+
+    def time_process_catalog(self, field):
+        for cat in self.cat_list:
+            q.process_catalog("redshift", cat, CONFIG, RA, DEC)
+
+    def time_process_vizier(self, field):
+        q.process_vizier(self.cat_list, "redshift", CONFIG, RA, DEC)
+
+    def peakmem_process_vizier(self, field):
+        q.process_vizier(self.cat_list, "redshift", CONFIG, RA, DEC)
+
+
+class FilterNED(Stage):
+    def setup(self, field):
+        quiet()
+        self.cat = (
+            parse(BytesIO(fixture("NED", field)), invalid="mask")
+            .get_first_table()
+            .to_table(use_names_over_ids=True)
+        )
+
+    def time_filter_ned_cat(self, field):
+        q.filter_ned_cat(self.cat, "RA", "DEC")
+
+    def peakmem_filter_ned_cat(self, field):
+        q.filter_ned_cat(self.cat, "RA", "DEC")
+
+
+class RemovePhotoz(Stage):
+    def setup(self, field):
+        quiet()
+        cat_list = q.prelim_selection(
+            fixture("Vizier", field), "redshift", RA, DEC, q.REDSHIFT_KEYS
+        )
+        parts = [
+            q.process_catalog("redshift", cat, CONFIG, RA, DEC) for cat in cat_list
+        ]
+        self.table = assemble([part for part in parts if part is not None])
+
+    def time_remove_potential_photoz(self, field):
+        q.remove_potential_photoz(self.table, "Redshift")
+
+    def peakmem_remove_potential_photoz(self, field):
+        q.remove_potential_photoz(self.table, "Redshift")
+
+
+class Duplicates(Stage):
+    def setup(self, field):
+        quiet()
+        cat_lists = q.prelim_selections(fixture("Vizier", field), TYPES, RA, DEC)
+        results = {
+            type1: q.process_vizier(cat_list, type1, CONFIG, RA, DEC)
+            for type1, cat_list in cat_lists.items()
+        }
+        self.table = q.stack_results(results)
+        self.grouped = self.table.copy()
+        duplicates.identify_duplicates(self.grouped)
+
+    def time_identify_duplicates(self, field):
+        duplicates.identify_duplicates(self.table)
+
+    def peakmem_identify_duplicates(self, field):
+        duplicates.identify_duplicates(self.table)
+
+    def time_find_groups_redshift(self, field):
+        duplicates.find_groups_redshift(self.grouped, None, "Redshift")
+
+    def peakmem_find_groups_redshift(self, field):
+        duplicates.find_groups_redshift(self.grouped, None, "Redshift")
@@ -0,0 +1,129 @@
+from typing import NamedTuple, Optional, Union
+
+import numpy as np
+from astropy.table import Column, MaskedColumn, Table
+
+
+class Part(NamedTuple):
+    """
+    Rows of a catalog that go into the final table, without copying them: the
+    RA, DEC and redshift columns of the catalog, the boolean mask of the rows
+    to keep (None to keep all rows) and the origin of the measurements, either
+    a single name for the whole catalog or a column with a name per row
+    """
+
+    ra: np.ndarray
+    dec: np.ndarray
+    z: np.ndarray
+    keep: Optional[np.ndarray]
+    origin: Union[str, np.ndarray]
+
+    def n_rows(self):
+        """
+        Number of rows kept
+        """
+        return len(self.ra) if self.keep is None else int(np.count_nonzero(self.keep))
+
+
+def table_part(table, RA="RA", DEC="DEC", z="Redshift", origin="Origin"):
+    """
+    Take all rows of a table with the final columns as a part
+    Input:
+        table: table with RA, DEC, redshift and origin columns
+        RA, DEC, z, origin: names of the columns
+    Return:
+        part with all the rows of the table
+    """
+    return Part(table[RA], table[DEC], table[z], None, table[origin])
+
+
+def name_width(origin):
+    """
+    Number of characters needed to store the origin of a part
+    Input:
+        origin: single name or column of names, as str or bytes
+    Return:
+        number of characters
+    """
+    if isinstance(origin, str):
+        return len(origin)
+    dtype = np.asarray(origin).dtype
+    return dtype.itemsize // 4 if dtype.kind == "U" else dtype.itemsize
+
+
+def take(keep, data, out):
+    """
+    Copy the kept rows of an array into a buffer
+    Input:
+        keep: boolean mask of the rows to keep
+        data: array
+        out: buffer with one element per kept row
+    """
+    # Copy in place if the types match, otherwise go through a converted copy
+    if data.dtype == out.dtype:
+        np.compress(keep, data, out=out)
+    else:
+        out[:] = data[keep]
+
+
+def fill(out, mask, parts, sizes, get):
+    """
+    Copy the kept rows of one column of every part into a preallocated buffer
+    Input:
+        out, mask: data and mask buffers of the final column
+        parts: list of parts
+        sizes: number of kept rows of each part
+        get: function returning the column of a part
+    """
+    start = 0
+    for part, size in zip(parts, sizes):
+        stop = start + size
+        col = get(part)
+        if isinstance(col, str):
+            out[start:stop] = col
+        elif part.keep is None:
+            out[start:stop] = np.ma.getdata(col)
+            mask[start:stop] = np.ma.getmaskarray(col)
+        else:
+            take(part.keep, np.ma.getdata(col), out[start:stop])
+            take(part.keep, np.ma.getmaskarray(col), mask[start:stop])
+        start = stop
+
+
+def assemble(parts, RA="RA", DEC="DEC", z="Redshift", origin="Origin"):
+    """
+    Build the final table of redshift measurements from many catalogs at once.
+    The final columns are allocated once, at their final size, and the kept
+    rows of each catalog are copied straight into them, instead of building a
+    table per catalog and stacking the tables.
+    Input:
+        parts: list of parts, see Part
+        RA, DEC, z, origin: names of the final columns
+    Return:
+        table with the RA, DEC, redshift and origin of all kept rows, or None
+        if there are no parts
+    """
+    if not parts:
+        return None
+    sizes = [part.n_rows() for part in parts]
+    n = sum(sizes)
+
+    columns = []
+    for get in [lambda p: p.ra, lambda p: p.dec, lambda p: p.z]:
+        cols = [get(part) for part in parts]
+        out = np.empty(n, dtype=np.result_type(*[col.dtype for col in cols]))
+        mask = np.zeros(n, dtype=bool)
+        fill(out, mask, parts, sizes, get)
+        column = MaskedColumn(out, mask=mask) if mask.any() else Column(out)
+        # Keep the unit and description of the first part, as vstack does
+        column.unit = getattr(cols[0], "unit", None)
+        column.description = getattr(cols[0], "description", None)
+        columns.append(column)
+
+    # The origin column is as wide as the longest name
+    width = max(name_width(part.origin) for part in parts)
+    out = np.empty(n, dtype=f"U{max(width, 1)}")
+    fill(out, np.zeros(n, dtype=bool), parts, sizes, lambda p: p.origin)
+    columns.append(Column(out))
+
+    return Table(columns, names=[RA, DEC, z, origin], copy=False)
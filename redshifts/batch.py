@@ -0,0 +1,215 @@
+import os
+import time
+from dataclasses import replace
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from colorama import Fore
+from astropy.table import Table
+from astropy.io import fits
+from astropy import units as u
+
+import redshifts.query as q
+import redshifts.constants as c
+
+# Configuration shared by all the fields run by a worker process; it is loaded
+# once by the parent and handed to each worker when the pool starts
+_config = None
+
+
+def init_worker(config):
+    """
+    Store the configuration in a worker process of the pool
+    Input:
+        config: configuration
+    """
+    global _config
+    _config = config
+
+
+def coordinate_string(value, unit):
+    """
+    Turn a coordinate from the targets table into a string that Astropy can parse
+    Input:
+        value: coordinate, either a string with units or a number
+        unit: unit of the column, if any; numbers without unit are in degrees
+    Return:
+        coordinate as a string with units, e.g. 150.1 deg
+    """
+    value = str(value).strip()
+    try:
+        float(value)
+    except ValueError:
+        # Already has units, e.g. 10h00m00s or 2 arcmin
+        return value
+    return f"{value} {unit if unit is not None else u.deg}"
+
+
+def read_targets(targets_file):
+    """
+    Read the list of fields to query. The table can be in any format Astropy
+    recognizes from the file extension, e.g. FITS, CSV or ECSV.
+    Input:
+        targets_file: table with name, RA and DEC columns, and an optional
+                      radius column to override the configuration per field.
+                      Coordinates and radii are strings with units (150d,
+                      2 arcmin) or numbers, in the unit of the column or
+                      degrees if the column has no unit
+    Return:
+        list of dictionaries with the name, RA, DEC and radius of each field
+    """
+    table = Table.read(targets_file)
+    targets = []
+    for row in table:
+        radius = None
+        if "radius" in table.colnames and not np.ma.is_masked(row["radius"]):
+            radius = c.Angle(coordinate_string(row["radius"], table["radius"].unit))
+        targets.append(
+            {
+                "name": str(row["name"]).strip(),
+                "RA": coordinate_string(row["RA"], table["RA"].unit),
+                "DEC": coordinate_string(row["DEC"], table["DEC"].unit),
+                "radius": radius,
+            }
+        )
+    return targets
+
+
+def run_field(data_path, target, config=None):
+    """
+    Run the query for a single field of the batch, catching any failure such
+    that the other fields can carry on
+    Input:
+        data_path: location to place the downloaded data
+        target: dictionary with the name, RA, DEC and radius of the field
+        config: configuration; defaults to the one shared with the worker
+    Return:
+        dictionary with the status and counts of the field
+    """
+    config = config if config is not None else _config
+    if target["radius"] is not None:
+        config = replace(config, radius=target["radius"])
+
+    summary = {
+        "name": target["name"],
+        "status": "done",
+        "n_unique": 0,
+        "n_NED": 0,
+        "n_vizier": 0,
+        "time": 0.0,
+        "error": "",
+    }
+    start = time.monotonic()
+    try:
+        table = q.run_query(
+            data_path, target["name"], target["RA"], target["DEC"], config
+        )
+        if table is None:
+            summary["status"] = "empty"
+        else:
+            n_NED = int(np.sum(table["Origin"] == "NED"))
+            summary.update(
+                n_unique=len(table), n_NED=n_NED, n_vizier=len(table) - n_NED
+            )
+    except Exception as e:
+        summary.update(status="failed", error=f"{type(e).__name__}: {e}")
+    summary["time"] = time.monotonic() - start
+    return summary
+
+
+def skipped_field(data_path, target, output_format="fits"):
+    """
+    Summary of a field that was already completed in an earlier run
+    Input:
+        data_path: location of the downloaded data
+        target: dictionary with the name of the field
+        output_format: format of the final table of the field
+    Return:
+        dictionary with the status and number of unique sources of the field
+    """
+    path = q.unique_path(data_path, target["name"], output_format)
+    if output_format == "fits":
+        # Only read the header, not the whole table
+        n_unique = fits.getheader(path, 1)["NAXIS2"]
+    else:
+        n_unique = len(q.read_output(path, output_format))
+    return {
+        "name": target["name"],
+        "status": "skipped",
+        "n_unique": n_unique,
+        "n_NED": -1,
+        "n_vizier": -1,
+        "time": 0.0,
+        "error": "",
+    }
+
+
+def report(row):
+    """
+    Print the outcome of a field as soon as it finishes
+    Input:
+        row: summary of the field
+    Return:
+        the same summary
+    """
+    if row["status"] == "failed":
+        print(Fore.RED + f"Field {row['name']} failed: {row['error']}" + Fore.RESET)
+    else:
+        print(f"Field {row['name']} {row['status']}: {row['n_unique']} redshifts.")
+    return row
+
+
+def run_batch(data_path, targets_file, config, jobs=1, resume=True, summary=None):
+    """
+    Query many fields, spreading them over a pool of worker processes. All
+    workers share the same configuration and the on-disk response cache.
+    Input:
+        data_path: location to place the downloaded data
+        targets_file: table of fields, see read_targets
+        config: configuration
+        jobs: number of fields run in parallel
+        resume: skip the fields for which the final table already exists
+        summary: name of the summary table to write; defaults to
+                 batch_summary.ecsv in data_path
+    Output:
+        table with the status, number of unique sources and run time of each
+        field, also written to the summary file
+    """
+    targets = read_targets(targets_file)
+
+    rows = []
+    todo = []
+    for target in targets:
+        path = q.unique_path(data_path, target["name"], config.output_format)
+        if resume and os.path.exists(path):
+            rows.append(skipped_field(data_path, target, config.output_format))
+        else:
+            todo.append(target)
+    print(f"Running {len(todo)} fields, {len(rows)} already done...")
+
+    if jobs > 1:
+        with ProcessPoolExecutor(
+            max_workers=jobs, initializer=init_worker, initargs=(config,)
+        ) as executor:
+            futures = [executor.submit(run_field, data_path, t) for t in todo]
+            for future in as_completed(futures):
+                rows.append(report(future.result()))
+    else:
+        for target in todo:
+            rows.append(report(run_field(data_path, target, config)))
+
+    # Keep the order of the targets file in the summary
+    order = {target["name"]: i for i, target in enumerate(targets)}
+    rows.sort(key=lambda row: order[row["name"]])
+    table = Table(
+        rows=[list(row.values()) for row in rows],
+        names=["name", "status", "n_unique", "n_NED", "n_vizier", "time", "error"],
+        dtype=[str, str, int, int, int, float, str],
+    )
+    table["time"].unit = u.s
+    table.meta["description"] = "Status of the fields of the batch"
+
+    if summary is None:
+        summary = f"{data_path}/batch_summary.ecsv"
+    table.write(summary, overwrite=True)
+    return table
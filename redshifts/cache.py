@@ -0,0 +1,108 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+
+from redshifts.files import atomic_write
+
+
+class ResponseCache:
+    """
+    On-disk cache of the raw responses of the NED and Vizier region queries.
+    Every response is stored gzip-compressed in its own file, named after a hash
+    of the query parameters. The modification time of a file records when the
+    response was downloaded and is used to expire it after ttl seconds; the
+    access time records when it was last used and is used to remove the least
+    recently used responses once the cache grows beyond max_size bytes.
+    """
+
+    def __init__(self, directory, max_size, ttl):
+        self.directory = os.path.expanduser(directory)
+        self.max_size = max_size
+        self.ttl = ttl
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(**params):
+        """
+        Build the cache key of a query
+        Input:
+            params: all parameters that define the query
+        Return:
+            hex digest identifying the query
+        """
+        query = json.dumps(params, sort_keys=True, default=str)
+        return hashlib.sha256(query.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.vot.gz")
+
+    def get(self, key):
+        """
+        Return the cached response of a query
+        Input:
+            key: cache key of the query
+        Return:
+            raw response in bytes, or None if the query is not in the cache or
+            has expired
+        """
+        path = self.path(key)
+        try:
+            stat = os.stat(path)
+            if time.time() - stat.st_mtime > self.ttl:
+                os.remove(path)
+                return None
+            with gzip.open(path, "rb") as f:
+                data = f.read()
+            # Mark the response as recently used, keeping its download time
+            os.utime(path, (time.time(), stat.st_mtime))
+        except (FileNotFoundError, OSError, EOFError):
+            return None
+        return data
+
+    def put(self, key, data):
+        """
+        Store the response of a query and evict old responses if the cache has
+        grown too large
+        Input:
+            key: cache key of the query
+            data: raw response in bytes
+        """
+        with atomic_write(self.path(key)) as f:
+            with gzip.GzipFile(fileobj=f, mode="wb") as gz:
+                gz.write(data)
+        self.evict()
+
+    def evict(self):
+        """
+        Remove expired responses, then the least recently used ones until the
+        total size of the cache is below max_size
+        """
+        now = time.time()
+        entries = []
+        for entry in os.scandir(self.directory):
+            if not entry.name.endswith(".vot.gz"):
+                continue
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            if now - stat.st_mtime > self.ttl:
+                self.remove(entry.path)
+            else:
+                entries.append((stat.st_atime, stat.st_size, entry.path))
+
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            self.remove(path)
+            total -= size
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,108 @@
+import os
+import re
+import json
+import hashlib
+import threading
+
+from redshifts.files import atomic_write
+
+# The name of a table and its FIELD elements, the only parts of the metadata
+# of a Vizier table that the classification looks at. Other parts, like the
+# number of rows, change from one query to the next.
+TABLE_NAME = re.compile(rb'<TABLE\b[^>]*?\sname="([^"]*)"')
+FIELD = re.compile(rb"<FIELD\b[^>]*/>|<FIELD\b.*?</FIELD>", re.DOTALL)
+
+
+def table_name(metadata):
+    """
+    Name of a Vizier table, e.g. J/ApJ/723/492/table1
+    Input:
+        metadata: TABLE element up to its DATA element, in bytes
+    Return:
+        name of the table, or None if it has none
+    """
+    name = TABLE_NAME.search(bytes(metadata))
+    return name.group(1).decode() if name is not None else None
+
+
+def metadata_fingerprint(metadata):
+    """
+    Fingerprint of the metadata of a Vizier table, which stays the same for
+    every query that returns the same catalog
+    Input:
+        metadata: TABLE element up to its DATA element, in bytes
+    Return:
+        hex digest of the table name and fields
+    """
+    metadata = bytes(metadata)
+    digest = hashlib.sha256()
+    name = TABLE_NAME.search(metadata)
+    digest.update(name.group(1) if name is not None else b"")
+    for field in FIELD.findall(metadata):
+        digest.update(field)
+    return digest.hexdigest()
+
+
+class CatalogIndex:
+    """
+    On-disk index of the classification of Vizier catalogs: which columns to
+    read for each type of search, whether the catalog is banned and which
+    column holds the redshift. Every decision is stored in its own small file,
+    named after a hash of the catalog metadata and of the rules used to make
+    it, so a change of the rules never picks up an old decision. Decisions are
+    also kept in memory, for the other fields run by the same process.
+    """
+
+    def __init__(self, directory):
+        self.directory = os.path.expanduser(directory)
+        self.lock = threading.Lock()
+        self.decisions = {}
+        os.makedirs(self.directory, exist_ok=True)
+
+    @staticmethod
+    def key(fingerprint, rules):
+        """
+        Build the key of a decision
+        Input:
+            fingerprint: metadata fingerprint of the catalog
+            rules: digest of the classification rules
+        Return:
+            hex digest identifying the decision
+        """
+        return hashlib.sha256(f"{fingerprint} {rules}".encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key):
+        """
+        Return a stored decision
+        Input:
+            key: key of the decision
+        Return:
+            decision as a dictionary, or None if the catalog was never
+            classified with these rules
+        """
+        with self.lock:
+            if key in self.decisions:
+                return self.decisions[key]
+        try:
+            with open(self.path(key)) as f:
+                decision = json.load(f)
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        with self.lock:
+            self.decisions[key] = decision
+        return decision
+
+    def put(self, key, decision):
+        """
+        Store a decision
+        Input:
+            key: key of the decision
+            decision: JSON serializable dictionary
+        """
+        with self.lock:
+            self.decisions[key] = decision
+        with atomic_write(self.path(key), "w") as f:
+            json.dump(decision, f)
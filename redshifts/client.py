@@ -0,0 +1,179 @@
+import os
+import sys
+import json
+import socket
+import http.client
+
+import click
+
+from redshifts.files import atomic_write
+
+# TCP port of the service on the local host, see redshifts.service
+DEFAULT_PORT = 8765
+# Size of the pieces in which a table is read from the service
+CHUNK_SIZE = 1 << 20
+
+
+class ServiceError(Exception):
+    """
+    The service could not run a field; the message is the error it returned
+    """
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection over a Unix socket
+    Input:
+        socket_path: location of the socket
+        timeout: optional timeout in seconds
+    """
+
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def connect(port=DEFAULT_PORT, socket_path=None, timeout=None):
+    """
+    Input:
+        port: TCP port of the service on the local host
+        socket_path: location of the Unix socket of the service, used instead
+                     of the port if given
+        timeout: optional timeout in seconds; fields can take long to run, so
+                 there is none by default
+    Return:
+        connection to the service
+    """
+    if socket_path is not None:
+        return UnixHTTPConnection(os.path.expanduser(socket_path), timeout)
+    return http.client.HTTPConnection("127.0.0.1", port, timeout=timeout)
+
+
+def error_message(response):
+    body = response.read()
+    try:
+        return json.loads(body)["error"]
+    except (ValueError, KeyError, TypeError):
+        return f"{response.status} {response.reason}"
+
+
+def submit(request, output=None, port=DEFAULT_PORT, socket_path=None, timeout=None):
+    """
+    Run a field on the service and save its final table
+    Input:
+        request: dictionary with the name, RA and DEC of the field and
+                 optionally a radius and a dictionary of settings under
+                 "config", see redshifts.service.Service.run
+        output: location to save the table; by default the name of the final
+                table of the field in the current directory
+        port, socket_path, timeout: see connect
+    Return:
+        location of the table and its number of rows, or None and 0 if no
+        redshifts were found
+    """
+    connection = connect(port, socket_path, timeout)
+    try:
+        connection.request(
+            "POST",
+            "/fields",
+            body=json.dumps(request),
+            headers={"Content-Type": "application/json"},
+        )
+        response = connection.getresponse()
+        if response.status == 204:
+            response.read()
+            return None, 0
+        if response.status != 200:
+            raise ServiceError(error_message(response))
+        if output is None:
+            extension = response.getheader("X-Redshifts-Format", "fits")
+            output = f"{request['name']}_online_redshift_ident_unique.{extension}"
+
+        # Write the table as it arrives, and move it into place once complete
+        with atomic_write(output) as f:
+            for chunk in iter(lambda: response.read(CHUNK_SIZE), b""):
+                f.write(chunk)
+        return output, int(response.getheader("X-Redshifts-Rows", 0))
+    finally:
+        connection.close()
+
+
+def status(port=DEFAULT_PORT, socket_path=None, timeout=None):
+    """
+    Input:
+        port, socket_path, timeout: see connect
+    Return:
+        state of the service, see redshifts.service.Service.status
+    """
+    connection = connect(port, socket_path, timeout)
+    try:
+        connection.request("GET", "/status")
+        response = connection.getresponse()
+        if response.status != 200:
+            raise ServiceError(error_message(response))
+        return json.loads(response.read())
+    finally:
+        connection.close()
+
+
+def parse_setting(setting):
+    """
+    Input:
+        setting: override of a setting as KEY=VALUE, where VALUE is read as
+                 JSON if possible (numbers, true/false, lists) and else kept as
+                 a string (e.g. 2 arcmin)
+    Return:
+        key and value
+    """
+    key, sep, value = setting.partition("=")
+    if not sep or not key.strip():
+        raise click.BadParameter(f"expected KEY=VALUE, got {setting!r}")
+    try:
+        return key.strip(), json.loads(value)
+    except ValueError:
+        return key.strip(), value
+
+
+@click.command()
+@click.option("--name", default="target", help="Target name.")
+@click.option(
+    "--RA", default=None, help="Right ascension, with units: e.g. 150d, 150deg, 12h"
+)
+@click.option("--DEC", default=None, help="Declination, with units: e.g. 30d, 30deg")
+@click.option("--radius", default=None, help="Radius of the field, with units.")
+@click.option(
+    "--set",
+    "settings",
+    multiple=True,
+    help="Override a search setting for this field, e.g. uncertainty=0.001.",
+)
+@click.option("--output", default=None, help="Where to save the final table.")
+@click.option("--port", default=DEFAULT_PORT, help="Port of the service.")
+@click.option("--socket", "socket_path", default=None, help="Socket of the service.")
+@click.option("--status", "show_status", is_flag=True, help="Show the service state.")
+def main(name, ra, dec, radius, settings, output, port, socket_path, show_status):
+    try:
+        if show_status:
+            click.echo(json.dumps(status(port, socket_path), indent=2))
+            return
+        if ra is None or dec is None:
+            raise click.UsageError("--RA and --DEC are required")
+        request = {"name": name, "RA": ra, "DEC": dec, "radius": radius}
+        request["config"] = dict(parse_setting(setting) for setting in settings)
+        path, rows = submit(request, output, port, socket_path)
+    except (ServiceError, OSError) as e:
+        click.echo(f"Error: {e}", err=True)
+        sys.exit(1)
+    if path is None:
+        click.echo(f"No redshifts found for {name}")
+    else:
+        click.echo(f"{rows} redshifts of {name} saved to {path}")
+
+
+if __name__ == "__main__":
+    main()
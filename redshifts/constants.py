@@ -1,10 +1,18 @@
 import yaml
 from dataclasses import replace, asdict, is_dataclass, field
-from typing import List
+from typing import List, Literal, Optional
 
 from pydantic.dataclasses import dataclass
 from astropy import units as u
 
+from redshifts.rules import (
+    BANNED_KEYWORDS,
+    HARD_SELECTION,
+    NED_FLAGS,
+    NED_TYPES,
+    Rules,
+)
+
 
 class Quantity(u.SpecificTypeQuantity):
     """
@@ -25,12 +33,119 @@ class Angle(Quantity):
     _equivalent_unit = u.degree
 
 
+class Duration(Quantity):
+    _equivalent_unit = u.second
+
+
+class DataSize(Quantity):
+    _equivalent_unit = u.byte
+
+
 @dataclass
 class Setup:
     radius: Angle
     uncertainty: float
     banned_catalogs_redshift: List[str]
     banned_catalogs_velocity: List[str]
+    # Words in a column description that disqualify the column, and words that
+    # mark the preferred column of a catalog with several redshift columns
+    banned_keywords: List[str] = field(default_factory=lambda: list(BANNED_KEYWORDS))
+    hard_selection: List[str] = field(default_factory=lambda: list(HARD_SELECTION))
+    # NED object types and redshift flags whose sources are left out
+    ned_types: List[str] = field(default_factory=lambda: list(NED_TYPES))
+    ned_flags: List[str] = field(default_factory=lambda: list(NED_FLAGS))
+    # Query NED and the two Vizier searches in parallel rather than one by one
+    concurrent_queries: bool = True
+    # Fetch the catalogs of the two Vizier searches with a single query and
+    # split them locally into redshifts and velocities
+    combined_vizier: bool = True
+    # Fetch a single row of every Vizier catalog in the region first, to read
+    # its metadata, and then only the coordinates and redshift columns of the
+    # catalogs that are kept, with vizier_workers queries in parallel
+    prune_vizier: bool = False
+    vizier_workers: int = 4
+    # Maximum time to wait for each source (NED, Vizier redshift, Vizier
+    # velocity) when querying concurrently
+    source_deadline: Duration = field(default_factory=lambda: Duration("100 min"))
+    # Number of parallel requests used to check the redshift type of each NED
+    # source and maximum number of such requests started per second
+    ned_workers: int = 8
+    ned_rate: float = 5.0
+    # Number of retries of a failed NED request and the time to wait before the
+    # first retry; the waiting time doubles with every retry
+    ned_retries: int = 3
+    ned_backoff: Duration = field(default_factory=lambda: Duration("2 s"))
+    # Keep the smallest published redshift uncertainty of every NED object
+    # checked, in the cache directory, and check an object again only once its
+    # verdict is older than ned_verdict_ttl
+    ned_verdicts: bool = True
+    ned_verdict_ttl: Duration = field(default_factory=lambda: Duration("90 day"))
+    # Connections kept open to each archive and shared by all the requests of a
+    # process; at least the number of requests running at once
+    http_pool_size: int = 16
+    # Maximum time to open a connection to an archive, and to wait for data
+    # from it during a region query and during a NED object lookup
+    connect_timeout: Duration = field(default_factory=lambda: Duration("10 s"))
+    read_timeout: Duration = field(default_factory=lambda: Duration("100 min"))
+    lookup_timeout: Duration = field(default_factory=lambda: Duration("1 min"))
+    # On-disk cache of the NED and Vizier region query responses: location,
+    # maximum size and time after which a response is downloaded again
+    use_cache: bool = True
+    cache_dir: str = "~/.cache/redshifts"
+    cache_size: DataSize = field(default_factory=lambda: DataSize("2 GB"))
+    cache_ttl: Duration = field(default_factory=lambda: Duration("30 day"))
+    # Keep the classification of every Vizier catalog seen (columns to read,
+    # banned or not, redshift column) in the cache directory, such that the
+    # metadata of a known catalog is not analysed again
+    catalog_index: bool = True
+    # Keep the measurements of every search, and the part of the sky searched
+    # by each source as HEALPix cells of order store_order, in a master store
+    # per configuration; later searches are only run over the cells that are
+    # not covered yet
+    master_store: bool = False
+    store_dir: str = "~/.cache/redshifts/store"
+    store_order: int = 10
+    # Ignore cached responses, download them again and update the cache
+    refresh_cache: bool = False
+    # Skip the stages of a field (query, stacking, removal of duplicates) whose
+    # inputs did not change since the last run, see the field manifest
+    reuse_stages: bool = True
+    # Write the tables passed between the stages (the results of each source,
+    # the stacked table and the table with duplicates identified) to disk
+    keep_intermediates: bool = False
+    # Format of the final table of unique redshifts
+    output_format: Literal["fits", "ecsv", "parquet", "hdf5"] = "fits"
+    # File to which the time spent in each stage of a field and the counts of
+    # downloaded bytes, catalogs and rows are appended, one JSON line per field
+    metrics_file: Optional[str] = None
+    # Profile the stages of each field with cProfile, writing the statistics to
+    # the profiles directory of the field
+    profile_stages: bool = False
+    # Split searches with a radius larger than tile_size into HEALPix cells of
+    # about that size, queried by tile_workers threads in parallel
+    tile_size: Optional[Angle] = None
+    tile_workers: int = 4
+    # Remove the duplicates cell by cell, in HEALPix cells of about
+    # dedupe_cell_size resolved by dedupe_workers threads in parallel, instead
+    # of for the whole stacked table at once, such that the memory used does
+    # not grow with the size of the field
+    dedupe_cell_size: Optional[Angle] = None
+    dedupe_workers: int = 4
+    # Keep an index of the duplicate groups of each field, such that running a
+    # field again only matches the measurements that were added or removed;
+    # takes precedence over dedupe_cell_size
+    incremental_dedupe: bool = False
+
+    def __post_init_post_parse__(self):
+        # Compile the selection rules once, when the configuration is built
+        self.rules = Rules(
+            self.banned_catalogs_redshift,
+            self.banned_catalogs_velocity,
+            self.banned_keywords,
+            self.hard_selection,
+            self.ned_types,
+            self.ned_flags,
+        )
 
 
 def read_config(config_file) -> Setup:
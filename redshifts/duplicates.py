@@ -0,0 +1,190 @@
+import numpy as np
+from scipy.spatial import cKDTree
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from astropy.table import MaskedColumn, Table
+
+
+def radec2xyz(ra, dec):
+    """
+    Convert sky coordinates to unit vectors
+    Input:
+        ra, dec: arrays of coordinates in degrees
+    Return:
+        array of shape (N, 3) with the cartesian unit vectors
+    """
+    ra = np.radians(np.asarray(ra, dtype=float))
+    dec = np.radians(np.asarray(dec, dtype=float))
+    cos_dec = np.cos(dec)
+    return np.column_stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)])
+
+
+def group_labels(ra, dec, dist=1):
+    """
+    Link the sources closer than dist together, and find the groups formed by
+    the linked sources. The pairs are found with a KD-tree on the unit vectors
+    of the source positions.
+    Input:
+        ra, dec: arrays of coordinates in degrees
+        dist: distance in arcsec to be used for the crossmatch
+    Return:
+        array with the label of the group of each source, and array with the
+        size of the group of each source
+    """
+    n = len(ra)
+    if n == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # Chord length between two unit vectors separated by dist on the sky
+    chord = 2 * np.sin(np.radians(dist / 3600.0) / 2)
+    pairs = cKDTree(radec2xyz(ra, dec)).query_pairs(chord, output_type="ndarray")
+    # Link pairs into groups of sources
+    graph = coo_matrix(
+        (np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])),
+        shape=(n, n),
+    )
+    _, labels = connected_components(graph, directed=False)
+    return labels, np.bincount(labels)[labels]
+
+
+def identify_duplicates(table, RA="RA", DEC="DEC", dist=1):
+    """
+    Within a single table, identify whether there are any sources with multiple
+    redshift measurements. Sources closer than dist are linked together and
+    linked sources form groups, in the same way as the STILTS tmatch1
+    action=identify crossmatch, see group_labels.
+    Input: 
+        table: table containing all the info on the targets. Must contain RA
+               and DEC in degrees
+        RA, DEC: names of the RA and DEC column
+        dist: distance in arcsec to be used for the crossmatch
+    Output:
+        return True if duplicates were found, False if no duplicates were found
+        The table gets 2 extra columns: GroupID, which identifies the group a
+        source belongs to, and GroupSize, which says how many duplicates exist
+        in the group (this will usually be 2, from 1 source with 2
+        measurements). Both are masked for sources without duplicates.
+    """
+    labels = np.arange(len(table))
+    if len(table) > 1:
+        labels, _ = group_labels(table[RA], table[DEC], dist)
+    return add_group_columns(table, labels)
+
+
+def add_group_columns(table, labels):
+    """
+    Add the GroupID and GroupSize columns of identify_duplicates to a table
+    Input:
+        table: table of measurements
+        labels: label of the group of every row
+    Return:
+        True if any group has more than one row
+    """
+    n = len(table)
+    group_id = np.zeros(n, dtype=np.int32)
+    group_size = np.zeros(n, dtype=np.int32)
+
+    # Number the groups from 1, in order of first appearance in the table
+    _, first, inverse, counts = np.unique(
+        labels, return_index=True, return_inverse=True, return_counts=True
+    )
+    multiple = counts > 1
+    number = np.zeros(len(counts), dtype=np.int64)
+    number[multiple] = np.argsort(np.argsort(first[multiple])) + 1
+    grouped = multiple[inverse]
+    group_id[grouped] = number[inverse][grouped]
+    group_size[grouped] = counts[inverse][grouped]
+
+    table["GroupID"] = MaskedColumn(group_id, mask=~grouped)
+    table["GroupSize"] = MaskedColumn(group_size, mask=~grouped)
+    return bool(grouped.any())
+
+
+def significant_digits(z):
+    """
+    Length of the fixed-point representation of each redshift, without
+    trailing zeros, i.e. len(format(z, "f").rstrip("0")) computed on the whole
+    array at once. This is used as a proxy for the precision of the redshift
+    measurement.
+    Input:
+        z: array of redshifts
+    Return:
+        integer array with the length of each redshift
+    """
+    z = np.asarray(z, dtype=np.float64)
+    # Six decimals, as in the "f" format
+    scaled = np.rint(np.abs(z) * 1e6).astype(np.int64)
+    integer, decimals = np.divmod(scaled, 10 ** 6)
+
+    # Digits of the integer part, at least one for "0."
+    n_integer = np.ones(len(z), dtype=np.int64)
+    nonzero = integer > 0
+    n_integer[nonzero] = np.floor(np.log10(integer[nonzero])).astype(np.int64) + 1
+
+    # Decimals left after stripping the trailing zeros
+    n_decimals = np.where(decimals > 0, 6, 0)
+    for _ in range(5):
+        strip = (decimals > 0) & (decimals % 10 == 0)
+        n_decimals[strip] -= 1
+        decimals[strip] //= 10
+
+    return np.signbit(z).astype(np.int64) + n_integer + 1 + n_decimals
+
+
+def best_of_groups(ids, z, rows):
+    """
+    Find the measurement with the most precision in each group of duplicates;
+    measurements are sorted by group and precision, such that the best one of
+    each group is found in a single pass. The length of the redshift is used as
+    a proxy for the precision of the measurement.
+    Input:
+        ids: group of each measurement
+        z: redshift of each measurement
+        rows: row number of each measurement; of measurements with the same
+              precision, the first row is kept
+    Return:
+        boolean array which is True for the best measurement of each group
+    """
+    significance = significant_digits(z)
+
+    # Sort by group, then by decreasing precision and then by row number, such
+    # that the first row of each group is the one with the most precision
+    order = np.lexsort((rows, -significance, ids))
+    sorted_ids = ids[order]
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = sorted_ids[1:] != sorted_ids[:-1]
+
+    best = np.zeros(len(ids), dtype=bool)
+    best[order[first]] = True
+    return best
+
+
+def find_groups_redshift(file1, outfile, z):
+    """
+    Search through the GroupID column of the fits table and find the groups of
+    duplicates. The GroupID identifies pairs/triplets/groups of same sources
+    which have multiple redshift estimations. From each group, keep only the
+    measurement with the most precision, see best_of_groups.
+    Input:
+        file1: master table, or fits file, with all the redshift for a cluster.
+               May contain duplicates from sources with multiple redshift
+               measurements
+        outfile: name of the fits file to write, or None to skip writing
+        z: name of the redshift column
+    Output:
+        table with unique sources, also written to outfile
+    """
+    table = file1 if isinstance(file1, Table) else Table.read(file1, hdu=1)
+
+    # Negative or masked ids act as fillers for unique sources with no matches
+    ids = np.ma.getdata(table["GroupID"])
+    grouped = np.flatnonzero(~np.ma.getmaskarray(table["GroupID"]) & (ids >= 0))
+
+    # Keep all the sources without duplicates and the best of each group
+    keep = np.ones(len(table), dtype=bool)
+    keep[grouped] = best_of_groups(ids[grouped], table[z][grouped], grouped)
+    table = table[keep]
+
+    # Write out a new fits file containing only unique sources
+    if outfile is not None:
+        table.write(outfile, format="fits", overwrite=True)
+    return table
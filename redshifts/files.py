@@ -0,0 +1,26 @@
+import os
+import tempfile
+from contextlib import contextmanager
+
+
+@contextmanager
+def atomic_write(path, mode="wb"):
+    """
+    Write a file through a temporary file in the same directory, moved into
+    place once it is complete, such that concurrent readers never see a
+    partially written file and an interrupted write never leaves one behind
+    Input:
+        path: location of the file
+        mode: mode in which to open the file, "wb" or "w"
+    Output:
+        yields the open temporary file
+    """
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
@@ -0,0 +1,334 @@
+import json
+import pickle
+import hashlib
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import redshifts.duplicates as duplicates
+from redshifts.metrics import Metrics
+from redshifts.files import atomic_write
+from redshifts.rules import as_text
+
+# Constants of the splitmix64 hash, used to give every measurement a key
+GOLDEN = np.uint64(0x9E3779B97F4A7C15)
+MIX1 = np.uint64(0xBF58476D1CE4E5B9)
+MIX2 = np.uint64(0x94D049BB133111EB)
+
+
+def mix(h):
+    """
+    Scramble 64-bit integers with the finalizer of splitmix64
+    Input:
+        h: array of unsigned 64-bit integers
+    Return:
+        array of scrambled integers
+    """
+    with np.errstate(over="ignore"):
+        h = h + GOLDEN
+        h = (h ^ (h >> np.uint64(30))) * MIX1
+        h = (h ^ (h >> np.uint64(27))) * MIX2
+    return h ^ (h >> np.uint64(31))
+
+
+def name_key(name):
+    """
+    Input:
+        name: origin of a measurement
+    Return:
+        64-bit hash of the name
+    """
+    digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+def row_keys(table, RA="RA", DEC="DEC", z="Redshift", origin="Origin"):
+    """
+    Key of every measurement of a stacked table, such that the measurements of
+    two versions of a field can be matched without comparing whole rows. The
+    key is a hash of the position, redshift and origin of the measurement and
+    of the number of identical measurements before it, such that every copy
+    of a repeated measurement has its own key.
+    Input:
+        table: stacked table
+        RA, DEC, z, origin: names of the columns
+    Return:
+        array of unsigned 64-bit keys
+    """
+    n = len(table)
+    h = np.zeros(n, dtype=np.uint64)
+    for column in [table[RA], table[DEC], table[z]]:
+        values = np.ascontiguousarray(np.ma.getdata(column), dtype=np.float64)
+        h = mix(h ^ values.view(np.uint64))
+    h = mix(h ^ np.ma.getmaskarray(table[z]).astype(np.uint64))
+    names, inverse = np.unique(as_text(table[origin]), return_inverse=True)
+    name_keys = np.array([name_key(name) for name in names], dtype=np.uint64)
+    h = mix(h ^ name_keys[inverse])
+
+    # Number the identical measurements in the order of the table
+    order = np.argsort(h, kind="stable")
+    start = np.ones(n, dtype=bool)
+    start[1:] = h[order][1:] != h[order][:-1]
+    run_start = np.maximum.accumulate(np.where(start, np.arange(n), 0))
+    copy = np.empty(n, dtype=np.uint64)
+    copy[order] = np.arange(n) - run_start
+    return mix(h ^ copy)
+
+
+def keys_digest(keys):
+    """
+    Input:
+        keys: array of measurement keys
+    Return:
+        hash of all the keys, in hexadecimal
+    """
+    return hashlib.blake2b(np.ascontiguousarray(keys).tobytes()).hexdigest()
+
+
+class GroupIndex:
+    """
+    Persistent record of the duplicate groups of a field, such that the groups
+    of a new version of the field (e.g. after a refresh brought a new catalog)
+    are found by matching only the new measurements. For every measurement it
+    keeps its key (see row_keys), position, group label and whether it is the
+    best measurement of its group. Positions are indexed by a KD-tree over
+    the measurements known when the tree was built, and the measurements added
+    since are searched in a small tree of their own; the tree is rebuilt once
+    these make up a quarter of the index. Removed measurements stay in the
+    index, marked as removed, until the tree is rebuilt.
+    Input:
+        keys, ra, dec, labels, best, alive: arrays with the key, position,
+            group label, best flag and whether the measurement is still in the
+            field, for every measurement
+        n_base: number of measurements in the tree
+        tree: KD-tree of the unit vectors of the first n_base measurements
+        inputs: settings and code the groups depend on
+    """
+
+    def __init__(self, keys, ra, dec, labels, best, alive, n_base, tree, inputs):
+        self.keys = keys
+        self.ra = ra
+        self.dec = dec
+        self.labels = labels
+        self.best = best
+        self.alive = alive
+        self.n_base = n_base
+        self.tree = tree
+        self.inputs = inputs
+        # Index entry of every row of the last table seen
+        self.rows = np.flatnonzero(alive)
+        # Whether the tree changed since the index was read
+        self.new_tree = False
+
+    @classmethod
+    def build(cls, table, z, inputs, dist=1, RA="RA", DEC="DEC"):
+        """
+        Find the duplicate groups of a whole table
+        Input:
+            table: stacked table
+            z: name of the redshift column
+            inputs: settings and code the groups depend on
+            dist: match radius in arcsec
+            RA, DEC: names of the position columns
+        Return:
+            GroupIndex of the table
+        """
+        ra = np.asarray(table[RA], dtype=np.float64)
+        dec = np.asarray(table[DEC], dtype=np.float64)
+        labels, _ = duplicates.group_labels(ra, dec, dist)
+        rows = np.arange(len(table))
+        best = duplicates.best_of_groups(labels, table[z], rows)
+        tree = cKDTree(duplicates.radec2xyz(ra, dec))
+        alive = np.ones(len(table), dtype=bool)
+        index = cls(
+            row_keys(table), ra, dec, labels, best, alive, len(table), tree, inputs
+        )
+        index.new_tree = True
+        return index
+
+    @classmethod
+    def load(cls, path, inputs):
+        """
+        Read the index of a field
+        Input:
+            path: location of the index, without extension
+            inputs: settings and code the groups depend on
+        Return:
+            GroupIndex, or None if there is none or it was built with other
+            inputs
+        """
+        try:
+            with np.load(f"{path}.npz") as arrays:
+                if json.loads(str(arrays["inputs"])) != inputs:
+                    return None
+                fields = {
+                    name: arrays[name]
+                    for name in ["keys", "ra", "dec", "labels", "best", "alive"]
+                }
+                n_base = int(arrays["n_base"])
+            with open(f"{path}.tree", "rb") as f:
+                tree, tree_keys = pickle.load(f)
+        except (FileNotFoundError, OSError, ValueError, KeyError, pickle.PickleError):
+            return None
+        # The tree must have been built over the first n_base measurements
+        if tree_keys != keys_digest(fields["keys"][:n_base]):
+            return None
+        return cls(n_base=n_base, tree=tree, inputs=inputs, **fields)
+
+    def save(self, path):
+        """
+        Write the index of a field, next to its tables
+        Input:
+            path: location of the index, without extension
+        """
+        # The tree is only written when it was rebuilt, together with the keys
+        # it was built over
+        if self.new_tree:
+            with atomic_write(f"{path}.tree") as f:
+                tree_keys = keys_digest(self.keys[: self.n_base])
+                pickle.dump((self.tree, tree_keys), f, pickle.HIGHEST_PROTOCOL)
+            self.new_tree = False
+        with atomic_write(f"{path}.npz") as f:
+            np.savez(
+                f,
+                keys=self.keys,
+                ra=self.ra,
+                dec=self.dec,
+                labels=self.labels,
+                best=self.best,
+                alive=self.alive,
+                n_base=self.n_base,
+                inputs=json.dumps(self.inputs, sort_keys=True),
+            )
+
+    def neighbours(self, entries, dist):
+        """
+        Index entries within the match radius of some entries
+        Input:
+            entries: index entries to search around
+            dist: match radius in arcsec
+        Return:
+            array of index entries, including the entries themselves
+        """
+        chord = 2 * np.sin(np.radians(dist / 3600.0) / 2)
+        points = duplicates.radec2xyz(self.ra[entries], self.dec[entries])
+        found = [np.asarray(entries)]
+        if self.n_base > 0:
+            found += [
+                np.asarray(f, dtype=np.int64)
+                for f in self.tree.query_ball_point(points, chord)
+            ]
+        delta = np.arange(self.n_base, len(self.keys))
+        if len(delta) > 0:
+            tree = cKDTree(duplicates.radec2xyz(self.ra[delta], self.dec[delta]))
+            found += [delta[f] for f in tree.query_ball_point(points, chord)]
+        return np.unique(np.concatenate(found).astype(np.int64))
+
+    def update(self, table, z, dist=1, RA="RA", DEC="DEC", metrics=None):
+        """
+        Find the duplicate groups of a new version of the field. Only the groups
+        that lose a measurement or gain one within the match radius of their
+        measurements are formed again, and only for those the best measurement
+        is chosen again; measurements with the same precision keep the choice
+        made before.
+        Input:
+            table: new stacked table of the field
+            z: name of the redshift column
+            dist: match radius in arcsec
+            RA, DEC: names of the position columns
+            metrics: optional Metrics of the field
+        Return:
+            boolean array which is True for the rows of the table to keep
+        """
+        metrics = metrics if metrics is not None else Metrics()
+        keys = row_keys(table, RA=RA, DEC=DEC, z=z)
+
+        # Match the rows to the measurements already in the index
+        known = np.flatnonzero(self.alive)
+        order = np.argsort(self.keys[known])
+        sorted_keys = self.keys[known][order]
+        # Look the keys up in sorted order, which is much faster than in the
+        # random order of the table
+        key_order = np.argsort(keys)
+        position = np.empty(len(keys), dtype=np.int64)
+        position[key_order] = np.searchsorted(sorted_keys, keys[key_order])
+        position = np.minimum(position, len(known) - 1)
+        found = np.zeros(len(keys), dtype=bool)
+        if len(known) > 0:
+            found = sorted_keys[position] == keys
+        rows = np.full(len(keys), -1, dtype=np.int64)
+        rows[found] = known[order[position[found]]]
+        matched = np.zeros(len(self.keys), dtype=bool)
+        matched[rows[found]] = True
+        removed = np.flatnonzero(self.alive & ~matched)
+        added = np.flatnonzero(~found)
+        metrics.count("dedupe.rows_added", len(added))
+        metrics.count("dedupe.rows_removed", len(removed))
+
+        # Add the new measurements, each in a group of its own for now, and
+        # mark the missing ones as removed
+        start = len(self.keys)
+        new = np.arange(start, start + len(added))
+        label = self.labels.max() + 1 if len(self.labels) > 0 else 0
+        self.keys = np.concatenate([self.keys, keys[added]])
+        self.ra = np.concatenate([self.ra, np.asarray(table[RA], np.float64)[added]])
+        self.dec = np.concatenate([self.dec, np.asarray(table[DEC], np.float64)[added]])
+        self.labels = np.concatenate([self.labels, label + np.arange(len(added))])
+        self.best = np.concatenate([self.best, np.zeros(len(added), dtype=bool)])
+        self.alive = np.concatenate([self.alive, np.ones(len(added), dtype=bool)])
+        self.alive[removed] = False
+        rows[added] = new
+
+        # Form the affected groups again: those that lost a measurement and
+        # those with a measurement near a new one
+        touched = [self.labels[removed]]
+        if len(new) > 0:
+            touched.append(self.labels[self.neighbours(new, dist)])
+        touched = np.unique(np.concatenate(touched))
+        members = np.flatnonzero(self.alive & np.isin(self.labels, touched))
+        metrics.count("dedupe.rows_regrouped", len(members))
+        if len(members) > 0:
+            labels, _ = duplicates.group_labels(
+                self.ra[members], self.dec[members], dist
+            )
+            self.labels[members] = self.labels.max() + 1 + labels
+            row_of = np.full(len(self.keys), -1, dtype=np.int64)
+            row_of[rows] = np.arange(len(rows))
+            self.best[members] = duplicates.best_of_groups(
+                self.labels[members],
+                np.ma.getdata(table[z])[row_of[members]],
+                row_of[members],
+            )
+        self.rows = rows
+
+        # Rebuild the tree once the measurements outside it, or removed from
+        # it, make up a quarter of the index
+        stale = len(self.keys) - self.n_base + np.count_nonzero(~self.alive)
+        if stale > len(self.keys) // 4:
+            self.compact()
+        return self.best[self.rows]
+
+    def compact(self):
+        """
+        Drop the removed measurements and rebuild the tree over all the others
+        """
+        entries = np.flatnonzero(self.alive)
+        new_entry = np.full(len(self.keys), -1, dtype=np.int64)
+        new_entry[entries] = np.arange(len(entries))
+        for name in ["keys", "ra", "dec", "labels", "best", "alive"]:
+            setattr(self, name, getattr(self, name)[entries])
+        self.rows = new_entry[self.rows]
+        self.n_base = len(entries)
+        self.tree = cKDTree(duplicates.radec2xyz(self.ra, self.dec))
+        self.new_tree = True
+
+    def add_group_columns(self, table):
+        """
+        Add the GroupID and GroupSize columns of
+        duplicates.identify_duplicates to the last table seen
+        Input:
+            table: last table given to build or update
+        Return:
+            True if any group has more than one row
+        """
+        return duplicates.add_group_columns(table, self.labels[self.rows])
@@ -1,19 +1,109 @@
 import os
 import warnings
+from dataclasses import replace
 
 warnings.filterwarnings("ignore")
 import click
 
 import redshifts.query as q
 import redshifts.constants as c
+import redshifts.batch as b
+import redshifts.service as s
 
 
-def redshifts(path, name, RA, DEC, config_path):
-    # Read in configuration
+def load_config(
+    config_path,
+    no_cache=False,
+    refresh=False,
+    keep_intermediates=False,
+    fmt=None,
+    metrics=None,
+    profile=False,
+):
+    # Read in configuration and apply the command line overrides
     config = c.read_config(config_path)
+    if no_cache:
+        config = replace(
+            config, use_cache=False, ned_verdicts=False, master_store=False
+        )
+    if refresh:
+        config = replace(config, refresh_cache=True)
+    if keep_intermediates:
+        config = replace(config, keep_intermediates=True)
+    if fmt is not None:
+        config = replace(config, output_format=fmt)
+    if metrics is not None:
+        config = replace(config, metrics_file=metrics)
+    if profile:
+        config = replace(config, profile_stages=True)
+    return config
+
+
+def redshifts(
+    path,
+    name,
+    RA,
+    DEC,
+    config_path,
+    no_cache=False,
+    refresh=False,
+    keep_intermediates=False,
+    fmt=None,
+    metrics=None,
+    profile=False,
+):
+    # Read in configuration
+    config = load_config(
+        config_path, no_cache, refresh, keep_intermediates, fmt, metrics, profile
+    )
+
+    # Run the query; the table of unique redshifts is kept in memory and
+    # returned, next to being written out
+    return q.run_query(path, name, RA, DEC, config)
+
+
+def redshifts_batch(
+    path,
+    targets,
+    config_path,
+    jobs=1,
+    resume=True,
+    no_cache=False,
+    refresh=False,
+    keep_intermediates=False,
+    fmt=None,
+    metrics=None,
+    profile=False,
+):
+    # Read in configuration once, to be shared by all the fields
+    config = load_config(
+        config_path, no_cache, refresh, keep_intermediates, fmt, metrics, profile
+    )
+
+    # Run all the fields in the targets table
+    return b.run_batch(path, targets, config, jobs=jobs, resume=resume)
 
-    # Run the query
-    q.run_query(path, name, RA, DEC, config)
+
+def redshifts_service(
+    path,
+    config_path,
+    port=s.DEFAULT_PORT,
+    socket_path=None,
+    jobs=1,
+    no_cache=False,
+    refresh=False,
+    keep_intermediates=False,
+    fmt=None,
+    metrics=None,
+    profile=False,
+):
+    # Read in configuration once, to be shared by all the requests
+    config = load_config(
+        config_path, no_cache, refresh, keep_intermediates, fmt, metrics, profile
+    )
+
+    # Serve the fields requested by clients until interrupted
+    s.serve(path, config, port=port, socket_path=socket_path, jobs=jobs)
 
 
 @click.command()
@@ -26,9 +116,119 @@ def redshifts(path, name, RA, DEC, config_path):
     "--RA", default="", help="Right ascension, with units: e.g. 150d, 150deg, 12h"
 )
 @click.option("--DEC", default="", help="Declination, with units: e.g. 30d, 30deg")
-def main(path, config, name, ra, dec):
+@click.option(
+    "--no-cache",
+    is_flag=True,
+    help="Do not use the query response cache, the NED verdicts and the store.",
+)
+@click.option(
+    "--refresh", is_flag=True, help="Download the queries again and update the cache."
+)
+@click.option(
+    "--targets",
+    default=None,
+    help="Table (FITS/CSV/ECSV) of fields with name, RA, DEC and optional radius.",
+)
+@click.option("--jobs", default=1, help="Number of fields to run in parallel.")
+@click.option(
+    "--serve",
+    is_flag=True,
+    help="Keep running and serve the fields requested with redshifts-client.",
+)
+@click.option("--port", default=s.DEFAULT_PORT, help="Local port of the service.")
+@click.option(
+    "--socket", "socket_path", default=None, help="Serve on this Unix socket instead."
+)
+@click.option(
+    "--resume/--no-resume",
+    default=True,
+    help="Skip fields of the targets table that were already completed.",
+)
+@click.option(
+    "--keep-intermediates",
+    is_flag=True,
+    help="Also write the tables passed between the stages to disk.",
+)
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(list(q.OUTPUT_FORMATS)),
+    default=None,
+    help="Format of the final table; defaults to the configuration (fits).",
+)
+@click.option(
+    "--metrics",
+    default=None,
+    help="Append the timings and counts of each field to this JSON lines file.",
+)
+@click.option(
+    "--profile", is_flag=True, help="Profile the stages of each field with cProfile."
+)
+def main(
+    path,
+    config,
+    name,
+    ra,
+    dec,
+    no_cache,
+    refresh,
+    targets,
+    jobs,
+    serve,
+    port,
+    socket_path,
+    resume,
+    keep_intermediates,
+    fmt,
+    metrics,
+    profile,
+):
+    # A service answering the fields requested by clients
+    if serve:
+        redshifts_service(
+            path,
+            config,
+            port,
+            socket_path,
+            jobs,
+            no_cache,
+            refresh,
+            keep_intermediates,
+            fmt,
+            metrics,
+            profile,
+        )
+        return
+    # A table of fields to run in one go
+    if targets is not None:
+        redshifts_batch(
+            path,
+            targets,
+            config,
+            jobs,
+            resume,
+            no_cache,
+            refresh,
+            keep_intermediates,
+            fmt,
+            metrics,
+            profile,
+        )
+        return
     # A fits file containing all the sources we want to download redshifts for
-    redshifts(path, name, ra, dec, config)
+    redshifts(
+        path,
+        name,
+        ra,
+        dec,
+        config,
+        no_cache,
+        refresh,
+        keep_intermediates,
+        fmt,
+        metrics,
+        profile,
+    )
 
 
 if __name__ == "__main__":
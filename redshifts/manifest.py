@@ -0,0 +1,177 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+
+from redshifts.files import atomic_write
+
+# Configuration settings that change the outcome of the query stage; the other
+# settings (concurrency, cache, ...) only change how the results are obtained
+QUERY_SETTINGS = [
+    "radius",
+    "uncertainty",
+    "banned_catalogs_redshift",
+    "banned_catalogs_velocity",
+    "banned_keywords",
+    "hard_selection",
+    "ned_types",
+    "ned_flags",
+    "tile_size",
+    "combined_vizier",
+    "prune_vizier",
+]
+
+# Settings that change the rows found over a part of the sky, and so define
+# which master store the results go to; the radius and tiling only change
+# which part of the sky is searched
+STORE_SETTINGS = [s for s in QUERY_SETTINGS if s not in ("radius", "tile_size")]
+
+
+def file_digest(path):
+    """
+    Hash of the content of a file
+    Input:
+        path: location of the file
+    Return:
+        hex digest of the file, or None if the file does not exist
+    """
+    digest = hashlib.sha256()
+    try:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+    except FileNotFoundError:
+        return None
+    return digest.hexdigest()
+
+
+def table_digest(table):
+    """
+    Hash of the content of a table in memory, independent of the byte order
+    and string types of its columns, such that a table read back from a file
+    has the same hash as the table that was written
+    Input:
+        table: Astropy table
+    Return:
+        hex digest of the column names, values and masks
+    """
+    digest = hashlib.sha256()
+    for name in table.colnames:
+        col = table[name]
+        data = np.ma.getdata(col)
+        digest.update(name.encode())
+        if data.dtype.kind in "SU":
+            digest.update("\n".join(data.astype(str)).encode())
+        else:
+            digest.update(data.astype(data.dtype.newbyteorder("<")).tobytes())
+        mask = np.ma.getmaskarray(col)
+        if mask.any():
+            digest.update(np.packbits(mask).tobytes())
+    return digest.hexdigest()
+
+
+def code_version(*files):
+    """
+    Hash of the source code that implements a stage, such that a stage is run
+    again after its code changes
+    Input:
+        files: source files of the Python modules
+    Return:
+        hex digest of the source files
+    """
+    digest = hashlib.sha256()
+    for path in files:
+        digest.update(file_digest(path).encode())
+    return digest.hexdigest()
+
+
+def config_subset(config, settings=QUERY_SETTINGS):
+    """
+    Settings of the configuration that a stage depends on
+    Input:
+        config: configuration
+        settings: names of the settings
+    Return:
+        dictionary of setting name and value, as strings for the quantities
+    """
+    subset = {}
+    for setting in settings:
+        value = getattr(config, setting)
+        subset[setting] = str(value) if hasattr(value, "unit") else value
+    return subset
+
+
+class Manifest:
+    """
+    Record of the stages run for a field. For each stage it keeps a hash of the
+    inputs of the stage (query parameters, settings, code version, files
+    written by the previous stages) and a hash of each file the stage wrote. A
+    stage whose inputs did not change and whose files are all still there and
+    untouched does not need to run again.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.directory = os.path.dirname(path) or "."
+        try:
+            with open(path) as f:
+                self.stages = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.stages = {}
+
+    @staticmethod
+    def inputs_digest(inputs):
+        query = json.dumps(inputs, sort_keys=True, default=str)
+        return hashlib.sha256(query.encode()).hexdigest()
+
+    def fresh(self, stage, inputs):
+        """
+        Check whether a stage can be skipped
+        Input:
+            stage: name of the stage
+            inputs: dictionary with everything the stage depends on
+        Return:
+            True if the stage ran before with the same inputs and its files are
+            unchanged
+        """
+        record = self.stages.get(stage)
+        if record is None or record["inputs"] != self.inputs_digest(inputs):
+            return False
+        return all(
+            file_digest(os.path.join(self.directory, path)) == digest
+            for path, digest in record["outputs"].items()
+        )
+
+    def record(self, stage, inputs, outputs):
+        """
+        Store the inputs and files of a stage that just ran, and write the
+        manifest to disk
+        Input:
+            stage: name of the stage
+            inputs: dictionary with everything the stage depends on
+            outputs: list of files written by the stage
+        """
+        # Files are stored relative to the manifest, such that the data
+        # directory can be moved
+        self.stages[stage] = {
+            "inputs": self.inputs_digest(inputs),
+            "outputs": {
+                os.path.relpath(path, self.directory): file_digest(path)
+                for path in outputs
+            },
+        }
+        self.save()
+
+    def forget(self, stage):
+        """
+        Drop a stage, such that it runs again next time
+        Input:
+            stage: name of the stage
+        """
+        if self.stages.pop(stage, None) is not None:
+            self.save()
+
+    def save(self):
+        with atomic_write(self.path, "w") as f:
+            json.dump(self.stages, f, indent=2, sort_keys=True)
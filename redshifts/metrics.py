@@ -0,0 +1,130 @@
+import os
+import json
+import time
+import cProfile
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+
+class Metrics:
+    """
+    Timings and counters of the search of a single field. The search runs in
+    several threads (sources, tiles, NED lookups), which all add to the same
+    record, so the time of a stage is summed over the threads that ran it and
+    can be larger than the wall time of the field.
+    Stages are named after what they do and where: network.Vizier and
+    network.NED are the region queries, network.NED_objects the per-object
+    lookups, wait.* the time spent waiting for the NED rate limit and before
+    retries, parse.*, filter.*, verify.NED, and the query, concat, dedupe and
+    write stages of the field.
+    Input:
+        field: name of the field
+        profile_dir: optional directory in which to write a cProfile dump of
+                     every stage
+    """
+
+    def __init__(self, field=None, profile_dir=None):
+        self.field = field
+        self.profile_dir = profile_dir
+        self.lock = threading.Lock()
+        self.times = defaultdict(float)
+        self.counts = Counter()
+        self.profiles = Counter()
+        self.profiling = threading.local()
+        self.started = time.time()
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            self.times[name] += seconds
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counts[name] += int(n)
+
+    @contextmanager
+    def stage(self, name, profile=True):
+        """
+        Time a stage, and profile it if a profile directory is set. cProfile
+        only follows the thread that starts it, so a stage running inside an
+        already profiled stage of the same thread is timed but not profiled.
+        Input:
+            name: name of the stage
+            profile: False for stages that run too often to profile each run,
+                     e.g. a single request
+        """
+        profiler = self.start_profile() if profile else None
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+            if profiler is not None:
+                self.stop_profile(profiler, name)
+
+    def start_profile(self):
+        if self.profile_dir is None or getattr(self.profiling, "active", False):
+            return None
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already running in this process
+            return None
+        self.profiling.active = True
+        return profiler
+
+    def stop_profile(self, profiler, name):
+        profiler.disable()
+        self.profiling.active = False
+        with self.lock:
+            self.profiles[name] += 1
+            n = self.profiles[name]
+        if not os.path.exists(self.profile_dir):
+            os.makedirs(self.profile_dir, exist_ok=True)
+        profiler.dump_stats(f"{self.profile_dir}/{self.field}_{name}_{n}.prof")
+
+    def as_dict(self, **extra):
+        """
+        Record of the field
+        Input:
+            extra: any other entries of the record, e.g. the status of the field
+        Return:
+            dictionary with the field name, start time, timings in seconds and
+            counters
+        """
+        with self.lock:
+            return {
+                "field": self.field,
+                "started": self.started,
+                **extra,
+                "times": dict(sorted(self.times.items())),
+                "counts": dict(sorted(self.counts.items())),
+            }
+
+    def write(self, metrics_file, **extra):
+        """
+        Append the record of the field to a file, as a single JSON line. Each
+        record is written with a single call, such that fields running in
+        different processes can share the same file.
+        Input:
+            metrics_file: path of the JSON lines file
+            extra: any other entries of the record, see as_dict
+        """
+        line = json.dumps(self.as_dict(**extra)) + "\n"
+        with open(os.path.expanduser(metrics_file), "a") as f:
+            f.write(line)
+
+    def summary(self):
+        """
+        One line summary of where the time of the field went
+        Return:
+            string with the downloaded volume and the time of the main stages
+        """
+        with self.lock:
+            downloaded = sum(n for k, n in self.counts.items() if k.startswith("bytes"))
+            groups = defaultdict(float)
+            for name, seconds in self.times.items():
+                groups[name.split(".")[0]] += seconds
+        times = ", ".join(f"{name} {seconds:.1f} s" for name, seconds in groups.items())
+        return f"{downloaded / 1e6:.1f} MB downloaded; {times}"
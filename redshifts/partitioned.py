@@ -0,0 +1,334 @@
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from astropy.io import fits
+from astropy.table import MaskedColumn, Table
+from astropy import units as u
+
+import redshifts.tiles as tiles
+import redshifts.duplicates as duplicates
+from redshifts.metrics import Metrics
+
+# Rows of the stacked table read and partitioned at a time
+CHUNK_ROWS = 100_000
+# Position angles at which each row looks for a cell edge within the match
+# radius, see near_edge
+DIRECTIONS = np.radians(np.arange(0, 360, 45))
+# FITS files are written in blocks of 2880 bytes
+FITS_BLOCK = 2880
+
+
+def record_dtype(table):
+    """
+    Layout of the rows in the partition files: the columns of the table, a
+    mask for each masked column, the row number in the table, whether the
+    row lies near the edge of its cell and the first row of its group
+    Input:
+        table: stacked table, or an empty slice of it
+    Return:
+        numpy structured dtype
+    """
+    fields = []
+    for name in table.colnames:
+        fields.append((name, table[name].dtype))
+        if table.masked or isinstance(table[name], MaskedColumn):
+            fields.append((f"{name}.mask", bool))
+    return np.dtype(fields + [("row", np.int64), ("near", bool), ("first", np.int64)])
+
+
+def to_records(table, dtype, start):
+    """
+    Input:
+        table: slice of the stacked table
+        dtype: layout of the rows, see record_dtype
+        start: row number of the first row of the slice
+    Return:
+        structured array with the rows of the slice
+    """
+    records = np.zeros(len(table), dtype=dtype)
+    for name in table.colnames:
+        records[name] = np.ma.getdata(table[name])
+        if f"{name}.mask" in dtype.names:
+            records[f"{name}.mask"] = np.ma.getmaskarray(table[name])
+    records["row"] = np.arange(start, start + len(table))
+    return records
+
+
+def near_edge(ra, dec, cells, order, dist):
+    """
+    Find the rows that could have a duplicate in a neighbouring cell. A row is
+    near the edge of its cell if one of the points at twice the match radius
+    around it, in eight directions, falls in another cell. As cells are much
+    larger than the match radius, their edges are straight lines at that scale,
+    and any edge within the match radius puts at least two of these points in
+    the neighbouring cell.
+    Input:
+        ra, dec: arrays of coordinates in degrees
+        cells: cell of every row
+        order: HEALPix order of the cells
+        dist: match radius in arcsec
+    Return:
+        boolean array which is True for the rows near the edge of their cell
+    """
+    hp = tiles.healpix(order)
+    ra, dec = np.radians(ra), np.radians(dec)
+    position = duplicates.radec2xyz(np.degrees(ra), np.degrees(dec))
+    # Unit vectors pointing north and east at every position
+    north = np.column_stack(
+        [-np.sin(dec) * np.cos(ra), -np.sin(dec) * np.sin(ra), np.cos(dec)]
+    )
+    east = np.column_stack([-np.sin(ra), np.cos(ra), np.zeros(len(ra))])
+    offset = np.radians(2 * dist / 3600)
+    near = np.zeros(len(ra), dtype=bool)
+    for angle in DIRECTIONS:
+        tangent = np.cos(angle) * north + np.sin(angle) * east
+        x, y, z = (np.cos(offset) * position + np.sin(offset) * tangent).T
+        lon, lat = np.arctan2(y, x), np.arctan2(z, np.hypot(x, y))
+        near |= hp.lonlat_to_healpix(lon * u.rad, lat * u.rad) != cells
+    return near
+
+
+class FitsStream:
+    """
+    FITS binary table written a few rows at a time, such that the table never
+    has to be held in memory as a whole. The header is written first with no
+    rows and updated with the number of rows once the table is complete.
+    Input:
+        path: location of the table
+        template: empty table with the columns of the table
+    """
+
+    def __init__(self, path, template):
+        self.path = path
+        hdu = fits.table_to_hdu(template)
+        self.header = hdu.header
+        # Layout of a row of the table in the file, in the big-endian order of
+        # FITS
+        self.dtype = np.asarray(hdu.data).dtype.newbyteorder(">")
+        self.nulls = {
+            self.header[f"TTYPE{i}"]: self.header[f"TNULL{i}"]
+            for i in range(1, len(template.colnames) + 1)
+            if f"TNULL{i}" in self.header
+        }
+        fd, self.tmp_path = tempfile.mkstemp(
+            dir=os.path.dirname(path) or ".", suffix=".fits"
+        )
+        self.file = os.fdopen(fd, "wb")
+        self.file.write(fits.PrimaryHDU().header.tostring().encode("ascii"))
+        self.header_start = self.file.tell()
+        self.file.write(self.header.tostring().encode("ascii"))
+        self.n_rows = 0
+
+    def write(self, records):
+        """
+        Append rows to the table; masked values are written as NaN, or as the
+        TNULL value of integer columns, as astropy does
+        Input:
+            records: structured array of rows, see to_records
+        """
+        data = np.zeros(len(records), dtype=self.dtype)
+        for name in self.dtype.names:
+            values = records[name]
+            if values.dtype.kind == "U":
+                values = np.char.encode(values, "utf-8")
+            data[name] = values
+            if f"{name}.mask" in records.dtype.names:
+                mask = records[f"{name}.mask"]
+                if data[name].dtype.kind == "f":
+                    data[name][mask] = np.nan
+                elif name in self.nulls:
+                    data[name][mask] = self.nulls[name]
+        self.file.write(data.tobytes())
+        self.n_rows += len(records)
+
+    def close(self):
+        """
+        Finish the table: pad the data to a whole FITS block, write the number
+        of rows to the header and move the table into place
+        """
+        self.file.write(b"\0" * (-self.n_rows * self.dtype.itemsize % FITS_BLOCK))
+        self.header["NAXIS2"] = self.n_rows
+        self.file.seek(self.header_start)
+        self.file.write(self.header.tostring().encode("ascii"))
+        self.file.close()
+        os.replace(self.tmp_path, self.path)
+
+
+def partition(source, order, directory, dist, metrics):
+    """
+    Split the stacked table into one file per HEALPix cell, reading it a chunk
+    at a time
+    Input:
+        source: stacked table, or its FITS file
+        order: HEALPix order of the cells
+        directory: location of the partition files
+        dist: match radius in arcsec
+        metrics: Metrics of the field
+    Return:
+        empty slice of the stacked table, with the GroupID and GroupSize columns
+        of duplicates.identify_duplicates, the layout of its rows and the sorted
+        list of the cells that hold rows
+    """
+    if not isinstance(source, Table):
+        source = Table.read(source, hdu=1, memmap=True)
+    template = source[:0]
+    duplicates.add_group_columns(template, np.zeros(0, dtype=np.int64))
+    dtype = record_dtype(template)
+    cells = set()
+    for start in range(0, len(source), CHUNK_ROWS):
+        records = to_records(source[start : start + CHUNK_ROWS], dtype, start)
+        ra = records["RA"].astype(float)
+        dec = records["DEC"].astype(float)
+        cell = tiles.healpix(order).lonlat_to_healpix(ra * u.deg, dec * u.deg)
+        records["near"] = near_edge(ra, dec, cell, order, dist)
+        metrics.count("dedupe.rows_near_edge", np.count_nonzero(records["near"]))
+
+        # Append the rows of each cell to its file, in the order of the table
+        order_in_chunk = np.argsort(cell, kind="stable")
+        cell, records = cell[order_in_chunk], records[order_in_chunk]
+        bounds = np.flatnonzero(np.diff(cell)) + 1
+        for part in np.split(np.arange(len(cell)), bounds):
+            if len(part) == 0:
+                continue
+            with open(os.path.join(directory, f"{cell[part[0]]}.bin"), "ab") as f:
+                records[part].tofile(f)
+            cells.add(int(cell[part[0]]))
+    return template, dtype, sorted(cells)
+
+
+def resolve(records, dist):
+    """
+    Remove the duplicates among a set of rows, and set the GroupSize and the
+    first row of the group of every row; the GroupID is set once all the cells
+    are done, see number_groups
+    Input:
+        records: structured array of rows, see to_records
+        dist: match radius in arcsec
+    Return:
+        boolean array which is True for the rows to keep, and boolean array
+        which is True for the rows whose group reaches the edge of a cell
+    """
+    labels, sizes = duplicates.group_labels(records["RA"], records["DEC"], dist)
+    records["GroupSize"] = sizes
+    records["GroupSize.mask"] = sizes < 2
+    records["GroupID.mask"] = True
+    edge = np.zeros(len(records), dtype=bool)
+    if len(records) > 0:
+        edge_groups = np.zeros(labels.max() + 1, dtype=bool)
+        edge_groups[labels[records["near"]]] = True
+        edge = edge_groups[labels]
+        first = np.full(labels.max() + 1, np.iinfo(np.int64).max)
+        np.minimum.at(first, labels, records["row"])
+        records["first"] = first[labels]
+    keep = duplicates.best_of_groups(labels, records["Redshift"], records["row"])
+    return keep, edge
+
+
+def resolve_cell(path, dtype, dist):
+    """
+    Remove the duplicates within a cell; the groups that reach the edge of the
+    cell could continue in a neighbouring cell, so they are set apart
+    Input:
+        path: partition file of the cell
+        dtype: layout of the rows
+        dist: match radius in arcsec
+    Return:
+        rows to keep and rows of the groups at the edge of the cell
+    """
+    records = np.fromfile(path, dtype=dtype)
+    os.remove(path)
+    keep, edge = resolve(records, dist)
+    return records[keep & ~edge], records[edge]
+
+
+def number_groups(path, rows, first):
+    """
+    Set the GroupID of the rows of a finished table that had duplicates: the
+    groups are numbered from 1 in order of their first row in the stacked
+    table, as in duplicates.add_group_columns. Only the GroupID column is
+    written, in place.
+    Input:
+        path: location of the table
+        rows: rows of the table that had duplicates
+        first: first row of their group in the stacked table
+    """
+    if len(rows) == 0:
+        return
+    with fits.open(path, mode="update", memmap=True) as hdus:
+        hdus[1].data["GroupID"][rows] = np.argsort(np.argsort(first)) + 1
+
+
+def dedupe_partitioned(
+    source, outfile, cell_size, dist=1, workers=1, metrics=None, tmp_dir=None
+):
+    """
+    Remove the duplicates of a stacked table that does not fit in memory, with
+    the same result as duplicates.identify_duplicates and
+    duplicates.find_groups_redshift. The rows are split into HEALPix cells of
+    about cell_size, and the duplicates are removed cell by cell, by workers
+    threads in parallel. Groups that reach the edge of a cell, i.e. with a row
+    within the match radius of it, are set apart and resolved together once
+    all cells are done, such that groups across cell edges are found whole.
+    The unique rows are written to the FITS output as soon as their cell is
+    done, so memory use is set by the size of the cells and not of the field.
+    The rows come out ordered by cell, with the GroupID and GroupSize columns
+    of duplicates.identify_duplicates.
+    Input:
+        source: stacked table, or its FITS file (read a chunk at a time)
+        outfile: name of the FITS file to write
+        cell_size: size of the cells as an angle
+        dist: match radius in arcsec
+        workers: number of cells resolved in parallel
+        metrics: optional Metrics of the field
+        tmp_dir: optional location of the partition files, by default next to
+                 outfile
+    Return:
+        number of unique rows written
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    order = tiles.tile_order(cell_size)
+    tmp_dir = tmp_dir if tmp_dir is not None else os.path.dirname(outfile) or "."
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as directory:
+        template, dtype, cells = partition(source, order, directory, dist, metrics)
+        metrics.count("dedupe.cells", len(cells))
+        output = FitsStream(outfile, template)
+        edge_path = os.path.join(directory, "edge.bin")
+        grouped_rows, grouped_first = [], []
+
+        def write_rows(records):
+            # Remember where the rows with duplicates go, to number their groups
+            grouped = np.flatnonzero(~records["GroupSize.mask"])
+            grouped_rows.append(output.n_rows + grouped)
+            grouped_first.append(records["first"][grouped])
+            output.write(records)
+
+        def write_cell(result):
+            kept, edge = result
+            write_rows(kept)
+            edge.tofile(edge_file)
+            metrics.count("dedupe.rows_at_edges", len(edge))
+
+        # Resolve the cells in order, with at most a few cells in flight, such
+        # that the memory used stays bounded
+        with ThreadPoolExecutor(max_workers=workers) as executor, open(
+            edge_path, "wb"
+        ) as edge_file:
+            pending = deque()
+            for cell in cells:
+                path = os.path.join(directory, f"{cell}.bin")
+                pending.append(executor.submit(resolve_cell, path, dtype, dist))
+                if len(pending) > 2 * workers:
+                    write_cell(pending.popleft().result())
+            while pending:
+                write_cell(pending.popleft().result())
+
+        # Resolve the groups at the edges of the cells together
+        records = np.fromfile(edge_path, dtype=dtype)
+        keep, _ = resolve(records, dist)
+        write_rows(records[keep])
+        output.close()
+    number_groups(outfile, np.concatenate(grouped_rows), np.concatenate(grouped_first))
+    return output.n_rows
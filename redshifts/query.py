@@ -1,23 +1,44 @@
 import os
 from io import BytesIO, StringIO
-import shutil
-import subprocess
-from collections import defaultdict
+import inspect
 import operator
+import re
+import threading
+import time
+from dataclasses import replace
 from functools import reduce
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
 
 from colorama import Fore
 import numpy as np
-from astroquery.vizier import Vizier
-from astroquery.ned import Ned
+import requests
 from astropy.table import Column, QTable, Table, vstack
 from astropy.io.votable import parse
 from astropy import constants as const
 from astropy import units as u
 import astropy.coordinates as coord
 
-timeout = 100 * 60
-Ned.TIMEOUT = timeout
+from redshifts.assembly import Part, assemble, table_part
+from redshifts.cache import ResponseCache
+from redshifts.catalog_index import CatalogIndex, metadata_fingerprint, table_name
+from redshifts.metrics import Metrics
+from redshifts.rules import DEFAULT_RULES, as_text
+from redshifts.transport import deadline, get_transport
+from redshifts.verdicts import VerdictStore
+import redshifts.tiles as tiles
+import redshifts.duplicates as duplicates
+import redshifts.partitioned as partitioned
+import redshifts.incremental as incremental
+from redshifts.manifest import (
+    STORE_SETTINGS,
+    Manifest,
+    code_version,
+    config_subset,
+    file_digest,
+    table_digest,
+)
+from redshifts.store import MasterStore
+
 
 VELOCITY_SRC = "spect.dopplerVeloc*|phys.veloc*"
 VELOCITY_KEYS = [
@@ -30,27 +51,11 @@ VELOCITY_KEYS = [
 ]
 REDSHIFT_SRC = "src.redshift*"
 REDSHIFT_KEYS = ["REDSHIFT_HC"]
-NED_FLAGS = [
-    b"::",
-    b"?",
-    b"CONT",
-    b"EST",
-    b"FoF",
-    b"LUM",
-    b"MFA",
-    b"MOD",
-    b"PHOT",
-    b"PEAK",
-    b"PRED",
-    b"SED",
-    b"TENT",
-    b"TOMO",
-]
-NED_TYPES = [b"QGroup", b"GClstr", b"GGroup", b"GPair", b"GTrpl", b"Other", b"PofG"]
-
-HARD_SELECTION = ["spectroscopic", "Spectroscopic"]
-
-BANNED_KEYWORDS = ["cluster", "Cluster", "Photometric", "photometric"]
+# Start of a TABLE element in a VOTable document (but not of TABLEDATA)
+TABLE_START = re.compile(rb"<TABLE[\s>]")
+# Vizier constraint that every value of a numeric column meets, but a missing
+# value does not: used to download only the rows with a redshift
+NOT_NULL = ">-1e30"
 
 
 def unwanted_catalogue(cat_name, banned_cat_list):
@@ -59,14 +64,12 @@ def unwanted_catalogue(cat_name, banned_cat_list):
     catalogues
     Input: 
         cat_name: name of the catalogue
-        banned_cat_list: list of catalogues that have been deemed banned
+        banned_cat_list: Matcher of the catalogues that have been deemed banned,
+                         see rules.Rules
     Output:
         return True if the catalogue is within the banned list, False if not
     """
-    if any(elem in cat_name for elem in banned_cat_list):
-        return True
-    else:
-        return False
+    return banned_cat_list.search(cat_name)
 
 
 def vel2redshift(cat, col):
@@ -80,18 +83,17 @@ def vel2redshift(cat, col):
         catalogue with velocity converted to redshift
     """
     try:
+        description = cat[col].info.description
         cat[col].unit.to(u.m / u.s)
         cat.replace_column(col, cat[col] / const.c.to(cat[col].unit))
-        cat[col].info.description = (
-            cat[col].info.description + ", converted to redshift"
-        )
+        cat[col].info.description = description + ", converted to redshift"
         cat[col].unit = u.dimensionless_unscaled
     except:
         pass
     return cat
 
 
-def select_best_redshift(cat, col_selection):
+def select_best_redshift(descriptions, col_selection, rules=DEFAULT_RULES):
     """
     Select a single column for the redshift measurement, for each catalogue. If 
     the table does not have any relevant column, return None. If there is one 
@@ -100,8 +102,10 @@ def select_best_redshift(cat, col_selection):
     spectroscopic redshift, keep that one. Otherwise, just select the first 
     column in the list.
     Input:
-        cat: parent catalogue
+        descriptions: dictionary of column name and description of the parent
+                      catalogue
         col_selection: list of column names
+        rules: selection rules, see rules.Rules
     Return:
         None or a single column name
     """
@@ -116,29 +120,29 @@ def select_best_redshift(cat, col_selection):
     # If more than one column were previously selected, choose one.
     if len(col_selection) > 1:
         for col in col_selection:
-            if any(elem in cat[col].info.description for elem in HARD_SELECTION):
+            if rules.hard_selection.search(descriptions[col]):
                 return col
         return col_selection[0]
 
 
-def column_selection(type1, cat):
+def column_selection(type1, descriptions, rules=DEFAULT_RULES):
     """
     Select the columns that could potentially contain redshift information
     Input:
         type1: redshift of velocity
-        cat: catalogue in Astropy table format
+        descriptions: dictionary of column name and description of the
+                      catalogue, in the order of its columns
+        rules: selection rules, see rules.Rules
     Output:
         selection of columns
     """
     col_selection = []
-    for col in cat.colnames:
+    for col, desc in descriptions.items():
         if col == "_RAJ2000":
             continue
         if col == "_DEJ2000":
             continue
-        desc = cat[col].info.description
-        f = any([(ban in desc) for ban in BANNED_KEYWORDS])
-        if f is False:
+        if not rules.banned_keywords.search(desc):
             col_selection.append(col)
     return col_selection
 
@@ -150,17 +154,12 @@ def set_unwanted_list(type1, config):
         type: velocity or redshift search
         c: configuration
     Output:
-        return list of catalogue names in string format
+        return Matcher of the banned catalogue names
     """
-    if type1 == "redshift":
-        return config.banned_catalogs_redshift
-    if type1 == "velocity":
-        return config.banned_catalogs_velocity
+    return config.rules.banned[type1]
 
 
-def process_catalog(
-    type1, cat, config, RA, DEC, z="Redshift", RAf="RA", DECf="DEC", origin="Origin"
-):
+def process_catalog(type1, cat, config, RA, DEC, metrics=None):
     """
     Take an downloaded Vizier catalogue and extract RA, DEC and a redshift 
     column, if possible
@@ -169,48 +168,56 @@ def process_catalog(
         cat: catalog as downloaded from Vizier with all columns in it
         config: configuration
         RA, DEC: names of RA and DEC column in original catalog
+        metrics: optional Metrics counting the catalogs seen, banned, skipped
+                 and kept
     Output:
         return None if catalog does not contain any useful redshift column or
-        a table with 4 columns: RA, DEC, redshift and data origin
+        the part of the catalog to keep: its RA, DEC and redshift columns, the
+        rows with a redshift and the catalog name as data origin
     """
+    metrics = metrics if metrics is not None else Metrics()
+    metrics.count(f"{type1}.catalogs_seen")
+    metrics.count(f"{type1}.rows", len(cat))
+
     # Skip unwanted catalogues
     if unwanted_catalogue(cat.meta["name"], set_unwanted_list(type1, config)):
+        metrics.count(f"{type1}.catalogs_banned")
         return None
 
-    # Make a list of potential column that contain redshift information
-    col_selection = column_selection(type1, cat)
-    final_z_col = select_best_redshift(cat, col_selection)
+    # Make a list of potential column that contain redshift information, unless
+    # prelim_selections already chose the column from the catalog metadata
+    final_z_col = cat.meta.get("redshift_column")
+    if final_z_col is None:
+        descriptions = {col: cat[col].info.description for col in cat.colnames}
+        col_selection = column_selection(type1, descriptions, config.rules)
+        final_z_col = select_best_redshift(descriptions, col_selection, config.rules)
 
     # If no relevant redshift column is present, skip the catalog
     if final_z_col == None:
+        metrics.count(f"{type1}.catalogs_skipped")
         return None
 
     # Skip weird column/tables with weird units/types for
     if cat[final_z_col].dtype not in [np.float32, np.float64]:
+        metrics.count(f"{type1}.catalogs_skipped")
         return None
 
     # If all values are masked, skip the catalog
     if all(cat[final_z_col].mask):
+        metrics.count(f"{type1}.catalogs_skipped")
         return None
-
-    # Homogenize column names
-    cat.rename_column(final_z_col, z)
-
-    # Select only relevant columns: RA, DEC and redshift
-    final_cat = cat[RA, DEC, z][~cat[z].mask]
-
-    # Rename the coord columns with chosen names
-    final_cat.rename_column(RA, RAf)
-    final_cat.rename_column(DEC, DECf)
-
-    # Add Vizier catalog name to the table for future reference
-    final_cat.add_column(Column([cat.meta["name"]] * len(final_cat)), name=origin)
-
-    # Add to master list of tables
-    return final_cat
+    metrics.count(f"{type1}.catalogs_kept")
+    metrics.count(f"{type1}.rows_no_redshift", np.count_nonzero(cat[final_z_col].mask))
+
+    # Select only relevant columns: RA, DEC and redshift, for the rows with a
+    # redshift, and add the Vizier catalog name for future reference. The rows
+    # are only copied once all catalogs are processed, see assemble
+    return Part(
+        cat[RA], cat[DEC], cat[final_z_col], ~cat[final_z_col].mask, cat.meta["name"]
+    )
 
 
-def remove_potential_photoz(table, z_col):
+def remove_potential_photoz(table, z_col, return_mask=False):
     """
     Some redshifts in Vizier might still be photometric. Check whether the 
     values of the redshift has little precision and use this as a proxy for 
@@ -219,67 +226,630 @@ def remove_potential_photoz(table, z_col):
     Input:
         table: table that contains redshift measurements
         z_col: optional name of the redshift column 
+        return_mask: if True, return only the boolean mask of the rows to keep
+                     and leave the table untouched
     Return:
-        table without potential photometric redshift
-    """
-    # Add number of rows to a list
-    rows_to_remove = []
-    # Iterate the table
-    for i, z in enumerate(table[z_col]):
-        # A string of 9's or 0's usually comes from python not being able to
-        # represent float accurately, so those measurements probably have a lot
-        # less precision than they might look like. Also if the string
-        # representation of the redshift measurement is short, it means the
-        # measurement does not have a lot of precision; here I remove anything
-        # with less than 2 significant digits.
-        if ("999999" in str(z)) | ("000000" in str(z)):
-            rows_to_remove.append(i)
-
-    table.remove_rows(rows_to_remove)
-    return table
+        table without potential photometric redshift, or the mask of rows that
+        are not consistent with photometric measurements
+    """
+    # A string of 9's or 0's usually comes from python not being able to
+    # represent float accurately, so those measurements probably have a lot
+    # less precision than they might look like. Also if the string
+    # representation of the redshift measurement is short, it means the
+    # measurement does not have a lot of precision; here I remove anything
+    # with less than 2 significant digits.
+    # Converting the whole column to strings gives the same shortest
+    # representation as str() on each value; masked values are always kept
+    keep = precise_redshifts(table[z_col])
+
+    if return_mask:
+        return keep
+    return table[keep]
+
+
+def precise_redshifts(z):
+    """
+    Find the redshifts that are not consistent with photometric measurements,
+    see remove_potential_photoz
+    Input:
+        z: redshift column
+    Return:
+        boolean mask of the redshifts to keep; masked values are always kept
+    """
+    as_str = np.ma.getdata(z).astype(str)
+    low_precision = (np.char.find(as_str, "999999") >= 0) | (
+        np.char.find(as_str, "000000") >= 0
+    )
+    return ~low_precision | np.ma.getmaskarray(z)
 
 
-def prelim_selection(cat_vot, type1, RA, DEC, KEYS):
+def split_votable(data):
+    """
+    Split a VOTable document with many tables, such as a Vizier response, into
+    one document per table. Each document is made of the VOTABLE and RESOURCE
+    headers followed by a single table, such that the tables can be parsed one
+    at a time. The tables are not copied, but returned as views on the data.
+    Input:
+        data: raw VOTable document in bytes
+    Yields:
+        for each table, a tuple of the header in bytes, the table metadata (the
+        table up to its DATA element) and the whole table
+    """
+    view = memoryview(data)
+    first_resource = data.find(b"<RESOURCE")
+    if first_resource < 0:
+        return
+    header = data[:first_resource]
+
+    for match in TABLE_START.finditer(data, first_resource):
+        start = match.start()
+        end = data.find(b"</TABLE>", start)
+        if end < 0:
+            # Truncated response
+            return
+        end += len(b"</TABLE>")
+
+        # Keep the RESOURCE element and the resource-level information that
+        # comes before its first table, e.g. COOSYS
+        resource = data.rfind(b"<RESOURCE", 0, start)
+        resource_header = data[resource : TABLE_START.search(data, resource).start()]
+
+        data_start = data.find(b"<DATA", start, end)
+        if data_start < 0:
+            data_start = end - len(b"</TABLE>")
+
+        yield header + resource_header, view[start:data_start], view[start:end]
+
+
+def parse_table(header, table, metadata_only=False, columns=None):
+    """
+    Parse a single table from split_votable
+    Input:
+        header: VOTABLE and RESOURCE headers
+        table: table, or table metadata, in bytes
+        metadata_only: True if table stops before its DATA element
+        columns: optional list of field IDs to read from the data
+    Return:
+        VOTable table element
+    """
+    closing = b"</TABLE>" if metadata_only else b""
+    document = b"".join([header, table, closing, b"</RESOURCE></VOTABLE>"])
+    return parse(
+        BytesIO(document), columns=columns, pedantic=False, invalid="mask"
+    ).get_first_table()
+
+
+def select_fields(fields, type1, KEYS):
+    """
+    Decide from the metadata of a table which fields could contain a redshift
+    Input:
+        fields: VOTable FIELD elements of the table
+        type1: velocity or redshift search
+        KEYS: UCDs of the relevant fields
+    Return:
+        list of the selected fields
+    """
+    cols = []
+    for f in fields:
+        # For velocities, check whether the units are the right type
+        if type1 == "velocity":
+            if f.ucd in KEYS:
+                try:
+                    f.unit.to(u.m / u.s)
+                    cols.append(f)
+                except:
+                    pass
+        # For redshifts, check whether the precision is high enough
+        if type1 == "redshift":
+            try:
+                if (
+                    f.precision is not None
+                    and (f.ucd in KEYS)
+                    and (int(float(f.precision)) > 3)
+                ):
+                    cols.append(f)
+            except:
+                pass
+    return cols
+
+
+def table_columns(table, names):
+    """
+    Convert only some of the fields of a VOTable table to an Astropy table, in
+    the same way as table.to_table(use_names_over_ids=True) converts them all
+    Input:
+        table: VOTable table element
+        names: names of the fields to convert
+    Return:
+        Astropy table with the requested columns
+    """
+    index = {f.name: i for i, f in enumerate(table.fields)}
+    meta = {}
+    for key in ["ID", "name", "ref", "ucd", "utype", "description"]:
+        if getattr(table, key, None) is not None:
+            meta[key] = getattr(table, key)
+
+    keys = table.array.dtype.names
+    cat = Table(
+        table.array[[keys[index[name]] for name in names]], names=names, meta=meta
+    )
+    for name in names:
+        table.fields[index[name]].to_table_column(cat[name])
+    return cat
+
+
+def classify_catalog(fields, name, types, RA, DEC, rules):
+    """
+    Decide from the metadata of a Vizier table what to do with it in every type
+    of search: which columns could hold a redshift, whether the catalog is
+    banned and which of the columns to use
+    Input:
+        fields: VOTable FIELD elements of the table
+        name: name of the catalog
+        types: dictionary of type (redshift or velocity) and its UCD keywords
+        RA, DEC: names of the RA and DEC columns
+        rules: selection rules, see rules.Rules
+    Return:
+        dictionary with the IDs of the fields to read (empty if the table can
+        be skipped) and, for each type with candidate columns, the columns, the
+        banned flag and the chosen redshift column (None if none is usable)
+    """
+    decision = {"ids": [], "types": {}}
+    needed = set()
+    for type1, KEYS in types.items():
+        columns = [f.name for f in select_fields(fields, type1, KEYS)]
+        if not columns:
+            continue
+        descriptions = {f.name: f.description for f in fields if f.name in columns}
+        column = select_best_redshift(
+            descriptions, column_selection(type1, descriptions, rules), rules
+        )
+        is_banned = unwanted_catalogue(name, rules.banned[type1])
+        decision["types"][type1] = {
+            "columns": columns,
+            "banned": is_banned,
+            "column": column,
+        }
+        if not is_banned and column is not None:
+            needed.update(columns)
+    if needed:
+        decision["ids"] = [f.ID for f in fields if f.name in [RA, DEC, *needed]]
+    return decision
+
+
+# Version of the code that classifies the catalogs (this module, the matching
+# rules and the catalog metadata), part of the rules under which a decision is
+# stored in the catalog index
+CLASSIFICATION_CODE = code_version(
+    __file__, inspect.getfile(as_text), inspect.getfile(CatalogIndex)
+)
+# Version of all the code that the query of a field runs, from the requests to
+# the assembly of the results, such that a change of any of it runs the query
+# again
+QUERY_CODE = code_version(
+    __file__,
+    tiles.__file__,
+    inspect.getfile(assemble),
+    inspect.getfile(as_text),
+    inspect.getfile(CatalogIndex),
+    inspect.getfile(get_transport),
+    inspect.getfile(ResponseCache),
+    inspect.getfile(VerdictStore),
+    inspect.getfile(MasterStore),
+)
+
+
+def classification_rules(types, RA, DEC, rules):
+    """
+    Digest of everything the classification of a catalog depends on, other
+    than the catalog itself
+    Input:
+        types, RA, DEC, rules: see classify_catalog
+    Return:
+        hex digest of the rules
+    """
+    return ResponseCache.key(
+        types=types, RA=RA, DEC=DEC, rules=rules.settings(), code=CLASSIFICATION_CODE
+    )
+
+
+# All fields of this process share the catalog index of a cache directory
+_catalog_indexes = {}
+_catalog_indexes_lock = threading.Lock()
+
+
+def get_catalog_index(config):
+    """
+    Return the index of catalog classifications
+    Input:
+        config: configuration
+    Return:
+        CatalogIndex, or None if the index is switched off
+    """
+    if config is None or not config.catalog_index:
+        return None
+    directory = os.path.join(os.path.expanduser(config.cache_dir), "catalogs")
+    with _catalog_indexes_lock:
+        if directory not in _catalog_indexes:
+            _catalog_indexes[directory] = CatalogIndex(directory)
+        return _catalog_indexes[directory]
+
+
+def catalog_decisions(data, types, RA, DEC, config=None, metrics=None):
+    """
+    Classify every table of a Vizier response from its metadata, see
+    classify_catalog. The decision taken for a catalog is stored in the
+    catalog index, such that the metadata of a catalog seen before is not even
+    parsed.
+    Input:
+        data: raw VOTable response
+        types: dictionary of type (redshift or velocity) and its UCD keywords
+        RA, DEC: names of the RA and DEC columns
+        config: optional configuration, with the banned catalogs and the
+                location of the catalog index
+        metrics: optional Metrics counting the catalogs banned or skipped
+    Yields:
+        for each table, the header, metadata and whole table from split_votable
+        and the decision
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    rules = config.rules if config is not None else DEFAULT_RULES
+    index = get_catalog_index(config)
+    digest = classification_rules(types, RA, DEC, rules)
+
+    for header, metadata, whole_table in split_votable(data):
+        key = CatalogIndex.key(metadata_fingerprint(metadata), digest)
+        decision = index.get(key) if index is not None else None
+        if decision is None:
+            table = parse_table(header, metadata, metadata_only=True)
+            decision = classify_catalog(table.fields, table.name, types, RA, DEC, rules)
+            if index is not None:
+                index.put(key, decision)
+                metrics.count("catalog_index.misses")
+        else:
+            metrics.count("catalog_index.hits")
+
+        for type1, choice in decision["types"].items():
+            if choice["banned"]:
+                metrics.count(f"{type1}.catalogs_seen")
+                metrics.count(f"{type1}.catalogs_banned")
+            elif choice["column"] is None:
+                metrics.count(f"{type1}.catalogs_seen")
+                metrics.count(f"{type1}.catalogs_skipped")
+        yield header, metadata, whole_table, decision
+
+
+def prelim_selection(data, type1, RA, DEC, KEYS, config=None, metrics=None):
     """
     Go through all the catalogs found online and decide whether to keep the
-    catalog, and if yes, which columns.
-    """
-    cat_list = []
-    for resource in cat_vot.resources:
-        for table in resource.tables:
-            cols = []
-            for f in table.fields:
-                # For velocities, check whether the units are the right type
-                if type1 == "velocity":
-                    if f.ucd in KEYS:
-                        try:
-                            f.unit.to(u.m / u.s)
-                            cols.append(f.name)
-                        except:
-                            pass
-                # For redshifts, check whether the precision is high enough
-                if type1 == "redshift":
-                    try:
-                        if (
-                            f.precision is not None
-                            and (f.ucd in KEYS)
-                            and (int(float(f.precision)) > 3)
-                        ):
-                            cols.append(f.name)
-                    except:
-                        pass
-            if cols != []:
-                tab1 = table.to_table(use_names_over_ids=True)[[RA, DEC] + cols]
-                tab1 = tab1[reduce(operator.or_, [~tab1[col].mask for col in cols])]
-                if type1 == "velocity":
-                    for col in cols:
-                        tab1 = vel2redshift(tab1, col)
-                if len(tab1) > 0:
-                    cat_list.append(tab1)
-    return cat_list
-
-
-def query_vizier(name, type1, config, RA="_RAJ2000", DEC="_DEJ2000", z="Redshift"):
+    catalog, and if yes, which columns. The decision is made on the metadata
+    of each table, before reading its data; only the data of the selected
+    tables and columns is read, one table at a time.
+    """
+    return prelim_selections(data, {type1: KEYS}, RA, DEC, config, metrics)[type1]
+
+
+def prelim_selections(data, types, RA, DEC, config=None, metrics=None):
+    """
+    Preliminary selection of a response for several types of search at once,
+    see prelim_selection. Every table is parsed only once, with the columns
+    needed by any of the types, and then split into one table per type.
+    Input:
+        data: raw VOTable response
+        types: dictionary of type (redshift or velocity) and its UCD keywords
+        RA, DEC: names of the RA and DEC columns
+        config: optional configuration, with the banned catalogs and the
+                location of the catalog index
+        metrics: optional Metrics counting the catalogs dropped here
+    Return:
+        dictionary of type and list of selected tables; the redshift column
+        of each table is given in its redshift_column metadata
+    """
+    cat_lists = {type1: [] for type1 in types}
+    decisions = catalog_decisions(data, types, RA, DEC, config, metrics)
+    for header, metadata, whole_table, decision in decisions:
+        if not decision["ids"]:
+            continue
+
+        table = parse_table(header, whole_table, columns=decision["ids"])
+        for type1, choice in decision["types"].items():
+            if choice["banned"] or choice["column"] is None:
+                continue
+            cols = choice["columns"]
+            tab1 = table_columns(table, [RA, DEC] + cols)
+            tab1 = tab1[reduce(operator.or_, [~tab1[col].mask for col in cols])]
+            if type1 == "velocity":
+                for col in cols:
+                    tab1 = vel2redshift(tab1, col)
+            if len(tab1) > 0:
+                tab1.meta["redshift_column"] = choice["column"]
+                cat_lists[type1].append(tab1)
+        del table
+    return cat_lists
+
+
+def get_cache(config):
+    """
+    Set up the on-disk cache of region query responses
+    Input:
+        config: configuration
+    Return:
+        ResponseCache, or None if caching is switched off
+    """
+    if not config.use_cache:
+        return None
+    return ResponseCache(
+        config.cache_dir,
+        config.cache_size.to_value(u.byte),
+        config.cache_ttl.to_value(u.s),
+    )
+
+
+def target_key(target):
+    """
+    Describe the position of a query in a way that can be used in a cache key
+    Input:
+        target: either source name in string format or Astropy coordinate object
+    Return:
+        string with the target name or its ICRS coordinates in degrees
+    """
+    if isinstance(target, coord.SkyCoord):
+        return f"{target.icrs.ra.deg:.8f} {target.icrs.dec.deg:+.8f}"
+    return str(target)
+
+
+def download(service, fetch, metrics):
+    """
+    Download the response of a query, recording the time spent waiting for it
+    and its size
+    Input:
+        service: name of the archive, NED or Vizier
+        fetch: function without arguments that downloads the response
+        metrics: Metrics of the field
+    Return:
+        raw response in bytes
+    """
+    with metrics.stage(f"network.{service}", profile=False):
+        data = fetch()
+    metrics.count(f"bytes.{service}", len(data))
+    return data
+
+
+def cached_response(service, target, config, fetch, metrics=None, **params):
+    """
+    Return the raw response of a region query, from the on-disk cache if the
+    same query has been run before and has not expired. Otherwise, download
+    the response and add it to the cache.
+    Input:
+        service: name of the archive, NED or Vizier
+        target: either source name in string format or Astropy coordinate object
+        config: configuration
+        fetch: function without arguments that downloads the response
+        metrics: optional Metrics recording the downloads and cache hits
+        params: any other parameters of the query, e.g. UCD filter and columns
+    Return:
+        raw response in bytes
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    cache = get_cache(config)
+    if cache is None:
+        return download(service, fetch, metrics)
+
+    key = cache.key(
+        service=service,
+        target=target_key(target),
+        radius=config.radius.to_value(u.deg),
+        **params,
+    )
+    if not config.refresh_cache:
+        data = cache.get(key)
+        if data is not None:
+            metrics.count(f"cache_hits.{service}")
+            return data
+
+    data = download(service, fetch, metrics)
+    cache.put(key, data)
+    return data
+
+
+def fetch_vizier(
+    name, UCD, config, RA="_RAJ2000", DEC="_DEJ2000", metrics=None, **query
+):
+    """
+    Query a region of the Vizier catalogue database, or take the response from
+    the cache
+    Input:
+        name: name of the source to query region for
+        UCD: UCD expression selecting the catalogs to return
+        config: configuration
+        RA, DEC: optional, coordinates of RA and DEC columns
+        metrics: optional Metrics of the field
+        query: optional other options of the Vizier query, e.g. catalog,
+               columns, column_filters or row_limit; by default, all the
+               columns and rows of the catalogs are returned
+    Return:
+        raw VOTable response
+    """
+    # Calculate homogenized RA and DEC and return unlimited rows
+    columns = query.pop("columns", ["**", RA, DEC])
+    v = get_transport(config).vizier(
+        deadline(config, config.read_timeout),
+        columns=columns,
+        ucd=UCD,
+        **{"row_limit": -1, **query},
+    )
+
+    # Query a region using source name, return a XML response. The responses
+    # go through our own cache only, not through the astroquery one as well
+    return cached_response(
+        "Vizier",
+        name,
+        config,
+        lambda: v.query_region_async(name, radius=config.radius, cache=False).content,
+        metrics,
+        ucd=UCD,
+        columns=columns,
+        **query,
+    )
+
+
+def catalog_request(decision):
+    """
+    Columns and constraints of the query that downloads only what is needed of
+    a catalog, from the decision taken on its metadata
+    Input:
+        decision: decision of classify_catalog
+    Return:
+        None if nothing is needed from the catalog, or a tuple of the names of
+        the candidate redshift columns and the column filters of the query
+    """
+    choices = [
+        choice
+        for choice in decision["types"].values()
+        if not choice["banned"] and choice["column"] is not None
+    ]
+    if not choices:
+        return None
+    columns = []
+    for choice in choices:
+        columns += [col for col in choice["columns"] if col not in columns]
+
+    # Only the rows with a value in the chosen redshift column are used. Vizier
+    # constraints all have to be met, so if the searches chose different
+    # columns, the rows are selected locally.
+    chosen = {choice["column"] for choice in choices}
+    filters = {chosen.pop(): NOT_NULL} if len(chosen) == 1 else {}
+    return columns, filters
+
+
+def pruned_selections(
+    name,
+    UCD,
+    types,
+    config,
+    RA="_RAJ2000",
+    DEC="_DEJ2000",
+    metrics=None,
+    cancel=None,
+):
+    """
+    Preliminary selection with the pruning done by Vizier, see
+    prelim_selections. A first query returns a single row of every catalog in
+    the region, only to read the catalog metadata, and the catalogs are
+    classified locally. Only the coordinates and candidate redshift columns of
+    the catalogs that are kept are then downloaded, with one query per
+    catalog and only the rows with a redshift.
+    Input:
+        name: name of the source to query region for
+        UCD: UCD expression selecting the catalogs to return
+        types: dictionary of type (redshift or velocity) and its UCD keywords
+        config: configuration
+        RA, DEC: names of the RA and DEC columns
+        metrics: optional Metrics of the field
+        cancel: optional threading.Event; once set, the catalog queries that
+                have not started yet are skipped, see check_cancelled
+    Return:
+        dictionary of type and list of selected tables, as prelim_selections
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    metadata_response = fetch_vizier(name, UCD, config, RA, DEC, metrics, row_limit=1)
+    check_cancelled(cancel)
+
+    queries = []
+    with metrics.stage("parse.Vizier"):
+        decisions = catalog_decisions(
+            metadata_response, types, RA, DEC, config, metrics
+        )
+        for header, metadata, whole_table, decision in decisions:
+            request = catalog_request(decision)
+            if request is not None:
+                queries.append((table_name(metadata), *request))
+    metrics.count("Vizier.catalog_queries", len(queries))
+
+    def fetch(request):
+        check_cancelled(cancel)
+        catalog, columns, filters = request
+        return fetch_vizier(
+            name,
+            "",
+            config,
+            RA,
+            DEC,
+            metrics,
+            catalog=catalog,
+            columns=[RA, DEC, *columns],
+            column_filters=filters,
+        )
+
+    # The catalogs were already counted on their metadata, so the selection of
+    # the downloaded tables does not count them again
+    cat_lists = {type1: [] for type1 in types}
+    with ThreadPoolExecutor(max_workers=config.vizier_workers) as executor:
+        for response in executor.map(fetch, queries):
+            check_cancelled(cancel)
+            with metrics.stage("parse.Vizier"):
+                selected = prelim_selections(response, types, RA, DEC, config)
+            for type1, cat_list in selected.items():
+                cat_lists[type1] += cat_list
+    return cat_lists
+
+
+def process_vizier(
+    cat_list, type1, config, RA="_RAJ2000", DEC="_DEJ2000", z="Redshift", metrics=None
+):
+    """
+    Turn the tables selected from a Vizier response into a single table of
+    redshift measurements
+    Input:
+        cat_list: tables kept by the preliminary selection
+        type1: redshift of velocity query
+        config: configuration
+        RA, DEC: coordinates of RA and DEC columns
+        z: name of the redshift column
+        metrics: optional Metrics of the field
+    Return:
+        Final table containing 4 columns, RA, DEC, redshift and origin of
+        redshift measurement, or None if nothing was found
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    with metrics.stage("filter.Vizier"):
+        # Find whether the catalogue contains relevant information and save the
+        # column with the relevant data
+        candidates = [
+            process_catalog(type1, cat, config, RA, DEC, metrics) for cat in cat_list
+        ]
+        candidates = [part for part in candidates if part is not None]
+
+        # Remove potential photoz's by removing measurements with little
+        # precision. The precision is judged on the redshifts as they are in the
+        # stacked table, in the dtype common to all the catalogs: a float32
+        # value reads differently once stacked with float64 ones
+        parts = []
+        if candidates:
+            z_dtype = np.result_type(*[part.z.dtype for part in candidates])
+        for part in candidates:
+            precise = precise_redshifts(part.z.astype(z_dtype))
+            metrics.count(
+                f"{type1}.rows_photoz", np.count_nonzero(part.keep & ~precise)
+            )
+            parts.append(part._replace(keep=part.keep & precise))
+
+        # Build a single table with the relevant data of all the catalogues
+        table = assemble(parts, z=z)
+    metrics.count(f"{type1}.rows_kept", 0 if table is None else len(table))
+    return table
+
+
+def query_vizier(
+    name,
+    type1,
+    config,
+    RA="_RAJ2000",
+    DEC="_DEJ2000",
+    z="Redshift",
+    metrics=None,
+    cancel=None,
+):
     """
     Use astroquery to query the Vizier catalogue database
     Input:
@@ -288,13 +858,16 @@ def query_vizier(name, type1, config, RA="_RAJ2000", DEC="_DEJ2000", z="Redshift
         config: configuration
         RA, DEC: optional, coordinates of RA and DEC columns; defaults to vizier
                  names which point to RA and DEC homogenized to deg and J2000
+        metrics: optional Metrics of the field
+        cancel: optional threading.Event stopping the search, see
+                check_cancelled
     Return:
         Final table containing 4 columns, RA, DEC, redshift and origin of 
         redshift measurement, compiled from all data available of Vizier
     """
+    metrics = metrics if metrics is not None else Metrics()
 
-    # Setup the column and keywords used for the selection; calculate
-    # homogenized RA and DEC and return unlimited rows
+    # Setup the column and keywords used for the selection
     if type1 == "velocity":
         UCD = VELOCITY_SRC
         KEYS = VELOCITY_KEYS
@@ -302,41 +875,63 @@ def query_vizier(name, type1, config, RA="_RAJ2000", DEC="_DEJ2000", z="Redshift
         UCD = REDSHIFT_SRC
         KEYS = REDSHIFT_KEYS
 
-    v = Vizier(columns=["**", RA, DEC], ucd=UCD, row_limit=-1, timeout=timeout,)
-
-    # Query a region using source name, return a XML response and process
-    # through Astropy as VOTABLE
-    cat_vot = parse(
-        BytesIO(v.query_region_async(name, radius=config.radius).text.encode()),
-        pedantic=False,
-        invalid="mask",
-    )
-
     # Make a preliminary selection of columns to keep only RA, DEC and the
     # possible redshift columns
-    cat_list = prelim_selection(cat_vot, type1, RA, DEC, KEYS)
+    if config.prune_vizier:
+        cat_list = pruned_selections(
+            name, UCD, {type1: KEYS}, config, RA, DEC, metrics, cancel
+        )[type1]
+    else:
+        response = fetch_vizier(name, UCD, config, RA, DEC, metrics)
+        check_cancelled(cancel)
+        with metrics.stage("parse.Vizier"):
+            cat_list = prelim_selection(response, type1, RA, DEC, KEYS, config, metrics)
 
-    # Initialize a list of table to be appended; These will be tables that have
-    # a redshift measurement
-    table_list = []
-    # Find whether the catalogue contains relevant information and save the
-    # column with the relevant data
-    for cat in cat_list:
-        final_cat = process_catalog(type1, cat, config, RA, DEC)
-        if final_cat is not None:
-            table_list.append(final_cat)
-
-    # Stack all the final catalogues with the relevant data
-    if table_list:
-        grand_table = vstack(table_list)
+    return process_vizier(cat_list, type1, config, RA, DEC, z, metrics)
 
-        # Remove potential photoz's by removing measurements with little precision
-        grand_table = remove_potential_photoz(grand_table, z)
 
-        # Return results of the vizier search
-        return grand_table
+def query_vizier_combined(
+    name,
+    config,
+    RA="_RAJ2000",
+    DEC="_DEJ2000",
+    z="Redshift",
+    metrics=None,
+    cancel=None,
+):
+    """
+    Run the redshift and velocity searches of Vizier with a single query. The
+    catalogs matching either UCD are fetched once and split locally into the
+    two searches; a catalog with both redshifts and velocities contributes to
+    both, as it would with two separate queries.
+    Input:
+        name: name of the source to query region for
+        config: configuration
+        RA, DEC: optional, coordinates of RA and DEC columns
+        z: name of the redshift column
+        metrics: optional Metrics of the field
+        cancel: optional threading.Event stopping the search, see
+                check_cancelled
+    Return:
+        dictionary with the final table (or None) of the redshift and of the
+        velocity search
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    UCD = f"{REDSHIFT_SRC}|{VELOCITY_SRC}"
+    types = {"redshift": REDSHIFT_KEYS, "velocity": VELOCITY_KEYS}
+    if config.prune_vizier:
+        cat_lists = pruned_selections(
+            name, UCD, types, config, RA, DEC, metrics, cancel
+        )
     else:
-        return None
+        response = fetch_vizier(name, UCD, config, RA, DEC, metrics)
+        check_cancelled(cancel)
+        with metrics.stage("parse.Vizier"):
+            cat_lists = prelim_selections(response, types, RA, DEC, config, metrics)
+    return {
+        type1: process_vizier(cat_list, type1, config, RA, DEC, z, metrics)
+        for type1, cat_list in cat_lists.items()
+    }
 
 
 def fix_coord_units(cat, RA, DEC):
@@ -354,7 +949,7 @@ def fix_coord_units(cat, RA, DEC):
     return cat
 
 
-def filter_ned_cat(cat, RA, DEC):
+def filter_ned_cat(cat, RA, DEC, rules=DEFAULT_RULES):
     """
     Filter the NED catalogue to include only sources that have redshift 
     measurements, remove photometric redshifts labelled as such and remove 
@@ -362,6 +957,8 @@ def filter_ned_cat(cat, RA, DEC):
     Input:
         cat: catalogue in question in Astropy table format
         RA, DEC: string names of the columns for which units need to be fixed
+        rules: selection rules with the NED types and flags to remove, see
+               rules.Rules
     Return:
         catalogue with correct units, with rows containing redshift and without
         clusters
@@ -371,47 +968,227 @@ def filter_ned_cat(cat, RA, DEC):
     # Select only lines that have a redshift measurement
     cat = cat[~cat["Redshift"].mask]
 
-    # Remove Galaxy Clusters and Groups and redshifts labelled as photometric
-    exclude_type = reduce(
-        operator.and_, [(cat["Type"] != type_) for type_ in NED_TYPES]
-    )
-    exclude_flag = reduce(
-        operator.and_, [(cat["Redshift Flag"] != flag) for flag in NED_FLAGS]
-    )
+    # Remove Galaxy Clusters and Groups and redshifts labelled as photometric,
+    # with a single membership test per column. The columns are compared as
+    # str, whether the VOTable parser returned them as str or bytes
+    exclude = np.isin(as_text(cat["Type"]), rules.ned_types)
+    exclude |= np.isin(as_text(cat["Redshift Flag"]), rules.ned_flags)
+
+    return cat[~exclude]
+
+
+# Errors from the connection to NED that are worth retrying
+TRANSIENT_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.ChunkedEncodingError,
+    # Raised by the transport for server errors only
+    requests.exceptions.HTTPError,
+    ConnectionError,
+    TimeoutError,
+)
+
+
+class RateLimiter:
+    """
+    Space out requests sent from several threads, such that at most rate
+    requests are started every second. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+        self.lock = threading.Lock()
+        self.next_slot = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_slot)
+            self.next_slot = slot + self.interval
+        time.sleep(slot - now)
+
+
+# All NED lookups of this process share the same rate limit, also when several
+# fields or tiles are verified at the same time
+_ned_limiters = {}
+_ned_limiters_lock = threading.Lock()
 
-    exclude = exclude_type & exclude_flag
 
-    return cat[exclude]
+def ned_limiter(rate):
+    """
+    Return the rate limiter shared by all the NED lookups at a given rate
+    Input:
+        rate: maximum number of requests per second
+    Return:
+        RateLimiter instance
+    """
+    with _ned_limiters_lock:
+        return _ned_limiters.setdefault(rate, RateLimiter(rate))
 
 
-def redshift_type(line, RA, DEC, un):
+def get_ned_redshifts(
+    object_name, ned, retries=0, backoff=1.0, limiter=None, metrics=None
+):
+    """
+    Download the table of redshift measurements of a single NED object.
+    Connection problems and timeouts are retried, waiting twice as long before
+    each new attempt.
+    Input:
+        object_name: NED object name
+        ned: astroquery NED client
+        retries: number of times to retry a failed request
+        backoff: time in seconds to wait before the first retry
+        limiter: optional RateLimiter shared by all the requests
+        metrics: optional Metrics; the requests are timed as
+                 network.NED_objects, the waits for the rate limit as
+                 wait.NED_rate and the waits before a retry as wait.NED_retry
+    Return:
+        table of redshift measurements of the object
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            with metrics.stage("wait.NED_rate", profile=False):
+                limiter.wait()
+        try:
+            with metrics.stage("network.NED_objects", profile=False):
+                return ned.get_table(object_name, table="redshifts")
+        except TRANSIENT_ERRORS:
+            if attempt == retries:
+                raise
+            with metrics.stage("wait.NED_retry", profile=False):
+                time.sleep(backoff * 2 ** attempt)
+
+
+def redshift_uncertainty(
+    object_name, ned, retries=0, backoff=1.0, limiter=None, metrics=None
+):
     """
     Determine which type of redshift a source has associated with it. We do this
-    by doing a targeted search on each source and checking its redshift 
-    measurements. If there is no such table, or if the error on the redshift
-    measurement is large, then the measurement is either missing or there are
-    very large errors (ie the redshift is photometric). Return the line if the 
-    values are good
+    by doing a targeted search on each source and checking its redshift
+    measurements. If the error on every redshift measurement is large, then the
+    redshift is photometric.
     Input:
-        line: line in original NED batch search
+        object_name: NED object name
+        ned, retries, backoff, limiter, metrics: see get_ned_redshifts
     Return
-        return line of the table if it contains good spectroscopic redshift; 
-        else, return None
+        smallest published uncertainty of the redshift measurements of the
+        source, or None if none of them has an uncertainty. Raise an exception
+        if the redshift table of the source could not be retrieved from NED.
     """
-    try:
-        result_table = Ned.get_table(line["Object Name"], table="redshifts")
-    except:
+    result_table = get_ned_redshifts(
+        object_name, ned, retries, backoff, limiter, metrics
+    )
+    uncertainty = np.ma.masked_invalid(result_table["Published Redshift Uncertainty"])
+    if uncertainty.count() == 0:
         return None
-    if any(result_table["Published Redshift Uncertainty"] < un):
-        return line[RA, DEC, "Redshift"]
-    else:
+    return float(uncertainty.min())
+
+
+def get_verdict_store(config):
+    """
+    Return the database of NED redshift uncertainties
+    Input:
+        config: configuration
+    Return:
+        VerdictStore, or None if the database is switched off
+    """
+    if not config.ned_verdicts:
         return None
+    return VerdictStore(os.path.join(config.cache_dir, "ned_verdicts.sqlite"))
+
+
+def verify_ned_objects(cat, config, RA="RA", DEC="DEC", metrics=None, cancel=None):
+    """
+    Check the redshift type of every source of a NED region search. Sources
+    with a recent verdict in the verdict database are answered from it; the
+    others are looked up with redshift_uncertainty, in parallel over
+    config.ned_workers threads and at most config.ned_rate requests per second,
+    and their verdict is stored.
+    Input:
+        cat: filtered NED catalogue
+        config: configuration
+        RA, DEC: names of the RA and DEC columns
+        metrics: optional Metrics recording the time spent on the lookups
+        cancel: optional threading.Event; once set, the lookups that have not
+                started yet are skipped, see check_cancelled
+    Return:
+        boolean array which is True for sources with a spectroscopic redshift
+        and array with the reason why a source could not be verified, i.e. the
+        lookup failed on a connection problem, a timeout or a server error
+        (empty string for sources that were verified)
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    names = as_text(cat["Object Name"]).tolist()
+    store = get_verdict_store(config)
+    known = {}
+    if store is not None and names and not config.refresh_cache:
+        known = store.get(names, config.ned_verdict_ttl.to_value(u.s))
+
+    limiter = ned_limiter(config.ned_rate)
+    backoff = config.ned_backoff.to_value(u.s)
+    ned = get_transport(config).ned(deadline(config, config.lookup_timeout))
+
+    def verify(name):
+        if cancel is not None and cancel.is_set():
+            return None, "cancelled"
+        try:
+            uncertainty = redshift_uncertainty(
+                name, ned, config.ned_retries, backoff, limiter, metrics
+            )
+            return uncertainty, ""
+        except TRANSIENT_ERRORS as e:
+            return None, f"{type(e).__name__}: {e}"
+        except Exception:
+            # NED answered, but without a table of redshift measurements for
+            # the object: asking again gives the same answer, so the object is
+            # taken as having no published uncertainty and the verdict stored
+            metrics.count("NED.objects_without_redshifts")
+            return None, ""
+
+    # Look up only the sources without a verdict
+    uncertainties = [known.get(name) for name in names]
+    reasons = [""] * len(names)
+    todo = [i for i, name in enumerate(names) if name not in known]
+    with ThreadPoolExecutor(max_workers=config.ned_workers) as executor:
+        results = executor.map(verify, [names[i] for i in todo])
+        for i, (uncertainty, reason) in zip(todo, results):
+            uncertainties[i], reasons[i] = uncertainty, reason
+    check_cancelled(cancel)
+    metrics.count("NED.verdicts_reused", len(names) - len(todo))
+
+    if store is not None:
+        store.put({names[i]: uncertainties[i] for i in todo if reasons[i] == ""})
+
+    spectroscopic = np.array(
+        [unc is not None and unc < config.uncertainty for unc in uncertainties],
+        dtype=bool,
+    )
+    return spectroscopic, np.array(reasons, dtype=str)
 
 
 class NedQueryFailed(Exception):
     pass
 
 
+class QueryCancelled(Exception):
+    """
+    The query of a source was cancelled, as it went over its deadline
+    """
+
+
+def check_cancelled(cancel):
+    """
+    Stop the query of a source that went over its deadline: the query checks
+    the event before each new request and before adding to the results of the
+    field
+    Input:
+        cancel: threading.Event, or None if the query cannot be cancelled
+    """
+    if cancel is not None and cancel.is_set():
+        raise QueryCancelled()
+
+
 def query_NED(
     name,
     config,
@@ -421,6 +1198,9 @@ def query_NED(
     RAf="RA",
     DECf="DEC",
     origin="Origin",
+    unverified=None,
+    metrics=None,
+    cancel=None,
 ):
     """
     Use astroquery to query the NED database
@@ -429,97 +1209,667 @@ def query_NED(
         config: configuration
         RA, DEC: optional, coordinates of RA and DEC columns; defaults to vizier
                  names which point to RA and DEC homogenized to deg and J2000    
+        unverified: optional list; a table of the sources whose redshift type
+                    could not be checked against NED is appended to it
+        metrics: optional Metrics of the field
+        cancel: optional threading.Event stopping the search, see
+                check_cancelled
     Return:
         Final table containing 4 columns, RA, DEC, redshift and origin of 
         redshift measurement, compiled from all data available of Vizier
     """
+    metrics = metrics if metrics is not None else Metrics()
+
     # Query NED for the region around source within radius
+    ned = get_transport(config).ned(deadline(config, config.read_timeout))
     try:
-        ned_result = Ned.query_region_async(name, radius=config.radius).text.encode()
+        ned_result = cached_response(
+            "NED",
+            name,
+            config,
+            lambda: ned.query_region_async(name, radius=config.radius).content,
+            metrics,
+        )
     except Exception as e:
         print(e)
         raise NedQueryFailed()
+    check_cancelled(cancel)
 
-    cat_vot = parse(BytesIO(ned_result), pedantic=False, invalid="mask")
-    cat_vot = cat_vot.get_first_table().to_table(use_names_over_ids=True)
+    with metrics.stage("parse.NED"):
+        cat_vot = parse(BytesIO(ned_result), pedantic=False, invalid="mask")
+        cat_vot = cat_vot.get_first_table().to_table(use_names_over_ids=True)
 
     # Filter the catalog, to remove useless rows
-    filtered_cat = filter_ned_cat(cat_vot, RA, DEC)
-    # Initialize a list of table to be appended; These will be table that have
-    # a redshift measurement
-    row_list = []
+    with metrics.stage("filter.NED"):
+        filtered_cat = filter_ned_cat(cat_vot, RA, DEC, config.rules)
+    metrics.count("NED.rows", len(cat_vot))
+    metrics.count("NED.rows_filtered", len(cat_vot) - len(filtered_cat))
 
     # Do another NED targeted search on each of the targets to check what type
     # of redshift it has associated
-    for line in filtered_cat:
-        if redshift_type(line, RA, DEC, config.uncertainty) is not None:
-            row_list.append(line[RA, DEC, "Redshift"])
+    with metrics.stage("verify.NED"):
+        spectroscopic, reasons = verify_ned_objects(
+            filtered_cat, config, RA, DEC, metrics, cancel
+        )
+    metrics.count("NED.verified", np.count_nonzero(reasons == ""))
+    metrics.count("NED.unverified", np.count_nonzero(reasons != ""))
+    metrics.count("NED.rows_kept", np.count_nonzero(spectroscopic))
+
+    # Keep track of the sources for which NED could not be queried
+    failed = reasons != ""
+    if unverified is not None and any(failed):
+        failed_cat = filtered_cat["Object Name", RA, DEC, "Redshift"][failed]
+        # Names of variable length come as objects, which FITS cannot store
+        failed_cat["Object Name"] = failed_cat["Object Name"].astype(str)
+        failed_cat.add_column(Column(reasons[failed]), name="Reason")
+        unverified.append(failed_cat)
+
+    if not any(spectroscopic):
+        return None
+
+    # Keep the spectroscopic redshifts, with names matching the general choice
+    # and NED as origin
+    part = Part(
+        filtered_cat[RA],
+        filtered_cat[DEC],
+        filtered_cat["Redshift"],
+        spectroscopic,
+        "NED",
+    )
+    return assemble([part], RAf, DECf, z, origin)
+
+
+# Sources queried for each field: description stored in the table metadata and
+# suffix of the intermediate fits file written for each of them
+SOURCES = {
+    "NED": ("NED", "NED"),
+    "redshift": ("Vizier redshifts", "vizier_redshift"),
+    "velocity": ("Vizier velocity", "vizier_velocity"),
+}
+
+
+def source_groups(config):
+    """
+    Group the sources by the query that answers them: the two Vizier searches
+    share a single query when config.combined_vizier is set
+    Input:
+        config: configuration
+    Return:
+        list of tuples of source names
+    """
+    if config.combined_vizier:
+        return [("NED",), ("redshift", "velocity")]
+    return [(source,) for source in SOURCES]
+
+
+def query_source(sources, target, config, unverified=None, metrics=None, cancel=None):
+    """
+    Run a single query for redshift measurements
+    Input:
+        sources: tuple of sources answered by the query, see source_groups
+        target: either source name in string format or Astropy coordinate object
+        config: configuration
+        unverified: optional list collecting NED sources that could not be
+                    verified, see query_NED
+        metrics: optional Metrics of the field
+        cancel: optional threading.Event stopping the query, see
+                check_cancelled
+    Return:
+        dictionary of source name and table with the redshift measurements
+        found in that source or None
+    """
+    if sources == ("NED",):
+        return {
+            "NED": query_NED(
+                target, config, unverified=unverified, metrics=metrics, cancel=cancel
+            )
+        }
+    if len(sources) > 1:
+        return query_vizier_combined(target, config, metrics=metrics, cancel=cancel)
+    return {
+        sources[0]: query_vizier(
+            target, sources[0], config, metrics=metrics, cancel=cancel
+        )
+    }
 
-    # Vstack all the lines into a single catalogue
-    if not row_list:
+
+def query_sources_concurrently(target, config, unverified=None, metrics=None):
+    """
+    Query NED and Vizier at the same time, each query in its own thread. Wait
+    for each of them at most config.source_deadline after the start of the
+    search; sources that do not answer in time are skipped with a warning and
+    left out of the results. Their request in flight is left to finish in its
+    thread, but the rest of their work, e.g. the NED lookups, is cancelled, and
+    the NED sources they could not verify are not reported.
+    Input:
+        target: either source name in string format or Astropy coordinate object
+        config: configuration
+        unverified: optional list collecting NED sources that could not be
+                    verified, see query_NED
+        metrics: optional Metrics of the field
+    Return:
+        dictionary of source name and table (or None) for each source that
+        answered in time
+    """
+    deadline = time.monotonic() + config.source_deadline.to_value(u.s)
+    groups = source_groups(config)
+    cancel = threading.Event()
+    # Each query collects its unverified NED sources apart, such that a query
+    # that answers late does not add to them
+    unverified_lists = {sources: [] for sources in groups}
+    executor = ThreadPoolExecutor(max_workers=len(groups))
+    futures = {
+        sources: executor.submit(
+            query_source,
+            sources,
+            target,
+            config,
+            unverified_lists[sources],
+            metrics,
+            cancel,
+        )
+        for sources in groups
+    }
+    results = {}
+    try:
+        for sources, future in futures.items():
+            try:
+                results.update(
+                    future.result(timeout=max(0, deadline - time.monotonic()))
+                )
+                if unverified is not None:
+                    unverified.extend(unverified_lists[sources])
+            except FutureTimeout:
+                future.cancel()
+                description = " and ".join(SOURCES[source][0] for source in sources)
+                print(
+                    Fore.YELLOW
+                    + f"Warning: {description} did not answer within "
+                    + f"{config.source_deadline}, skipping it."
+                )
+    finally:
+        # Stop the work of the sources that went over the deadline, without
+        # waiting for their request in flight
+        cancel.set()
+        executor.shutdown(wait=False)
+    return results
+
+
+def query_sources(target, config, unverified=None, metrics=None):
+    """
+    Query all sources for redshift measurements, either concurrently or one
+    after the other depending on the configuration
+    Input:
+        target: either source name in string format or Astropy coordinate object
+        config: configuration
+        unverified: optional list collecting NED sources that could not be
+                    verified, see query_NED
+        metrics: optional Metrics of the field
+    Return:
+        dictionary of source name and table (or None) for each source; sources
+        that went over their deadline are left out
+    """
+    if config.concurrent_queries:
+        return query_sources_concurrently(target, config, unverified, metrics)
+    results = {}
+    for sources in source_groups(config):
+        results.update(query_source(sources, target, config, unverified, metrics))
+    return results
+
+
+def query_tile(
+    cell, order, path, name, config, unverified=None, incomplete=None, metrics=None
+):
+    """
+    Query all sources over a single HEALPix cell of a tiled search. The cone
+    queried around the cell covers the whole cell and the results are trimmed
+    to the cell itself, such that neighbouring tiles do not share sources. The
+    tile is saved in the tiles directory of the field and read back from there
+    when an interrupted search is restarted.
+    Input:
+        cell: nested index of the HEALPix cell
+        order: HEALPix order of the cell
+        path, name: location and base name of the field
+        config: configuration
+        unverified: optional list collecting NED sources that could not be
+                    verified, see query_NED
+        incomplete: optional list collecting the cells for which not all
+                    sources answered or not all NED sources were verified
+        metrics: optional Metrics of the field
+    Return:
+        table with all the measurements inside the cell, with an extra Source
+        column saying which source each row comes from
+    """
+    tile_file = f"{path}/{name}/tiles/{name}_tile_{order}_{cell}.fits"
+    if os.path.exists(tile_file):
+        return Table.read(tile_file)
+
+    center, radius = tiles.cell_cone(cell, order)
+    tile_unverified = []
+    results = query_sources(
+        center, replace(config, radius=radius), tile_unverified, metrics
+    )
+    if unverified is not None:
+        unverified.extend(tile_unverified)
+
+    table_list = []
+    for source, table in results.items():
+        if table is not None:
+            table = table[tiles.in_cell(table, cell, order)]
+            table.add_column(Column(np.full(len(table), source)), name="Source")
+            table_list.append(table)
+    if table_list:
+        tile = vstack(table_list)
+    else:
+        tile = Table(
+            names=["RA", "DEC", "Redshift", "Origin", "Source"],
+            dtype=[float, float, float, "U1", "U1"],
+        )
+
+    # Only save complete tiles, such that sources that went over their deadline
+    # and NED sources that could not be verified are queried again in the next
+    # run
+    if len(results) == len(SOURCES) and not tile_unverified:
+        tile.write(tile_file, overwrite=True)
+    elif incomplete is not None:
+        incomplete.append(f"tile {cell}")
+    return tile
+
+
+def query_tiles(
+    target,
+    path,
+    name,
+    config,
+    unverified=None,
+    incomplete=None,
+    metrics=None,
+    cells=None,
+):
+    """
+    Split a search with a large radius into HEALPix cells of about
+    config.tile_size and query the cells in parallel, over config.tile_workers
+    threads. The tiles are merged and trimmed to the search radius.
+    Input:
+        target: either source name in string format or Astropy coordinate object
+        path, name: location and base name of the field
+        config: configuration
+        unverified: optional list collecting NED sources that could not be
+                    verified, see query_NED
+        incomplete: optional list collecting the cells for which not all
+                    sources answered
+        metrics: optional Metrics of the field
+        cells: optional subset of the cells to query, e.g. the cells not yet
+               in the master store; by default all cells of the search
+    Return:
+        dictionary of source name and table (or None) for each source
+    """
+    if not isinstance(target, coord.SkyCoord):
+        target = coord.SkyCoord.from_name(target)
+    order = tiles.tile_order(config.tile_size)
+    if cells is None:
+        cells = tiles.tile_cells(target, config.radius, order)
+    if not os.path.exists(f"{path}/{name}/tiles"):
+        os.makedirs(f"{path}/{name}/tiles")
+    print(f"Splitting the search into {len(cells)} tiles...")
+
+    with ThreadPoolExecutor(max_workers=config.tile_workers) as executor:
+        tile_list = list(
+            executor.map(
+                lambda cell: query_tile(
+                    cell, order, path, name, config, unverified, incomplete, metrics
+                ),
+                cells,
+            )
+        )
+
+    merged = vstack(tile_list)
+    merged = merged[tiles.in_cone(merged, target, config.radius)]
+
+    # Split the merged table back into the different sources
+    results = {}
+    for source in SOURCES:
+        table = merged[merged["Source"] == source]
+        table.remove_column("Source")
+        results[source] = table if len(table) > 0 else None
+    return results
+
+
+def get_store(config):
+    """
+    Return the master store of a configuration
+    Input:
+        config: configuration
+    Return:
+        MasterStore, or None if the master store is switched off
+    """
+    if not config.master_store:
         return None
+    key = ResponseCache.key(
+        settings=config_subset(config, STORE_SETTINGS), order=config.store_order
+    )
+    return MasterStore(os.path.join(config.store_dir, key[:16]), config.store_order)
 
-    final_cat = vstack(row_list)
 
-    # Rename columns to match general choice
-    final_cat.rename_column("Redshift", z)
-    final_cat.rename_column(RA, RAf)
-    final_cat.rename_column(DEC, DECf)
+def query_stored(target, path, name, config, store, unverified, missing, metrics=None):
+    """
+    Search with the master store: the part of the search covered by every
+    source is answered from the store, and only the rest is queried. With
+    tiling, only the tiles that overlap a cell that is not covered yet are
+    queried; otherwise a single cone is queried around those cells. The
+    results of the sources that answered completely then replace those in the
+    store over the queried region.
+    Input:
+        target: either source name in string format or Astropy coordinate object
+        path, name: location and base name of the field
+        config: configuration
+        store: MasterStore of the configuration
+        unverified: list collecting NED sources that could not be verified,
+                    see query_NED
+        missing: list collecting the sources or tiles that did not answer
+        metrics: optional Metrics of the field
+    Return:
+        dictionary of source name and table (or None) for each source; sources
+        that did not answer are left out
+    """
+    metrics = metrics if metrics is not None else Metrics()
+    if not isinstance(target, coord.SkyCoord):
+        target = coord.SkyCoord.from_name(target)
+    order = store.order
+    cells = tiles.tile_cells(target, config.radius, order)
+    if config.refresh_cache:
+        covered = {source: np.zeros(len(cells), dtype=bool) for source in SOURCES}
+    else:
+        covered = {
+            source: store.covered(source, cells, target, config.radius)
+            for source in SOURCES
+        }
+    uncovered = cells[~reduce(operator.and_, covered.values())]
+    metrics.count("store.cells", len(cells))
+    metrics.count("store.cells_covered", len(cells) - len(uncovered))
+
+    # Query the cells that are not covered by every source, and find the region
+    # that the query covers: the cells of the store order that overlap with it,
+    # a function selecting the rows inside it, and the cells entirely inside it
+    fresh = {}
+    tiled = config.tile_size is not None and config.radius > config.tile_size
+    if len(uncovered) > 0 and tiled:
+        tile_order = tiles.tile_order(config.tile_size)
+        tile_cells = tiles.tile_cells(target, config.radius, tile_order)
+        if tile_order <= order:
+            shift = 2 * (order - tile_order)
+            tile_cells = np.intersect1d(tile_cells, uncovered >> shift)
+            region = cells[np.isin(cells >> shift, tile_cells)]
+        else:
+            shift = 2 * (tile_order - order)
+            tile_cells = tile_cells[np.isin(tile_cells >> shift, uncovered)]
+            region = uncovered
+        fresh = query_tiles(
+            target, path, name, config, unverified, missing, metrics, tile_cells
+        )
+
+        def inside(table):
+            queried_tile = np.isin(tiles.cell_index(table, tile_order), tile_cells)
+            return queried_tile & tiles.in_cone(table, target, config.radius)
+
+        queried = np.intersect1d(
+            region, tiles.cells_inside(target, config.radius, order)
+        )
+        cones = [(target, config.radius)]
+    elif len(uncovered) > 0:
+        center, radius = tiles.cells_cone(uncovered, order)
+        if radius >= config.radius:
+            center, radius = target, config.radius
+        fresh = query_sources(
+            center, replace(config, radius=radius), unverified, metrics
+        )
+        missing.extend(SOURCES[s][0] for s in SOURCES if s not in fresh)
+        region = tiles.tile_cells(center, radius, order)
 
-    # Add origin column as NED
-    final_cat.add_column(Column(["NED"] * len(final_cat)), name=origin)
+        def inside(table):
+            return tiles.in_cone(table, center, radius)
 
-    return final_cat
+        queried = tiles.cells_inside(center, radius, order)
+        cones = [(center, radius), (target, config.radius)]
 
+    # Store what the sources found, unless results are missing; together with
+    # the covered cells, the query covers the whole search
+    for source, table in fresh.items():
+        if (tiled and missing) or (source == "NED" and unverified):
+            continue
+        with metrics.stage("store"):
+            store.put(source, table, region, inside, queried, cones)
 
-def query_redshift(target, path, name, config):
+    # Take the covered cells from the store and the others from the query
+    results = {}
+    for source in SOURCES:
+        if not covered[source].all() and source not in fresh:
+            continue
+        parts = []
+        with metrics.stage("store"):
+            stored = store.rows(source, cells[covered[source]])
+        if stored is not None:
+            metrics.count("store.rows", len(stored))
+            parts.append(stored[tiles.in_cone(stored, target, config.radius)])
+        table = fresh.get(source)
+        if table is not None:
+            cell = tiles.cell_index(table, order)
+            keep = ~np.isin(cell, cells[covered[source]])
+            keep &= tiles.in_cone(table, target, config.radius)
+            parts.append(table[keep])
+        parts = [part for part in parts if len(part) > 0]
+        results[source] = vstack(parts) if parts else None
+    return results
+
+
+def query_redshift(target, path, name, config, incomplete=None, metrics=None):
     """
     Perform an astroquery search of NED and Vizier for spectroscopic redshift 
-    measurements. 
+    measurements. Searches with a radius larger than config.tile_size are
+    split into tiles that are queried in parallel. With config.master_store,
+    the part of the search covered by earlier searches is taken from the
+    master store, see query_stored.
     Input: 
         target: either source name in string format or Astropy coordinate object
         path: path where to write the fits file with redshifts
         name: base name for the fits files containing the redshifts (can be the 
               target name)
         config: configuration
+        incomplete: optional list collecting what is missing from the results:
+                    sources or tiles that did not answer in time and NED
+                    sources that could not be verified
+        metrics: optional Metrics of the field
     Return:
         stacked table with all redshift measurements. Will most likely contain 
-        duplicated sources
-    """
-    # Query NED for redshifts
-    tab_NED = query_NED(target, config)
-    if tab_NED is not None:
-        tab_NED.meta["description"] = "NED"
-        tab_NED.write(f"{path}/{name}/{name}_NED.fits", overwrite=True)
-    print("Done querying NED...")
-    # Query Vizier for redshift columns
-    tab_redshift = query_vizier(target, "redshift", config)
-    if tab_redshift is not None:
-        tab_redshift.meta["description"] = "Vizier redshifts"
-        tab_redshift.write(f"{path}/{name}/{name}_vizier_redshift.fits", overwrite=True)
-    print("Done quering Vizier for redshifts...")
-    # Query Vizier for velocity columns
-    tab_velocity = query_vizier(target, "velocity", config)
-    if tab_velocity is not None:
-        tab_velocity.meta["description"] = "Vizier velocity"
-        tab_velocity.write(f"{path}/{name}/{name}_vizier_velocity.fits", overwrite=True)
-    print("Done querying Vizier for velocities...")
+        duplicated sources. None if no redshifts were found
+    """
+    unverified = []
+    missing = []
+    store = get_store(config)
+    if store is not None:
+        results = query_stored(
+            target, path, name, config, store, unverified, missing, metrics
+        )
+    elif config.tile_size is not None and config.radius > config.tile_size:
+        results = query_tiles(target, path, name, config, unverified, missing, metrics)
+    else:
+        results = query_sources(target, config, unverified, metrics)
+        missing = [SOURCES[source][0] for source in SOURCES if source not in results]
+
+    # Write out the results of each source, if requested; remove the files left
+    # by an earlier run for sources that found nothing this time
+    for source, (description, suffix) in SOURCES.items():
+        source_file = f"{path}/{name}/{name}_{suffix}.fits"
+        if results.get(source) is not None:
+            results[source].meta["description"] = description
+            if config.keep_intermediates:
+                results[source].write(source_file, overwrite=True)
+        elif source in results and os.path.exists(source_file):
+            os.remove(source_file)
+
+    if incomplete is not None:
+        incomplete.extend(missing)
+        if unverified:
+            incomplete.append("NED verification")
+
+    # Write out the NED sources that could not be verified, such that they can
+    # be checked by hand or in a later run
+    unverified_file = f"{path}/{name}/{name}_NED_unverified.fits"
+    if os.path.exists(unverified_file):
+        os.remove(unverified_file)
+    if unverified:
+        tab_unverified = vstack(unverified)
+        tab_unverified.meta["description"] = "NED sources that could not be verified"
+        tab_unverified.write(unverified_file, overwrite=True)
+        print(
+            Fore.YELLOW
+            + f"Warning: {len(tab_unverified)} NED sources could not be verified."
+        )
+
+    return stack_results(results)
 
+
+def stack_results(results):
+    """
+    Stack the redshift measurements of all sources in a single table
+    Input:
+        results: dictionary of source name and table (or None)
+    Return:
+        stacked table, or None if no source found any redshifts
+    """
     # Add table to the list only if it not not empty
-    cat_list = [t for t in [tab_redshift, tab_velocity, tab_NED] if t is not None]
-    if cat_list:
-        return vstack(cat_list)
+    parts = [
+        table_part(results[t])
+        for t in ["redshift", "velocity", "NED"]
+        if results.get(t) is not None
+    ]
+    if parts:
+        return assemble(parts)
     else:
         print(
             Fore.YELLOW + f"Warning: no spectroscopic redshifts found in search area."
         )
-        exit()
+        return None
+
+
+def source_files(data_path, name):
+    """
+    Location of the fits file of each source of a field
+    Input:
+        data_path: location of the downloaded data
+        name: basename/identifier of the field
+    Return:
+        dictionary of source name and fits file
+    """
+    return {
+        source: f"{data_path}/{name}/{name}_{suffix}.fits"
+        for source, (_, suffix) in SOURCES.items()
+    }
+
+
+def query_stage(coords, data_path, name, config, manifest, inputs, metrics=None):
+    """
+    Run the query of a field and record it in the manifest of the field, if
+    all sources answered and their results are kept on disk. Tiles saved by an
+    earlier search with different inputs are removed first, while those of an
+    interrupted search with the same inputs are kept.
+    Input:
+        coords: coordinates in Astropy format
+        data_path: location to place the downloaded data
+        name: basename/identifier for field to query
+        config: configuration
+        manifest: manifest of the field
+        inputs: everything the query depends on
+        metrics: optional Metrics of the field
+    Return:
+        stacked table with all redshift measurements, or None
+    """
+    tiles_dir = f"{data_path}/{name}/tiles"
+    if not manifest.fresh("tiles", inputs) and os.path.exists(tiles_dir):
+        for tile_file in os.listdir(tiles_dir):
+            os.remove(f"{tiles_dir}/{tile_file}")
+    manifest.record("tiles", inputs, [])
+
+    incomplete = []
+    grand_table = query_redshift(coords, data_path, name, config, incomplete, metrics)
+    if incomplete:
+        print(
+            Fore.YELLOW
+            + f"Warning: incomplete results ({', '.join(incomplete)}), the "
+            + "query will run again next time."
+        )
+        manifest.forget("query")
+    elif not config.keep_intermediates:
+        # The results of the sources are needed to reuse the query
+        manifest.forget("query")
+    else:
+        outputs = list(source_files(data_path, name).values())
+        outputs.append(f"{data_path}/{name}/{name}_NED_unverified.fits")
+        manifest.record("query", inputs, [f for f in outputs if os.path.exists(f)])
+    return grand_table
+
+
+# File extension and Astropy format of each output format
+OUTPUT_FORMATS = {
+    "fits": ("fits", "fits"),
+    "ecsv": ("ecsv", "ascii.ecsv"),
+    "parquet": ("parquet", "parquet"),
+    "hdf5": ("hdf5", "hdf5"),
+}
+
+
+def unique_path(data_path, name, output_format="fits"):
+    """
+    Location of the final table of a field
+    Input:
+        data_path: location of the downloaded data
+        name: basename/identifier of the field
+        output_format: format of the table, see OUTPUT_FORMATS
+    Return:
+        path of the table with the unique list of redshifts
+    """
+    extension = OUTPUT_FORMATS[output_format][0]
+    return f"{data_path}/{name}/{name}_online_redshift_ident_unique.{extension}"
+
+
+def write_output(table, path, output_format):
+    """
+    Write the final table of a field. Parquet needs pyarrow and HDF5 needs
+    h5py to be installed.
+    Input:
+        table: table with the unique list of redshifts
+        path: location of the table
+        output_format: format of the table, see OUTPUT_FORMATS
+    """
+    kwargs = {}
+    if output_format == "hdf5":
+        kwargs = {"path": "redshifts", "serialize_meta": True}
+    table.write(path, format=OUTPUT_FORMATS[output_format][1], overwrite=True, **kwargs)
+
+
+def read_output(path, output_format):
+    """
+    Read back the final table of a field
+    Input:
+        path: location of the table
+        output_format: format of the table, see OUTPUT_FORMATS
+    Return:
+        table with the unique list of redshifts
+    """
+    kwargs = {"path": "redshifts"} if output_format == "hdf5" else {}
+    return Table.read(path, format=OUTPUT_FORMATS[output_format][1], **kwargs)
 
 
 def run_query(data_path, name, RA, DEC, config, z="Redshift"):
     """
     Query NED and Vizier for spectroscopic redshifts around coordinates of 
-    choice
+    choice. The tables are passed from one stage to the next in memory; they
+    are only written to disk with config.keep_intermediates. The stages of the
+    search (query, stacking and removal of the duplicates) are recorded in a
+    manifest of the field, and a stage whose inputs did not change since the
+    last run is not run again. The time spent in each stage, the volume
+    downloaded and the rows kept or dropped along the way are appended to
+    config.metrics_file, also when the search fails.
     Input: 
         data_path: location to place the downloaded data
         name: basename/identifier for field to query
@@ -527,8 +1877,37 @@ def run_query(data_path, name, RA, DEC, config, z="Redshift"):
         config: configuration, including search radius, list of catalogues that 
                 have been deemed banned
     Output:
-        None; write out fits file with a unique list of redshifts around the
-        target of interest
+        table with the unique list of redshifts around the target of interest,
+        also written to a file in config.output_format; None if no redshifts
+        were found
+    """
+    profile_dir = f"{data_path}/{name}/profiles" if config.profile_stages else None
+    metrics = Metrics(name, profile_dir)
+    start = time.monotonic()
+    status = "failed"
+    try:
+        table = run_stages(data_path, name, RA, DEC, config, z, metrics)
+        status = "empty" if table is None else "done"
+        return table
+    finally:
+        wall_time = time.monotonic() - start
+        print(f"Field {name} {status} in {wall_time:.1f} s: {metrics.summary()}")
+        if config.metrics_file is not None:
+            metrics.write(config.metrics_file, status=status, wall_time=wall_time)
+
+
+def run_stages(data_path, name, RA, DEC, config, z, metrics):
+    """
+    Run the stages of the search of a field, see run_query
+    Input:
+        data_path: location to place the downloaded data
+        name: basename/identifier for field to query
+        RA, DEC: coordinates of the field, with units
+        config: configuration
+        z: name of the redshift column
+        metrics: Metrics of the field
+    Output:
+        table with the unique list of redshifts, or None
     """
     # Set the paths based on the where you want the data to be downloaded and
     # the identified for the sources/field the redshifts are downloaded for
@@ -536,112 +1915,203 @@ def run_query(data_path, name, RA, DEC, config, z="Redshift"):
         os.makedirs(f"{data_path}/{name}")
     path_concat = f"{data_path}/{name}/{name}_online_redshift.fits"
     path_ident = f'{path_concat.replace(".fits", "")}_ident.fits'
-    path_unique = f'{path_concat.replace(".fits", "")}_ident_unique.fits'
+    path_unique = unique_path(data_path, name, config.output_format)
+    manifest = Manifest(f"{data_path}/{name}/{name}_manifest.json")
+    reuse = config.reuse_stages and not config.refresh_cache
 
     # Build coordinates
     coords = coord.SkyCoord(RA, DEC)
 
-    # Perform the redshift query on Vizier and NED and write to fits file
-    grand_table = query_redshift(coords, data_path, name, config)
-
-    grand_table.meta["description"] = "Vizier and NED redshifts"
-    grand_table.write(path_concat, format="fits", overwrite=True)
-
-    # Identify duplicates and keep only the best redshift measurement
-    duplicates = identify_duplicates(path_concat, path_ident, RA="RA", DEC="DEC")
-    if duplicates == True:
-        find_groups_redshift(path_ident, path_unique, z)
+    # Perform the redshift query on Vizier and NED, unless it ran before with
+    # the same position, settings and code and its results were kept
+    query_inputs = {
+        "RA": RA,
+        "DEC": DEC,
+        "config": config_subset(config),
+        "code": QUERY_CODE,
+    }
+    queried = not (reuse and manifest.fresh("query", query_inputs))
+    if queried:
+        with metrics.stage("query"):
+            grand_table = query_stage(
+                coords, data_path, name, config, manifest, query_inputs, metrics
+            )
+    else:
+        print("Query inputs unchanged, reusing the earlier results...")
+        metrics.count("reused.query")
+
+    # Stack the results of all sources, or reuse the stacked table if the
+    # results did not change
+    files = source_files(data_path, name)
+    concat_inputs = {source: file_digest(files[source]) for source in files}
+    if not queried:
+        if reuse and manifest.fresh("concat", concat_inputs):
+            metrics.count("reused.concat")
+            grand_table = (
+                Table.read(path_concat) if os.path.exists(path_concat) else None
+            )
+        else:
+            with metrics.stage("concat"):
+                grand_table = stack_results(
+                    {s: Table.read(f) for s, f in files.items() if os.path.exists(f)}
+                )
+    if grand_table is None:
+        # Remove the tables of an earlier run that found redshifts, such that
+        # the field is not taken as done, e.g. when a batch is resumed
+        for path in [path_concat, path_ident, path_unique]:
+            if os.path.exists(path):
+                os.remove(path)
+        manifest.record("concat", concat_inputs, [])
+        manifest.forget("dedupe")
+        return None
+    if not config.keep_intermediates:
+        manifest.forget("concat")
+    elif queried or not manifest.fresh("concat", concat_inputs):
+        grand_table.meta["description"] = "Vizier and NED redshifts"
+        grand_table.write(path_concat, format="fits", overwrite=True)
+        manifest.record("concat", concat_inputs, [path_concat])
+
+    # Identify duplicates and keep only the best redshift measurement, unless
+    # the stacked table and the code did not change
+    dedupe_inputs = {
+        "concat": table_digest(grand_table),
+        "z": z,
+        "code": code_version(
+            __file__,
+            duplicates.__file__,
+            partitioned.__file__,
+            incremental.__file__,
+            tiles.__file__,
+            inspect.getfile(as_text),
+        ),
+        "format": config.output_format,
+        "cell_size": str(config.dedupe_cell_size),
+        "incremental": config.incremental_dedupe,
+    }
+    metrics.count("field.rows_stacked", len(grand_table))
+    if reuse and manifest.fresh("dedupe", dedupe_inputs):
+        metrics.count("reused.dedupe")
+        return read_output(path_unique, config.output_format)
+    outputs = [path_unique]
+    if config.incremental_dedupe:
+        with metrics.stage("dedupe"):
+            table = dedupe_incremental(
+                grand_table, f"{data_path}/{name}/{name}_groups", z, metrics
+            )
+            if config.keep_intermediates:
+                grand_table.write(path_ident, format="fits", overwrite=True)
+                outputs.append(path_ident)
+    elif config.dedupe_cell_size is not None:
+        # Stream the stacked table from its file rather than from memory
+        if not config.keep_intermediates:
+            grand_table.write(path_concat, format="fits", overwrite=True)
+        del grand_table
+        table = dedupe_cells(path_concat, path_unique, config, metrics)
+        if not config.keep_intermediates:
+            os.remove(path_concat)
+        manifest.record("dedupe", dedupe_inputs, outputs)
+        return table
     else:
-        shutil.copyfile(path_ident, path_unique)
+        with metrics.stage("dedupe"):
+            dups = duplicates.identify_duplicates(grand_table, RA="RA", DEC="DEC")
+            if config.keep_intermediates:
+                grand_table.write(path_ident, format="fits", overwrite=True)
+                outputs.append(path_ident)
+            if dups == True:
+                table = duplicates.find_groups_redshift(grand_table, None, z)
+            else:
+                table = grand_table
+    metrics.count("field.rows_unique", len(table))
+    with metrics.stage("write"):
+        write_output(table, path_unique, config.output_format)
+    manifest.record("dedupe", dedupe_inputs, outputs)
+    return table
 
 
-def identify_duplicates(file1, outname, RA="RA", DEC="DEC", dist=1):
+def dedupe_cells(path_concat, path_unique, config, metrics):
     """
-    Within a single file,identify using STITLS whether there are any sources 
-    with multiple redshift measurements
-    Input: 
-        file1: name of the file containing all the info on the targets. Must 
-               contain RA and DEC under the names "RA" and "DEC"
-        outname: preferred name for the output file. This will contain 2 extra
-                 columns which describe whether the source has "duplicate" and
-                 another which says how many duplicates exist in the group (this
-                 will usually be 2, from 1 source with 2 measurements)
-        RA, DEC: preferred names to be set for the RA and DEC column
-        dist: distance in arcsec to be used for the crossmatch
-    Output:
-        return True if duplicates were found, False if no duplicates were found
-        fits file with name outname which marks the duplicate sources   
+    Remove the duplicates of the stacked table cell by cell, see
+    partitioned.dedupe_partitioned. The stacked table is read from its file a
+    chunk at a time, and the unique rows are streamed to a FITS file, which is
+    converted afterwards if another output format was requested. The table with
+    the duplicates identified is not written in this mode.
+    Input:
+        path_concat: location of the stacked table with all redshift
+                     measurements
+        path_unique: location of the final table
+        config: configuration
+        metrics: Metrics of the field
+    Return:
+        table with the unique list of redshifts, with the same columns and
+        types as duplicates.find_groups_redshift gives
     """
-    command = (
-        f'stilts tmatch1 matcher=sky values="{RA} {DEC}" params={dist} '
-        + f"action=identify in={file1} out={outname}"
-    )
-    try:
-        subprocess.check_output(command, shell=True, executable="/bin/zsh")
-        return True
-    except:
-        shutil.copyfile(file1, outname)
-        return False
+    path_fits = path_unique
+    if config.output_format != "fits":
+        path_fits = f"{os.path.splitext(path_unique)[0]}.partial.fits"
+    with metrics.stage("dedupe"):
+        n_unique = partitioned.dedupe_partitioned(
+            path_concat,
+            path_fits,
+            config.dedupe_cell_size,
+            workers=config.dedupe_workers,
+            metrics=metrics,
+        )
+    metrics.count("field.rows_unique", n_unique)
+    table = native_table(Table.read(path_fits))
+    if config.output_format != "fits":
+        with metrics.stage("write"):
+            write_output(table, path_unique, config.output_format)
+            os.remove(path_fits)
+    return table
 
 
-def list_duplicates(seq):
+def native_table(table):
     """
-    Find groups of duplicated values in a sequence
+    Give a table read from a FITS file the types of a table made in memory:
+    text columns as str rather than bytes, and numbers in the byte order of
+    the machine rather than big-endian
     Input:
-        seq: list of values
-    Output:
-        return a list of unique group of duplicate values 
+        table: table read from a FITS file
+    Return:
+        the same table, converted in place
     """
-    tally = defaultdict(list)
-    for i, item in enumerate(seq):
-        try:
-            if item.mask == True:
-                continue
-        except:
-            tally[item].append(i)
-    return ((key, locs) for key, locs in tally.items() if len(locs) > 1)
+    table.convert_bytestring_to_unicode()
+    for name in table.colnames:
+        dtype = table[name].dtype
+        if not dtype.isnative:
+            table[name] = table[name].astype(dtype.newbyteorder("="))
+    return table
 
 
-def find_groups_redshift(file1, outfile, z):
+def dedupe_incremental(grand_table, path_index, z, metrics):
     """
-    Search through the GroupID column of the fits table and list duplicates and
-    their row id. The GroupID identifies pairs/triplets/groups of same sources
-    which have multiple redshift estimations.
+    Remove the duplicates with the group index of the field, see
+    incremental.GroupIndex: if the field was deduplicated before, only the
+    measurements added or removed since are matched. The index is built from
+    the whole table the first time, or when the code changed.
     Input:
-        file1: master file with all the redshift for a cluster. May contain 
-               duplicates from sources with multiple redshift measurements
-    Output:
-        fits file with unique sources 
+        grand_table: stacked table with all redshift measurements; it gets the
+                     GroupID and GroupSize columns of
+                     duplicates.identify_duplicates
+        path_index: location of the index of the field, without extension
+        z: name of the redshift column
+        metrics: Metrics of the field
+    Return:
+        table with the unique list of redshifts
     """
-
-    table = Table.read(file1, hdu=1)
-    ids = table["GroupID"]
-    indeces_remove = []
-
-    # Iterate through the grouped sources
-    for dup in sorted(list_duplicates(ids)):
-        if dup[0] < 0:
-            continue  # ignore negative ids which act as fillers for
-        # unique sources with no matches
-        # Find groups of sources
-        grouped_sources = table[dup[1]]
-
-        # Make a list of the length of the redshift as a proxy for the precision
-        # of the redshift measurement
-        significance = np.array(
-            [len(format(source[z], "f").rstrip("0")) for source in grouped_sources]
-        )
-        # Remove the source with the most precision and add the rest to the list
-        # of sources to be removed
-        del dup[1][np.argmax(significance)]
-        index_source_to_remove = dup[1]
-
-        # Append all indeces to be removed from the list
-        indeces_remove = indeces_remove + index_source_to_remove
-
-    # Remove the lines corresponding to the sources chosen for removal through
-    # the process described above
-    table.remove_rows(np.array(indeces_remove))
-
-    # Write out a new fits file containing only unique sources
-    table.write(outfile, format="fits", overwrite=True)
+    inputs = {
+        "z": z,
+        "code": code_version(
+            duplicates.__file__, incremental.__file__, inspect.getfile(as_text)
+        ),
+    }
+    index = incremental.GroupIndex.load(path_index, inputs)
+    if index is None:
+        metrics.count("dedupe.index_built")
+        index = incremental.GroupIndex.build(grand_table, z, inputs)
+        keep = index.best[index.rows]
+    else:
+        keep = index.update(grand_table, z, metrics=metrics)
+    index.save(path_index)
+    index.add_group_columns(grand_table)
+    return grand_table[keep]
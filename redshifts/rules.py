@@ -0,0 +1,118 @@
+import re
+
+import numpy as np
+
+# Default selection rules; all of them can be changed in the configuration file.
+# Words in a column description that disqualify the column
+BANNED_KEYWORDS = ["cluster", "Cluster", "Photometric", "photometric"]
+# Words in a column description that mark the preferred redshift column of a
+# catalog with several candidate columns
+HARD_SELECTION = ["spectroscopic", "Spectroscopic"]
+# NED object types (groups and clusters of galaxies) and redshift flags
+# (photometric, estimated or uncertain redshifts) whose sources are left out
+NED_TYPES = ["QGroup", "GClstr", "GGroup", "GPair", "GTrpl", "Other", "PofG"]
+NED_FLAGS = [
+    "::",
+    "?",
+    "CONT",
+    "EST",
+    "FoF",
+    "LUM",
+    "MFA",
+    "MOD",
+    "PHOT",
+    "PEAK",
+    "PRED",
+    "SED",
+    "TENT",
+    "TOMO",
+]
+
+
+class Matcher:
+    """
+    Check whether a text contains any of a list of substrings, with a single
+    regular expression compiled once for the whole list instead of one test
+    per substring
+    """
+
+    def __init__(self, substrings):
+        self.substrings = list(substrings)
+        self.pattern = None
+        if self.substrings:
+            self.pattern = re.compile("|".join(map(re.escape, self.substrings)))
+
+    def search(self, text):
+        """
+        Input:
+            text: string to search
+        Return:
+            True if any of the substrings is part of the text
+        """
+        return self.pattern is not None and self.pattern.search(text) is not None
+
+
+class Rules:
+    """
+    Selection rules of a configuration, compiled once: matchers for the banned
+    catalogs of each type of search and for the column descriptions, and the
+    NED types and flags as arrays for a vectorized membership test
+    """
+
+    def __init__(
+        self,
+        banned_catalogs_redshift=(),
+        banned_catalogs_velocity=(),
+        banned_keywords=BANNED_KEYWORDS,
+        hard_selection=HARD_SELECTION,
+        ned_types=NED_TYPES,
+        ned_flags=NED_FLAGS,
+    ):
+        self.banned = {
+            "redshift": Matcher(banned_catalogs_redshift),
+            "velocity": Matcher(banned_catalogs_velocity),
+        }
+        self.banned_keywords = Matcher(banned_keywords)
+        self.hard_selection = Matcher(hard_selection)
+        self.ned_types = np.array(ned_types, dtype=str)
+        self.ned_flags = np.array(ned_flags, dtype=str)
+
+    def settings(self):
+        """
+        The rules as plain lists, e.g. to build a hash of them
+        Return:
+            dictionary of rule name and list of strings
+        """
+        return {
+            "banned_catalogs_redshift": self.banned["redshift"].substrings,
+            "banned_catalogs_velocity": self.banned["velocity"].substrings,
+            "banned_keywords": self.banned_keywords.substrings,
+            "hard_selection": self.hard_selection.substrings,
+            "ned_types": self.ned_types.tolist(),
+            "ned_flags": self.ned_flags.tolist(),
+        }
+
+
+# Rules used when no configuration is given: nothing banned besides the
+# default keywords, types and flags
+DEFAULT_RULES = Rules()
+
+
+def as_text(column):
+    """
+    Turn a string column into an array of str, whether it holds str or bytes,
+    such that it can be compared with the rules
+    Input:
+        column: column of strings, possibly masked
+    Return:
+        array of str
+    """
+    data = np.ma.getdata(column)
+    if data.dtype.kind == "S":
+        return np.char.decode(data, "utf-8")
+    if data.dtype.kind == "O" and len(data) > 0 and isinstance(data[0], bytes):
+        return np.array(
+            [v.decode("utf-8") if isinstance(v, bytes) else v for v in data],
+            dtype=str,
+        )
+    return data.astype(str)
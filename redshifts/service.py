@@ -0,0 +1,308 @@
+import os
+import re
+import json
+import time
+import threading
+import socketserver
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from dataclasses import replace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from colorama import Fore
+import astropy.coordinates as coord
+
+import redshifts.query as q
+import redshifts.batch as b
+from redshifts.client import DEFAULT_PORT
+from redshifts.transport import get_transport
+
+# Field names that can be used as the name of the directory of the field
+FIELD_NAME = re.compile(r"[A-Za-z0-9_+\-][A-Za-z0-9_.+\-]*")
+# Size of the pieces in which a table is sent to the client
+CHUNK_SIZE = 1 << 20
+# Settings that a request can override for its field: those of the search
+# itself. Settings naming files and directories (cache, store, metrics,
+# profiles) or changing how the service runs stay as the service was started,
+# as any local user can send requests.
+FIELD_SETTINGS = [
+    "radius",
+    "uncertainty",
+    "banned_catalogs_redshift",
+    "banned_catalogs_velocity",
+    "banned_keywords",
+    "hard_selection",
+    "ned_types",
+    "ned_flags",
+    "output_format",
+]
+# Content type of the final table, for each output format
+CONTENT_TYPES = {
+    "fits": "application/fits",
+    "ecsv": "text/plain; charset=utf-8",
+    "parquet": "application/vnd.apache.parquet",
+    "hdf5": "application/x-hdf5",
+}
+
+
+class BadRequest(ValueError):
+    """
+    Field request that cannot be run, e.g. without coordinates or with an
+    unknown setting
+    """
+
+
+class Service:
+    """
+    Warm state of the daemon, shared by all the requests it serves: the
+    configuration, read and checked once, and, through the process, the
+    connection pools, caches and indices that the search keeps per process.
+    Fields are run in the threads of the server, at most jobs at a time, and
+    never two with the same name at once.
+    Input:
+        data_path: location to place the downloaded data
+        config: configuration
+        jobs: number of fields run at the same time
+    """
+
+    def __init__(self, data_path, config, jobs=4):
+        self.data_path = data_path
+        self.config = config
+        self.slots = threading.BoundedSemaphore(jobs)
+        self.jobs = jobs
+        self.lock = threading.Lock()
+        self.field_locks = defaultdict(threading.Lock)
+        self.running = Counter()
+        self.served = Counter()
+        self.started = time.time()
+        # Open the connection pool before the first request comes in
+        get_transport(config)
+
+    def field_config(self, request):
+        """
+        Configuration of a field: the configuration of the service with the
+        overrides of the request, which are limited to FIELD_SETTINGS
+        Input:
+            request: field request, with an optional radius and an optional
+                     dictionary of settings under "config"
+        Return:
+            configuration
+        """
+        overrides = dict(request.get("config") or {})
+        if request.get("radius") is not None:
+            overrides["radius"] = b.coordinate_string(request["radius"], None)
+        refused = sorted(set(overrides) - set(FIELD_SETTINGS))
+        if refused:
+            raise BadRequest(
+                f"settings that cannot be set per field: {', '.join(refused)}"
+            )
+        try:
+            return replace(self.config, **overrides)
+        except (TypeError, ValueError) as e:
+            raise BadRequest(f"invalid settings: {e}")
+
+    @contextmanager
+    def field(self, name):
+        """
+        Hold a slot of the service and the lock of a field while it runs
+        Input:
+            name: name of the field
+        """
+        with self.lock:
+            field_lock = self.field_locks[name]
+        with self.slots, field_lock:
+            with self.lock:
+                self.running[name] += 1
+            try:
+                yield
+            finally:
+                with self.lock:
+                    self.running[name] -= 1
+                    if not self.running[name]:
+                        del self.running[name]
+
+    def run(self, request, send):
+        """
+        Run the search of a field and hand its final table to send, while the
+        field is still locked, such that no other request overwrites the table
+        in the meantime
+        Input:
+            request: dictionary with the name, RA and DEC of the field (strings
+                     with units, or numbers in degrees), and optionally a
+                     radius and settings overrides, see field_config
+            send: function called with the table of unique redshifts (None if
+                  there are none), its path and its format
+        """
+        name = str(request.get("name", ""))
+        if not FIELD_NAME.fullmatch(name):
+            raise BadRequest(f"invalid field name: {name!r}")
+        if request.get("RA") is None or request.get("DEC") is None:
+            raise BadRequest("RA and DEC are required")
+        RA = b.coordinate_string(request["RA"], None)
+        DEC = b.coordinate_string(request["DEC"], None)
+        try:
+            coord.SkyCoord(RA, DEC)
+        except ValueError as e:
+            raise BadRequest(f"invalid coordinates: {e}")
+        config = self.field_config(request)
+
+        with self.field(name):
+            try:
+                table = q.run_query(self.data_path, name, RA, DEC, config)
+            except Exception:
+                self.count("failed")
+                raise
+            self.count("empty" if table is None else "done")
+            path = q.unique_path(self.data_path, name, config.output_format)
+            send(table, path, config.output_format)
+
+    def count(self, status):
+        with self.lock:
+            self.served[status] += 1
+
+    def status(self):
+        """
+        Return:
+            dictionary with the uptime, the fields running and the number of
+            fields served per outcome
+        """
+        with self.lock:
+            return {
+                "uptime": time.time() - self.started,
+                "jobs": self.jobs,
+                "running": sorted(self.running),
+                "served": dict(self.served),
+            }
+
+
+def handler(service):
+    """
+    HTTP request handler of the service:
+        POST /fields runs a field, see Service.run, and answers with its final
+            table (204 No Content if no redshifts were found)
+        GET /status answers with the state of the service, see Service.status
+    Errors are answered with a JSON object with an "error" message.
+    Input:
+        service: Service instance
+    Return:
+        BaseHTTPRequestHandler class
+    """
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def address_string(self):
+            # Clients of a Unix socket have no address
+            if isinstance(self.client_address, tuple):
+                return self.client_address[0]
+            return "local"
+
+        def do_GET(self):
+            if self.path != "/status":
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            self.send_json(200, service.status())
+
+        def do_POST(self):
+            if self.path != "/fields":
+                self.send_json(404, {"error": f"unknown path {self.path}"})
+                return
+            try:
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                request = json.loads(body or b"{}")
+                if not isinstance(request, dict):
+                    raise BadRequest("the request must be a JSON object")
+                service.run(request, self.send_table)
+            except (BadRequest, json.JSONDecodeError) as e:
+                self.send_json(400, {"error": str(e)})
+            except Exception as e:
+                self.send_json(500, {"error": f"{type(e).__name__}: {e}"})
+
+        def send_table(self, table, path, output_format):
+            """
+            Send the final table of a field, in pieces, such that it is never
+            held in memory as a whole
+            """
+            if table is None:
+                self.send_response(204)
+                self.send_header("X-Redshifts-Status", "empty")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", CONTENT_TYPES[output_format])
+            self.send_header("Content-Length", str(os.path.getsize(path)))
+            self.send_header("X-Redshifts-Status", "done")
+            self.send_header("X-Redshifts-Rows", str(len(table)))
+            self.send_header("X-Redshifts-Format", output_format)
+            self.end_headers()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                    self.wfile.write(chunk)
+
+        def send_json(self, status, content):
+            body = json.dumps(content).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    return Handler
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """
+    HTTP server on a Unix socket, serving every connection in its own thread;
+    only the user running the service can connect
+    """
+
+    daemon_threads = True
+
+    def server_bind(self):
+        # Remove the socket left behind by a service that was killed
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        super().server_bind()
+        os.chmod(self.server_address, 0o600)
+
+
+def make_server(service, port=DEFAULT_PORT, socket_path=None):
+    """
+    Server of the service, on a Unix socket if a path is given, or else on a
+    TCP port of the local host only
+    Input:
+        service: Service instance
+        port: TCP port
+        socket_path: location of the Unix socket
+    Return:
+        server, not yet serving
+    """
+    if socket_path is not None:
+        return UnixHTTPServer(os.path.expanduser(socket_path), handler(service))
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler(service))
+    server.daemon_threads = True
+    return server
+
+
+def serve(data_path, config, port=DEFAULT_PORT, socket_path=None, jobs=4):
+    """
+    Run the service until it is interrupted
+    Input:
+        data_path: location to place the downloaded data
+        config: configuration
+        port: TCP port of the local host to listen on
+        socket_path: location of a Unix socket to listen on instead
+        jobs: number of fields run at the same time
+    """
+    server = make_server(Service(data_path, config, jobs), port, socket_path)
+    where = socket_path if socket_path is not None else f"127.0.0.1:{port}"
+    print(Fore.GREEN + f"Serving redshift searches on {where}..." + Fore.RESET)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if socket_path is not None and os.path.exists(server.server_address):
+            os.remove(server.server_address)
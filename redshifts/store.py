@@ -0,0 +1,182 @@
+import os
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (e.g. on Windows) the store is not locked, so it should not
+    # be updated by several processes at once
+    fcntl = None
+
+import numpy as np
+from astropy import units as u
+from astropy.table import Column, Table, vstack
+import astropy.coordinates as coord
+
+import redshifts.tiles as tiles
+from redshifts.files import atomic_write
+
+# HEALPix order of the partitions of the rows, with cells of about 1.8 deg
+PARTITION_ORDER = 5
+
+
+class MasterStore:
+    """
+    Local store of the redshift measurements found by the searches, and of the
+    part of the sky that each source has been searched over. The coverage of a
+    source is kept in two forms: the HEALPix cells of the store order that lie
+    entirely in the searched area, i.e. a MOC at a single order, and the cones
+    that have been searched entirely, such that a search within an earlier one
+    is answered without a query even at the edges of the cone, where the cells
+    are only partly covered. The rows are stored in one FITS file per cell of
+    PARTITION_ORDER, such that a search only reads the partitions it overlaps.
+    A store only holds the results of a single configuration, see
+    query.get_store.
+    Input:
+        directory: location of the store
+        order: HEALPix order of the cells that make up the coverage
+    """
+
+    def __init__(self, directory, order):
+        self.directory = os.path.expanduser(directory)
+        self.order = order
+        os.makedirs(os.path.join(self.directory, "rows"), exist_ok=True)
+
+    def path(self, kind, source):
+        return os.path.join(self.directory, f"{kind}_{source}.npy")
+
+    def partition_path(self, partition):
+        return os.path.join(self.directory, "rows", f"{partition}.fits")
+
+    def load(self, kind, source, shape):
+        try:
+            return np.load(self.path(kind, source))
+        except (FileNotFoundError, OSError, ValueError):
+            return np.zeros(shape)
+
+    def save(self, kind, source, array):
+        with atomic_write(self.path(kind, source)) as f:
+            np.save(f, array)
+
+    def covered(self, source, cells, center, radius):
+        """
+        Find which cells of a search a source has already covered
+        Input:
+            source: name of the source, see query.SOURCES
+            cells: nested indices of the cells of the store order that overlap
+                   with the search
+            center, radius: cone of the search
+        Return:
+            boolean array which is True for the cells covered by the source
+        """
+        cones = self.load("cones", source, (0, 3))
+        if len(cones) > 0:
+            centers = coord.SkyCoord(cones[:, 0] * u.deg, cones[:, 1] * u.deg)
+            inside = centers.separation(center) + radius <= cones[:, 2] * u.deg
+            if inside.any():
+                return np.ones(len(cells), dtype=bool)
+        return np.isin(cells, self.load("coverage", source, 0))
+
+    def partitions(self, cells):
+        shift = 2 * (self.order - PARTITION_ORDER)
+        return np.unique(np.asarray(cells, dtype=np.int64) >> shift)
+
+    def read_partition(self, partition):
+        path = self.partition_path(partition)
+        if not os.path.exists(path):
+            return None
+        table = Table.read(path)
+        for name in ["Origin", "Source"]:
+            table[name] = table[name].astype(str)
+        return table
+
+    def rows(self, source, cells):
+        """
+        Rows of a source that lie in some of the cells
+        Input:
+            source: name of the source
+            cells: nested indices of cells of the store order
+        Return:
+            table with the RA, DEC, Redshift and Origin of the rows, or None if
+            there are none
+        """
+        tables = []
+        for partition in self.partitions(cells):
+            table = self.read_partition(partition)
+            if table is None:
+                continue
+            keep = (table["Source"] == source) & np.isin(table["Cell"], cells)
+            tables.append(table[keep])
+        tables = [table for table in tables if len(table) > 0]
+        if not tables:
+            return None
+        table = vstack(tables) if len(tables) > 1 else tables[0]
+        table.remove_columns(["Source", "Cell"])
+        return table
+
+    def put(self, source, table, region, inside, cells, cones=()):
+        """
+        Store the results of a search of a source. The rows of the source
+        already stored inside the searched region are replaced.
+        Input:
+            source: name of the source
+            table: rows found by the search, or None
+            region: nested indices of the cells of the store order that
+                    overlap with the searched region
+            inside: function returning, for a table with RA and DEC columns,
+                    the boolean mask of the rows inside the searched region
+            cells: nested indices of the cells that lie entirely inside the
+                   searched region
+            cones: center and radius of the cones that are now entirely
+                   covered by the source
+        """
+        if table is not None:
+            table = table["RA", "DEC", "Redshift", "Origin"]
+            table = table[inside(table)]
+            table["Source"] = Column(np.full(len(table), source))
+            table["Cell"] = tiles.cell_index(table, self.order)
+
+        shift = 2 * (self.order - PARTITION_ORDER)
+        with self.lock():
+            # Write the rows before the coverage, such that a search reading
+            # the store meanwhile finds the rows of every covered cell
+            for partition in self.partitions(region):
+                parts = []
+                old = self.read_partition(partition)
+                if old is not None:
+                    parts.append(old[(old["Source"] != source) | ~inside(old)])
+                if table is not None:
+                    parts.append(table[(table["Cell"] >> shift) == partition])
+                parts = [part for part in parts if len(part) > 0]
+                if parts:
+                    self.write(vstack(parts), self.partition_path(partition))
+                elif old is not None:
+                    os.remove(self.partition_path(partition))
+
+            coverage = self.load("coverage", source, 0).astype(np.int64)
+            self.save("coverage", source, np.union1d(coverage, cells))
+            if cones:
+                new = [
+                    [c.icrs.ra.deg, c.icrs.dec.deg, r.to_value(u.deg)] for c, r in cones
+                ]
+                old = self.load("cones", source, (0, 3))
+                self.save("cones", source, np.vstack([old, new]))
+
+    def write(self, table, path):
+        with atomic_write(path) as f:
+            table.write(f, format="fits")
+
+    @contextmanager
+    def lock(self):
+        """
+        Hold the lock of the store, such that processes updating the same
+        partitions do not overwrite each other's rows
+        """
+        with open(os.path.join(self.directory, "lock"), "a") as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
@@ -0,0 +1,152 @@
+import numpy as np
+from astropy_healpix import HEALPix
+from astropy import units as u
+import astropy.coordinates as coord
+
+# Deepest HEALPix order used for tiling, with cells of about 0.4 arcsec
+MAX_ORDER = 29
+
+
+def healpix(order):
+    """
+    HEALPix grid used to split the sky into tiles
+    Input:
+        order: HEALPix order; the grid has 12 * 4**order cells
+    Return:
+        HEALPix instance with nested ordering in ICRS
+    """
+    return HEALPix(nside=2 ** order, order="nested", frame=coord.ICRS())
+
+
+def tile_order(size):
+    """
+    Choose the HEALPix order whose cells are the largest ones not bigger than
+    the requested tile size
+    Input:
+        size: tile size as an angle
+    Return:
+        HEALPix order
+    """
+    for order in range(MAX_ORDER + 1):
+        if healpix(order).pixel_resolution <= size:
+            return order
+    return MAX_ORDER
+
+
+def tile_cells(center, radius, order):
+    """
+    Find the HEALPix cells that overlap, even partially, with a cone
+    Input:
+        center: center of the cone as an Astropy coordinate object
+        radius: radius of the cone
+        order: HEALPix order of the cells
+    Return:
+        array of the nested index of each cell
+    """
+    return healpix(order).cone_search_skycoord(center, radius)
+
+
+def cell_cone(cell, order, margin=0.01):
+    """
+    Smallest cone, centered on a cell, that contains the whole cell
+    Input:
+        cell: nested index of the cell
+        order: HEALPix order of the cell
+        margin: fractional margin added to the radius, to account for the
+                curved cell edges in between the sampled boundary points
+    Return:
+        center of the cell as an Astropy coordinate object and cone radius
+    """
+    hp = healpix(order)
+    center = hp.healpix_to_skycoord(cell)
+    boundary = hp.boundaries_skycoord(cell, step=4)
+    radius = boundary.separation(center).max() * (1 + margin)
+    return center, radius.to(u.arcmin)
+
+
+def cells_inside(center, radius, order):
+    """
+    Find the HEALPix cells that lie entirely within a cone
+    Input:
+        center: center of the cone as an Astropy coordinate object
+        radius: radius of the cone
+        order: HEALPix order of the cells
+    Return:
+        array of the nested index of each cell
+    """
+    cells = tile_cells(center, radius, order)
+    if len(cells) == 0:
+        return cells
+    boundary = healpix(order).boundaries_skycoord(cells, step=4)
+    inside = (boundary.separation(center) <= radius).all(axis=1)
+    return cells[inside]
+
+
+def cells_cone(cells, order, margin=0.01):
+    """
+    Cone, centered on the mean position of a set of cells, that contains all
+    the cells, see cell_cone
+    Input:
+        cells: nested indices of the cells
+        order: HEALPix order of the cells
+        margin: fractional margin added to the radius
+    Return:
+        center of the cone as an Astropy coordinate object and cone radius
+    """
+    hp = healpix(order)
+    centers = hp.healpix_to_skycoord(cells)
+    x, y, z = centers.cartesian.xyz.value.mean(axis=1)
+    center = coord.SkyCoord(
+        np.arctan2(y, x) * u.rad, np.arctan2(z, np.hypot(x, y)) * u.rad
+    )
+    boundary = hp.boundaries_skycoord(cells, step=4)
+    radius = boundary.separation(center).max() * (1 + margin)
+    return center, radius.to(u.arcmin)
+
+
+def in_cell(table, cell, order, RA="RA", DEC="DEC"):
+    """
+    Find the rows of a table that fall within a HEALPix cell
+    Input:
+        table: table with RA and DEC in degrees
+        cell: nested index of the cell
+        order: HEALPix order of the cell
+        RA, DEC: names of the RA and DEC columns
+    Return:
+        boolean array which is True for the rows inside the cell
+    """
+    return cell_index(table, order, RA, DEC) == cell
+
+
+def cell_index(table, order, RA="RA", DEC="DEC"):
+    """
+    HEALPix cell of every row of a table
+    Input:
+        table: table with RA and DEC in degrees
+        order: HEALPix order of the cells
+        RA, DEC: names of the RA and DEC columns
+    Return:
+        array of nested cell indices
+    """
+    return healpix(order).lonlat_to_healpix(
+        np.asarray(table[RA], dtype=float) * u.deg,
+        np.asarray(table[DEC], dtype=float) * u.deg,
+    )
+
+
+def in_cone(table, center, radius, RA="RA", DEC="DEC"):
+    """
+    Find the rows of a table that fall within a cone
+    Input:
+        table: table with RA and DEC in degrees
+        center: center of the cone as an Astropy coordinate object
+        radius: radius of the cone
+        RA, DEC: names of the RA and DEC columns
+    Return:
+        boolean array which is True for the rows inside the cone
+    """
+    coords = coord.SkyCoord(
+        np.asarray(table[RA], dtype=float) * u.deg,
+        np.asarray(table[DEC], dtype=float) * u.deg,
+    )
+    return coords.separation(center) <= radius
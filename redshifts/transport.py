@@ -0,0 +1,118 @@
+import os
+import threading
+
+from requests.adapters import HTTPAdapter
+from astroquery.ned import Ned
+from astroquery.vizier import Vizier
+from astropy import units as u
+
+
+def raise_server_error(response, *args, **kwargs):
+    if response.status_code >= 500:
+        response.raise_for_status()
+
+
+class NedClient(type(Ned)):
+    """
+    Astroquery NED client sending every request with its own deadlines, as
+    the astroquery one sends them with the timeout of the module-wide client,
+    and never through the astroquery disk cache: the region queries are cached
+    by ResponseCache and the object lookups by the verdict database, each with
+    their own expiration, refresh and switch, which a second cache of a week
+    would get around
+    Input:
+        timeout: connect and read deadline in seconds
+    """
+
+    def __init__(self, timeout):
+        super().__init__()
+        self.timeout = timeout
+
+    def _request(self, *args, **kwargs):
+        kwargs["timeout"] = self.timeout
+        kwargs["cache"] = False
+        return super()._request(*args, **kwargs)
+
+
+class Transport:
+    """
+    HTTP connections shared by all the NED and Vizier requests of a process.
+    The astroquery clients all use the same session, whose connection pool
+    keeps up to pool_size connections per host open between requests, instead
+    of a session per client that opens new connections for every query.
+    A server error (e.g. 503 Service Unavailable) raises an HTTPError instead
+    of being handed to the astroquery parser as if it were a result.
+    """
+
+    def __init__(self, pool_size):
+        # Start from the session of the astroquery NED client, which carries
+        # the astroquery User-Agent and logging hooks
+        self.session = type(Ned)()._session
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.hooks["response"].append(raise_server_error)
+        self.ned_clients = {}
+        self.lock = threading.Lock()
+
+    def ned(self, timeout):
+        """
+        NED client sending its requests over the shared connections; the client
+        is shared by all threads that use the same deadlines
+        Input:
+            timeout: connect and read deadline in seconds
+        Return:
+            astroquery NED client
+        """
+        with self.lock:
+            if timeout not in self.ned_clients:
+                client = NedClient(timeout)
+                client._session = self.session
+                self.ned_clients[timeout] = client
+            return self.ned_clients[timeout]
+
+    def vizier(self, timeout, **kwargs):
+        """
+        Vizier client sending its requests over the shared connections
+        Input:
+            timeout: connect and read deadline in seconds
+            kwargs: options of the query, e.g. columns and UCD filter
+        Return:
+            astroquery Vizier client
+        """
+        client = type(Vizier)(timeout=timeout, **kwargs)
+        client._session = self.session
+        return client
+
+
+# One transport per process and pool size; a process started by fork gets its
+# own, as connections cannot be shared between processes
+_transports = {}
+_transports_lock = threading.Lock()
+
+
+def get_transport(config):
+    """
+    Return the transport shared by all the requests of this process
+    Input:
+        config: configuration
+    Return:
+        Transport instance
+    """
+    key = (os.getpid(), config.http_pool_size)
+    with _transports_lock:
+        if key not in _transports:
+            _transports[key] = Transport(config.http_pool_size)
+        return _transports[key]
+
+
+def deadline(config, read_timeout):
+    """
+    Connect and read deadlines of a request, in the form requests expects
+    Input:
+        config: configuration
+        read_timeout: maximum time to wait for data from the archive
+    Return:
+        tuple of the connect and read deadline in seconds
+    """
+    return (config.connect_timeout.to_value(u.s), read_timeout.to_value(u.s))
@@ -0,0 +1,68 @@
+import os
+import time
+import sqlite3
+from contextlib import closing
+
+
+class VerdictStore:
+    """
+    SQLite database of the NED objects whose redshift type has been checked.
+    For every object it keeps the smallest published uncertainty of its
+    redshift measurements (NULL if none has an uncertainty) and the time it
+    was fetched, such that the check against any maximum uncertainty can be
+    answered without asking NED again. The database can be shared by several
+    processes; each call opens its own connection.
+    Input:
+        path: location of the database file
+    """
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with closing(self.connect()) as db, db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.execute(
+                "CREATE TABLE IF NOT EXISTS verdicts ("
+                "object_name TEXT PRIMARY KEY, "
+                "min_uncertainty REAL, "
+                "fetched REAL NOT NULL)"
+            )
+
+    def connect(self):
+        # Wait for the other processes writing to the database, rather than
+        # failing straight away
+        return sqlite3.connect(self.path, timeout=60)
+
+    def get(self, names, max_age):
+        """
+        Look up many objects at once, with a single query on the primary key
+        Input:
+            names: NED object names
+            max_age: age in seconds after which a verdict is no longer used
+        Return:
+            dictionary of object name and smallest uncertainty (None if the
+            object has no uncertainty), for the objects with a recent verdict
+        """
+        with closing(self.connect()) as db:
+            db.execute("CREATE TEMP TABLE names (object_name TEXT)")
+            db.executemany("INSERT INTO names VALUES (?)", ((n,) for n in names))
+            rows = db.execute(
+                "SELECT object_name, min_uncertainty FROM verdicts "
+                "WHERE object_name IN (SELECT object_name FROM names) "
+                "AND fetched >= ?",
+                (time.time() - max_age,),
+            ).fetchall()
+        return dict(rows)
+
+    def put(self, verdicts):
+        """
+        Store the verdicts of many objects, replacing older ones
+        Input:
+            verdicts: dictionary of object name and smallest uncertainty
+        """
+        now = time.time()
+        with closing(self.connect()) as db, db:
+            db.executemany(
+                "INSERT OR REPLACE INTO verdicts VALUES (?, ?, ?)",
+                ((name, unc, now) for name, unc in verdicts.items()),
+            )
@@ -0,0 +1,128 @@
+import tempfile
+import unittest
+from unittest import mock
+
+import numpy as np
+import requests
+from astropy.table import MaskedColumn, Table, vstack
+
+import redshifts.constants as c
+import redshifts.query as q
+
+
+def catalog(name, z, dtype):
+    """
+    Vizier catalog with its redshift column already chosen
+    Input:
+        name: name of the catalog
+        z: redshifts
+        dtype: dtype of the redshift column
+    Return:
+        catalog as returned by the preliminary selection
+    """
+    n = len(z)
+    return Table(
+        [
+            MaskedColumn(np.linspace(150, 150.1, n), name="_RAJ2000"),
+            MaskedColumn(np.linspace(2, 2.1, n), name="_DEJ2000"),
+            MaskedColumn(np.array(z, dtype=dtype), name="z"),
+        ],
+        meta={"name": name, "redshift_column": "z"},
+    )
+
+
+class PhotozFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.config = c.Setup(
+            radius=c.Angle("10 arcmin"),
+            uncertainty=0.01,
+            banned_catalogs_redshift=[],
+            banned_catalogs_velocity=[],
+        )
+
+    def test_float32_judged_as_stacked(self):
+        # Once stacked with a float64 catalog, the float32 0.1 reads as
+        # 0.10000000149011612 and is dropped, as it was when the filter ran on
+        # the stacked table
+        cats = [
+            catalog("A", [0.1, 0.3051, 0.25, 0.123456], np.float32),
+            catalog("B", [0.123, 0.5, 0.2000000001], np.float64),
+        ]
+        table = q.process_vizier(cats, "redshift", self.config)
+        stacked = vstack([Table({"z": cat["z"]}) for cat in cats])["z"]
+        expected = stacked[q.precise_redshifts(stacked)]
+        np.testing.assert_array_equal(table["Redshift"], expected)
+        self.assertNotIn(np.float64(np.float32(0.1)), table["Redshift"])
+
+    def test_float32_alone(self):
+        # A stack of float32 catalogs stays float32, so 0.1 reads as 0.1
+        cats = [catalog("A", [0.1, 0.3051], np.float32)]
+        table = q.process_vizier(cats, "redshift", self.config)
+        self.assertEqual(table["Redshift"].dtype, np.float32)
+        np.testing.assert_array_equal(table["Redshift"], np.float32([0.1, 0.3051]))
+
+
+class FakeNed:
+    """
+    NED client answering the redshift table of an object, or raising the
+    exception given for it
+    """
+
+    def __init__(self, answers):
+        self.answers = answers
+        self.asked = []
+
+    def get_table(self, object_name, table):
+        self.asked.append(object_name)
+        answer = self.answers[object_name]
+        if isinstance(answer, Exception):
+            raise answer
+        return Table({"Published Redshift Uncertainty": [answer]})
+
+
+class VerifyNedObjectsTest(unittest.TestCase):
+    def setUp(self):
+        self.config = c.Setup(
+            radius=c.Angle("10 arcmin"),
+            uncertainty=0.01,
+            banned_catalogs_redshift=[],
+            banned_catalogs_velocity=[],
+            cache_dir=tempfile.mkdtemp(),
+            ned_rate=0,
+            ned_retries=0,
+        )
+        self.ned = FakeNed(
+            {
+                "spec": 0.001,
+                "down": requests.exceptions.ConnectionError("refused"),
+                "none": ValueError("no redshift table"),
+            }
+        )
+        transport = mock.Mock()
+        transport.ned.return_value = self.ned
+        patcher = mock.patch.object(q, "get_transport", return_value=transport)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def verify(self):
+        cat = Table({"Object Name": ["spec", "down", "none"]})
+        return q.verify_ned_objects(cat, self.config)
+
+    def test_permanent_failure_is_a_verdict(self):
+        # A connection problem leaves the source unverified, an object without
+        # a redshift table is a definite verdict
+        spectroscopic, reasons = self.verify()
+        self.assertEqual(spectroscopic.tolist(), [True, False, False])
+        self.assertEqual(reasons[0], "")
+        self.assertIn("ConnectionError", reasons[1])
+        self.assertEqual(reasons[2], "")
+
+    def test_only_unverified_asked_again(self):
+        self.verify()
+        self.ned.asked.clear()
+        self.verify()
+        self.assertEqual(self.ned.asked, ["down"])
+
+
+if __name__ == "__main__":
+    unittest.main()